@@ -0,0 +1,409 @@
+"""
+End-to-end benchmark of ingest, playlist generation and serving, run entirely offline.
+
+A FakeOrigin publishes segments on a simulated clock. The benchmark drives the real
+SegmentDownloader, playlist_creator and serve_http code against it and reports:
+
+  ingest         catch-up time for the backlog, per-segment ingest latency, journal bytes per segment,
+                 CPU and origin bytes per playlist reload while nothing changes
+  playlist_tick  CPU per tick for every delay in config.delays_seconds, at several buffer depths
+  playlist_event latency from a committed segment to the delayed playlist being rewritten
+  serve          requests/sec for on-demand playlists and segments
+  export         objects uploaded and CPU per publishing round, exporting the ingested buffer to a folder
+  read_ahead     first reads of the segments a delay plays next, from a cold page cache and after reading
+                 ahead (Linux only, as it drops the segments from the page cache with posix_fadvise)
+
+Run from the repository root:
+
+    python benchmarks/bench_pipeline.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import wait
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_origin import FakeOrigin, SimulatedClock
+from http_client import HttpConnection, percentile, raise_open_file_limit
+
+
+def drain_downloads(downloader, timeout: float = 60.0):
+    """Commit downloads as they finish, until none are left"""
+    deadline = time.perf_counter() + timeout
+    while downloader.pending_downloads and time.perf_counter() < deadline:
+        wait(downloader.pending_downloads.values(), timeout=deadline - time.perf_counter())
+        downloader.commit_segments()
+
+
+def bench_ingest(args, folder: Path, clock: SimulatedClock) -> dict:
+    from segment_downloader import SegmentDownloader
+
+    lost = set(random.sample(range(1000, 1000 + args.backlog + args.live_segments), args.lost_segments))
+    origin = FakeOrigin(clock, segment_duration=args.segment_duration, window=max(args.backlog, 6),
+                        backlog=args.backlog, lost=lost, error_rate=args.error_rate,
+                        segment_bytes=args.segment_bytes, can_skip_until=args.can_skip_until,
+                        variants=[(f'v{i + 1}-{bandwidth // 1000}', bandwidth)
+                                  for i, bandwidth in enumerate(args.variants)]).start()
+    try:
+        downloader = SegmentDownloader(output_dir=str(folder), master_url=origin.url, max_retries=2,
+                                       initial_backoff=0.01, variants_url=origin.master_url if args.variants else None)
+
+        # Catching up on a full origin window after a restart
+        started = time.perf_counter()
+        downloader.process_segments()
+        drain_downloads(downloader)
+        catch_up = time.perf_counter() - started
+        journal_bytes = downloader.journal.path.stat().st_size
+
+        # Then one new segment per target duration
+        latencies = []
+        for _ in range(args.live_segments):
+            clock.advance(args.segment_duration)
+            started = time.perf_counter()
+            downloader.process_segments()
+            drain_downloads(downloader)
+            latencies.append(time.perf_counter() - started)
+
+        downloader.journal.sync()
+        journal_growth = downloader.journal.path.stat().st_size - journal_bytes
+
+        # Reloads between segments, when the playlist hasn't changed
+        playlist_bytes = origin.playlist_bytes
+        started = time.process_time()
+        for _ in range(args.idle_polls):
+            downloader.process_segments()
+        idle_cpu = (time.process_time() - started) / max(args.idle_polls, 1)
+        idle_bytes = (origin.playlist_bytes - playlist_bytes) / max(args.idle_polls, 1)
+        downloader.executor.shutdown()
+        downloader.journal.close()
+        downloader.segment_events.close()
+    finally:
+        origin.stop()
+
+    return {
+        'backlog segments': args.backlog,
+        'catch-up s': catch_up,
+        'ingest p50 ms': percentile(latencies, 0.5) * 1000,
+        'ingest p99 ms': percentile(latencies, 0.99) * 1000,
+        'segments indexed': len(downloader.segments),
+        'variants': len(downloader.variants),
+        'variant gaps': sum(bin(mask).count('1') for mask in downloader.segments.variant_masks) - \
+            len(downloader.segments) * len(downloader.variants),
+        'journal bytes/segment': journal_growth / max(args.live_segments, 1),
+        'segment bytes/segment': args.segment_bytes,
+        'origin requests': origin.requests,
+        'origin playlist bytes': origin.playlist_bytes,
+        'idle poll cpu ms': idle_cpu * 1000,
+        'idle poll bytes': idle_bytes,
+    }
+
+
+def build_index(depth: int, segment_duration: float, end_time: float):
+    from segment_index import SegmentIndex
+
+    segment_index = SegmentIndex(Path(os.devnull))
+    first_time = end_time - depth * segment_duration
+    for i in range(depth):
+        sequence = 1000 + i
+        segment_index.add(sequence, first_time + i * segment_duration, segment_duration, f'segment_{sequence:04d}.aac')
+    return segment_index
+
+
+def bench_playlist_ticks(args, folder: Path, clock: SimulatedClock) -> list:
+    import config
+    import playlist_creator
+
+    results = []
+    for depth in args.depths:
+        segment_index = build_index(depth, args.segment_duration, clock.time())
+        specs = [
+            config.PlaylistSpec(delay, clock.time() - depth * args.segment_duration, f'playlist_{delay}.m3u8',
+                                first_segment_id=segment_index.sequences[0], is_initalised=True)
+            for delay in config.delays_seconds
+        ]
+        tick_folder = folder / f'ticks_{depth}'
+        tick_folder.mkdir()
+        with mock.patch.object(playlist_creator, 'playlist_folder', str(tick_folder)):
+            playlist_creator.written_playlists.clear()
+            cpu = []
+            for _ in range(args.ticks):
+                clock.advance(1.0)
+                started = time.process_time()
+                for spec in specs:
+                    playlist_creator.populate_playlist(spec, segment_index)
+                cpu.append(time.process_time() - started)
+        results.append({
+            'buffer depth': depth,
+            'delays': len(specs),
+            'cpu/tick ms': sum(cpu) / len(cpu) * 1000,
+            'cpu/tick p99 ms': percentile(cpu, 0.99) * 1000,
+        })
+    return results
+
+
+def bench_playlist_events(args, folder: Path, clock: SimulatedClock) -> dict:
+    import config
+    import playlist_creator
+    from segment_journal import SegmentJournal
+    from segment_events import SegmentEventNotifier
+
+    event_folder = folder / 'events'
+    event_folder.mkdir()
+    journal = SegmentJournal(event_folder / 'segment_journal.jsonl')
+    journal.open()
+    sequence = 1000
+    start_time = clock.time() - 600
+    for sequence in range(1000, 1060):
+        journal.append({'url': str(sequence), 'duration': args.segment_duration, 'sequence': sequence,
+                        'timestamp': start_time + (sequence - 1000) * args.segment_duration,
+                        'filename': f'segment_{sequence:04d}.aac'})
+    spec = config.PlaylistSpec(0, start_time, 'playlist_0.m3u8', first_segment_id=None)
+    playlist_path = event_folder / 'playlist_0.m3u8'
+
+    latencies = []
+    with mock.patch.object(playlist_creator, 'playlist_folder', str(event_folder)):
+        # Put the live edge of the zero-delay playlist just before the next segment starts
+        last_end = start_time + (sequence - 1000 + 1) * args.segment_duration
+        clock.set(last_end + config.buffer_period_seconds - 0.5)
+        threading.Thread(target=playlist_creator.main, args=([spec],), daemon=True).start()
+        deadline = time.perf_counter() + 10
+        while not playlist_path.exists() and time.perf_counter() < deadline:
+            time.sleep(0.001)
+
+        notifier = SegmentEventNotifier(event_folder / 'segment_events.sock')
+        for _ in range(args.events):
+            sequence += 1
+            filename = f'segment_{sequence:04d}.aac'
+            # The new segment is already due on the delayed timeline as soon as it is committed
+            clock.advance(args.segment_duration)
+            started = time.perf_counter()
+            journal.append({'url': str(sequence), 'duration': args.segment_duration, 'sequence': sequence,
+                            'timestamp': start_time + (sequence - 1000) * args.segment_duration,
+                            'filename': filename})
+            notifier.notify()
+            deadline = started + 5
+            while filename not in playlist_path.read_text() and time.perf_counter() < deadline:
+                time.sleep(0.0005)
+            latencies.append(time.perf_counter() - started)
+        notifier.close()
+    journal.close()
+
+    return {
+        'events': len(latencies),
+        'update p50 ms': percentile(latencies, 0.5) * 1000,
+        'update p99 ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def serve_listener(port: int, delay: int, stop_at: float, results: dict):
+    connection = HttpConnection('127.0.0.1', port)
+    try:
+        while time.perf_counter() < stop_at:
+            try:
+                status, _, body, latency = await connection.get(f'/playlist.m3u8?delay={delay}')
+                results['latencies'].append(latency)
+                uris = [line for line in body.decode().splitlines() if line and not line.startswith('#')]
+                if status != 200 or not uris:
+                    results['errors'] += 1
+                    continue
+                status, _, body, latency = await connection.get(random.choice(uris))
+                results['latencies'].append(latency)
+                results['bytes'] += len(body)
+                if status != 200:
+                    results['errors'] += 1
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                results['errors'] += 1
+                await connection.close()
+    finally:
+        await connection.close()
+
+
+def bench_serve(args, folder: Path, clock: SimulatedClock, ingest_end: float) -> dict:
+    import serve_http
+
+    clock.set(ingest_end)
+    server = serve_http.StreamServer(('127.0.0.1', 0), str(folder), log_requests=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    # Delays that land inside the ingested buffer
+    buffered = args.live_segments * args.segment_duration
+    delays = [max(int(buffered / 2) - 60, 0), max(int(buffered / 4) - 60, 0)]
+
+    async def run():
+        results = {'latencies': [], 'bytes': 0, 'errors': 0}
+        stop_at = time.perf_counter() + args.serve_seconds
+        await asyncio.gather(*(serve_listener(port, delays[i % len(delays)], stop_at, results)
+                               for i in range(args.listeners)))
+        return results
+
+    started = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'listeners': args.listeners,
+        'requests/s': len(results['latencies']) / elapsed,
+        'MB/s': results['bytes'] / elapsed / 1e6,
+        'p50 ms': percentile(results['latencies'], 0.5) * 1000,
+        'p99 ms': percentile(results['latencies'], 0.99) * 1000,
+        'errors': results['errors'],
+    }
+
+
+def bench_export(args, folder: Path, clock: SimulatedClock, ingest_end: float) -> dict:
+    import config
+    import export
+    import playlist_creator
+    from concurrent.futures import ThreadPoolExecutor
+    from segment_index import SegmentIndex
+    from variants import load_variants
+
+    clock.set(ingest_end)
+    station = config.Station('bench', '', str(folder))
+    segment_index = SegmentIndex(folder / 'segment_journal.jsonl')
+    segment_index.refresh()
+    # Every delay that lands inside the ingested buffer
+    buffered = args.live_segments * args.segment_duration
+    specs = [config.PlaylistSpec(delay, clock.time() - buffered, f'playlist_{delay}.m3u8',
+                                 first_segment_id=segment_index.sequences[0], is_initalised=True)
+             for delay in config.delays_seconds if delay + config.buffer_period_seconds < buffered]
+
+    def uploads(kind: str) -> float:
+        return export.export_uploads._values.get(('bench', kind), 0)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        exporter = export.StationExporter(station, export.DirectoryTarget(folder.parent / 'export'), executor,
+                                          delays=[spec.delay_seconds for spec in specs])
+        variants = load_variants(folder)
+        for spec in specs:
+            playlist_creator.populate_playlist(spec, segment_index, station, variants)
+        started = time.perf_counter()
+        exporter.export_once()
+        first_round = time.perf_counter() - started
+        first_segments = uploads('segment')
+
+        # One round a second while the delayed windows move along the buffer
+        cpu = []
+        playlist_uploads = uploads('playlist')
+        for _ in range(args.export_rounds):
+            clock.advance(1.0)
+            for spec in specs:
+                playlist_creator.populate_playlist(spec, segment_index, station, variants)
+            started = time.process_time()
+            exporter.export_once()
+            cpu.append(time.process_time() - started)
+
+    return {
+        'delays': len(specs),
+        'first round s': first_round,
+        'first round segments': first_segments,
+        'rounds': len(cpu),
+        'playlists/round': (uploads('playlist') - playlist_uploads) / max(len(cpu), 1),
+        'segments/round': (uploads('segment') - first_segments) / max(len(cpu), 1),
+        'cpu/round ms': sum(cpu) / max(len(cpu), 1) * 1000,
+    }
+
+
+def bench_read_ahead(args, folder: Path, clock: SimulatedClock, ingest_end: float) -> dict:
+    import serve_http
+
+    clock.set(ingest_end)
+    read_ahead = serve_http.PlaylistGenerator(str(folder)).read_ahead()
+    buffered = args.live_segments * args.segment_duration
+    read_ahead.delay_requested(max(int(buffered / 2) - 60, 0), playlist_file=False)
+    paths = [path for path, _ in read_ahead.wanted(clock.time())]
+
+    def first_reads(warm: bool) -> list:
+        # Written segments have to reach the disk before the page cache will let them go
+        os.sync()
+        for path in paths:
+            read_ahead.drop(path, 0, 0)
+        if warm:
+            read_ahead.hot.clear()
+            read_ahead.run_once(clock.time())
+            # In service segments are read ahead minutes before they are due, here the reads just need to land
+            time.sleep(0.5)
+        latencies = []
+        for path in paths:
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                f.read()
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    cold = first_reads(False)
+    warm = first_reads(True)
+    return {
+        'segments': len(paths),
+        'cold p50 ms': percentile(cold, 0.5) * 1000,
+        'cold p99 ms': percentile(cold, 0.99) * 1000,
+        'read ahead p50 ms': percentile(warm, 0.5) * 1000,
+        'read ahead p99 ms': percentile(warm, 0.99) * 1000,
+    }
+
+
+def print_result(stage: str, result: dict):
+    print(f'{stage:15}' + '  '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}'
+                                    for key, value in result.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segment-duration', type=float, default=10.0)
+    parser.add_argument('--segment-bytes', type=int, default=262144)
+    parser.add_argument('--backlog', type=int, default=30, help="Segments waiting at the origin on start up")
+    parser.add_argument('--live-segments', type=int, default=60, help="Segments ingested one at a time after catching up")
+    parser.add_argument('--lost-segments', type=int, default=0, help="Segments the origin answers with a 404")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of segment requests failing with a 503")
+    parser.add_argument('--can-skip-until', type=float, default=None,
+                        help="Have the origin offer LL-HLS delta updates skipping segments this many seconds old")
+    parser.add_argument('--variants', type=int, nargs='*', default=[],
+                        help="Bandwidths of extra variants the origin offers, to ingest alongside the main one")
+    parser.add_argument('--idle-polls', type=int, default=20, help="Playlist reloads timed while nothing changes")
+    parser.add_argument('--depths', type=int, nargs='+', default=[360, 2160, 8640], help="Buffer depths, in segments")
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--listeners', type=int, default=200)
+    parser.add_argument('--serve-seconds', type=float, default=5.0)
+    parser.add_argument('--export-rounds', type=int, default=60, help="Publishing rounds, one per simulated second")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    clock = SimulatedClock()
+    results = {}
+    # The playlist creator thread is a daemon and may still be checkpointing as the folder is removed
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder:
+        # The pipeline writes its logs into the working directory
+        os.chdir(folder)
+        with mock.patch('time.time', clock.time):
+            results['ingest'] = bench_ingest(args, Path(folder) / 'output', clock)
+            ingest_end = clock.time()
+            results['playlist_tick'] = bench_playlist_ticks(args, Path(folder), clock)
+            results['playlist_event'] = bench_playlist_events(args, Path(folder), clock)
+            results['serve'] = bench_serve(args, Path(folder) / 'output', clock, ingest_end)
+            results['export'] = bench_export(args, Path(folder) / 'output', clock, ingest_end)
+            if hasattr(os, 'posix_fadvise'):
+                results['read_ahead'] = bench_read_ahead(args, Path(folder) / 'output', clock, ingest_end)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for stage, result in results.items():
+        for row in result if isinstance(result, list) else [result]:
+            print_result(stage, row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Benchmark serve_http against the original single-threaded SimpleHTTPRequestHandler server.
+
+Each simulated listener repeatedly fetches a delayed playlist and one of the recent
+segments over its own connection. Run from the repository root:
+
+    python benchmarks/bench_serve.py --listeners 2000 --seconds 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from http_client import HttpConnection, percentile, raise_open_file_limit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The server as it was before the production serving mode
+BASELINE_SERVER = '''
+import http.server, socketserver, sys
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=sys.argv[2], **kwargs)
+    def log_message(self, *args):
+        pass
+with socketserver.TCPServer(("", int(sys.argv[1])), Handler) as httpd:
+    httpd.serve_forever()
+'''
+
+
+def build_output_folder(folder: str, segments: int, segment_bytes: int):
+    """Write fake segments and a playlist referencing the newest of them"""
+    for sequence in range(segments):
+        with open(os.path.join(folder, f'segment_{sequence:04d}.aac'), 'wb') as f:
+            f.write(os.urandom(segment_bytes))
+    with open(os.path.join(folder, 'playlist_300.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:11\n')
+        f.write(f'#EXT-X-MEDIA-SEQUENCE:{segments - 6}\n')
+        for sequence in range(segments - 6, segments):
+            f.write(f'#EXTINF:10.0\nsegment_{sequence:04d}.aac\n')
+
+
+def start_server(mode: str, port: int, folder: str) -> subprocess.Popen:
+    if mode == 'baseline':
+        command = [sys.executable, '-c', BASELINE_SERVER, str(port), folder]
+    else:
+        command = [sys.executable, os.path.join(REPO_ROOT, 'serve_http.py'),
+                   '--port', str(port), '--folder', folder, '--quiet']
+    process = subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+async def listener(port: int, segments: int, stop_at: float, results: dict):
+    connection = HttpConnection('127.0.0.1', port)
+    try:
+        while time.perf_counter() < stop_at:
+            for path in ('/playlist_300.m3u8', f'/segment_{random.randrange(segments - 6, segments):04d}.aac'):
+                try:
+                    status, _, body, latency = await connection.get(path)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                    results['errors'] += 1
+                    await connection.close()
+                    continue
+                if status != 200:
+                    results['errors'] += 1
+                results['latencies'].append(latency)
+                results['bytes'] += len(body)
+    finally:
+        results['connects'] += connection.connects
+        await connection.close()
+
+
+async def run_load(port: int, listeners: int, seconds: float, segments: int) -> dict:
+    results = {'latencies': [], 'bytes': 0, 'errors': 0, 'connects': 0}
+    stop_at = time.perf_counter() + seconds
+    await asyncio.gather(*(listener(port, segments, stop_at, results) for _ in range(listeners)))
+    return results
+
+
+def benchmark(mode: str, args) -> dict:
+    with tempfile.TemporaryDirectory() as folder:
+        build_output_folder(folder, args.segments, args.segment_bytes)
+        port = args.port + (1 if mode == 'baseline' else 0)
+        server = start_server(mode, port, folder)
+        try:
+            started = time.perf_counter()
+            results = asyncio.run(run_load(port, args.listeners, args.seconds, args.segments))
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = results['latencies']
+    return {
+        'mode': mode,
+        'requests/s': len(latencies) / elapsed,
+        'MB/s': results['bytes'] / elapsed / 1e6,
+        'p50 ms': percentile(latencies, 0.5) * 1000,
+        'p99 ms': percentile(latencies, 0.99) * 1000,
+        'errors': results['errors'],
+        'connections': results['connects'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['production', 'baseline', 'both'], default='both')
+    parser.add_argument('--listeners', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--segments', type=int, default=60)
+    parser.add_argument('--segment-bytes', type=int, default=262144, help="About 10s of 210 kbps AAC")
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    modes = ['baseline', 'production'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        result = benchmark(mode, args)
+        print('  '.join(f'{key}={value:.1f}' if isinstance(value, float) else f'{key}={value}'
+                        for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Behaviour checks of the pipeline for cases the benchmarks don't exercise, run entirely offline.
+
+  blocking_reload  a blocked reload of a playlist file is due when the playlist creator adds the segment,
+                   after a gap in recording
+  chunk_delay      a delay that plays chunks starts from its threshold after a restart without a checkpoint,
+                   once the segments it starts on have been deleted
+  seek_playlist    a live /at/ playlist gives the wall time of its first segment
+
+Each check builds its own buffer in a temporary folder, drives the real code on a simulated clock
+and fails with an AssertionError if the behaviour is wrong.
+
+Run from the repository root:
+
+    python benchmarks/check_pipeline.py
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_origin import SimulatedClock
+
+SEGMENT_DURATION = 10.0
+
+
+def write_journal(folder: Path, segments: list, duration: float = SEGMENT_DURATION):
+    """Record (sequence, start time) segments in a journal in folder"""
+    from segment_journal import SegmentJournal
+
+    folder.mkdir(exist_ok=True)
+    journal = SegmentJournal(folder / 'segment_journal.jsonl')
+    journal.open()
+    for sequence, start_time in segments:
+        journal.append({'url': str(sequence), 'duration': duration, 'sequence': sequence,
+                        'timestamp': start_time, 'filename': f'segment_{sequence:04d}.aac'})
+    journal.close()
+
+
+def check_blocking_reload(folder: Path, clock: SimulatedClock):
+    import config
+    import playlist_creator
+    import serve_http
+    from segment_index import SegmentIndex
+
+    # Ten minutes of recording were lost, and the delay started after them
+    start_time = clock.time() - 3600
+    write_journal(folder, [(sequence, start_time + (sequence - 1000) * SEGMENT_DURATION)
+                           for sequence in range(1000, 1030)]
+                  + [(sequence, start_time + 600 + (sequence - 1000) * SEGMENT_DURATION)
+                     for sequence in range(1030, 1060)])
+    delay = 300
+    spec = config.PlaylistSpec(delay, start_time, f'playlist_{delay}.m3u8', first_segment_id=1030, is_initalised=True)
+    with mock.patch.object(playlist_creator, 'playlist_folder', str(folder)):
+        playlist_creator.save_playlist_spec([spec])
+        segment_index = SegmentIndex(folder / 'segment_journal.jsonl')
+        segment_index.refresh()
+        due = serve_http.PlaylistGenerator(str(folder)).sequence_due(delay, 1040, playlist_file=True)
+        assert due is not None, "no due time for an indexed segment"
+
+        # The playlist creator adds the segment to the file exactly then
+        for at, listed in ((due - 0.5, False), (due + 0.5, True)):
+            clock.set(at)
+            playlist_creator.populate_playlist(spec, segment_index)
+            playlist_path = folder / spec.playlist_file_name
+            playlist = playlist_path.read_text() if playlist_path.exists() else ''
+            assert ('segment_1040.aac' in playlist) == listed, \
+                f"segment_1040 {'missing from' if listed else 'already in'} the playlist {at - due:+.1f}s from its due time"
+
+
+def check_chunk_delay(folder: Path, clock: SimulatedClock):
+    import config
+    import playlist_creator
+    from coalesce import chunk_folder
+    from segment_index import SegmentIndex
+
+    # Four hours recorded, the first two coalesced into one minute chunks, and segments kept for the last 2.2 hours
+    coalesce_after, chunk_segments = 7200, 6
+    start_time = clock.time() - 4 * 3600
+    write_journal(folder, [(sequence, start_time + sequence * SEGMENT_DURATION) for sequence in range(792, 1440)])
+    write_journal(chunk_folder(folder), [(chunk, start_time + chunk * chunk_segments * SEGMENT_DURATION)
+                                         for chunk in range(0, 120)], duration=chunk_segments * SEGMENT_DURATION)
+
+    # Restarted without a checkpoint, so the delay is initialised again from the recording's start time
+    delay = 3 * 3600
+    spec = config.PlaylistSpec(delay, start_time, f'playlist_{delay}.m3u8', first_segment_id=None)
+    with mock.patch.object(config, 'coalesce_after_seconds', coalesce_after), \
+            mock.patch.object(playlist_creator, 'coalesce_after_seconds', coalesce_after), \
+            mock.patch.object(playlist_creator, 'coalesce_segments', chunk_segments), \
+            mock.patch.object(playlist_creator, 'playlist_folder', str(folder)):
+        segment_index = SegmentIndex(folder / 'segment_journal.jsonl')
+        segment_index.refresh()
+        playlist_creator.update_playlists([spec], segment_index)
+        assert spec.is_initalised, "the delay wasn't initialised from its chunks"
+        assert spec.first_segment_id == 0, f"anchored on segment {spec.first_segment_id}, not the first chunk"
+
+        # The delay is playing the chunk recorded delay + buffer ago, not waiting for its segments to come round
+        playing = int((clock.time() - delay - config.buffer_period_seconds - start_time) // (chunk_segments * SEGMENT_DURATION))
+        playlist_path = folder / spec.playlist_file_name
+        playlist = playlist_path.read_text() if playlist_path.exists() else ''
+        assert f'chunks/segment_{playing:04d}.aac' in playlist, f"chunk {playing} missing from the playlist"
+
+
+def check_seek_playlist(folder: Path, clock: SimulatedClock):
+    import serve_http
+
+    # An hour recorded, and a listener seeking back half an hour, as /at/<time>.m3u8 asks for
+    start_time = clock.time() - 3600
+    write_journal(folder, [(sequence, start_time + sequence * SEGMENT_DURATION) for sequence in range(0, 360)])
+    seek_to = datetime.fromtimestamp(clock.time() - 1800, timezone.utc).isoformat()
+    playlist = serve_http.PlaylistGenerator(str(folder)).seek_playlist(serve_http.parse_broadcast_time(seek_to))
+    assert playlist is not None, "nothing served for a buffered time"
+    assert '#EXT-X-PLAYLIST-TYPE' not in playlist and '#EXT-X-ENDLIST' not in playlist, "not a live playlist"
+
+    # Players seek by wall time, so it has to give the first segment's
+    first = int(re.search(r'segment_(\d+)\.aac', playlist).group(1))
+    expected = datetime.fromtimestamp(start_time + first * SEGMENT_DURATION, timezone.utc)
+    assert f"#EXT-X-PROGRAM-DATE-TIME:{expected.isoformat(timespec='milliseconds')}" in playlist, \
+        "the live seek playlist has no EXT-X-PROGRAM-DATE-TIME for its first segment"
+
+
+CHECKS = {
+    'blocking_reload': check_blocking_reload,
+    'chunk_delay': check_chunk_delay,
+    'seek_playlist': check_seek_playlist,
+}
+
+
+def main():
+    clock = SimulatedClock()
+    with tempfile.TemporaryDirectory() as folder:
+        # The pipeline writes its logs into the working directory
+        os.chdir(folder)
+        with mock.patch('time.time', clock.time):
+            for name, check in CHECKS.items():
+                check_folder = Path(folder) / name
+                check_folder.mkdir()
+                check(check_folder, clock)
+                print(f'{name:20}ok')
+
+
+if __name__ == '__main__':
+    main()
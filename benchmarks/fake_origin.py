@@ -0,0 +1,189 @@
+"""
+A local stand-in for the live HLS origin, so the pipeline can be exercised offline.
+
+The origin publishes one segment every segment_duration seconds of its clock, which is
+usually a SimulatedClock the benchmark advances by hand.
+"""
+import http.server
+import math
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Iterable, Optional, Sequence, Tuple
+
+
+class SimulatedClock:
+    """A wall clock that only moves when told to"""
+
+    def __init__(self, start: Optional[float] = None):
+        self.now = time.time() if start is None else start
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self.now += seconds
+
+    def set(self, now: float):
+        with self._lock:
+            self.now = now
+
+
+class FakeOrigin:
+    """
+    Serves a live media playlist at /live/v0-221.m3u8 and its segments, and a master playlist
+    at /live/master.m3u8 listing it along with any extra variants.
+
+    Args:
+        clock: Clock deciding which segments have been published
+        segment_duration: Duration of each segment, in seconds
+        window: Number of segments listed in the playlist
+        backlog: Number of segments already published when the origin starts
+        lost: Sequence numbers listed in the playlist that the origin answers with a 404 (gaps in the stream)
+        error_rate: Fraction of segment requests answered with a 503
+        segment_bytes: Size of each segment
+        can_skip_until: Advertise LL-HLS delta updates (_HLS_skip=YES) leaving out segments this many seconds
+            before the live edge, or None to only serve full playlists
+        variants: (name, bandwidth) of extra variants, served at /live/<name>.m3u8 with the same media
+            sequence numbers and segments sized in proportion to their bandwidth
+    """
+
+    def __init__(self, clock: SimulatedClock, segment_duration: float = 10.0, window: int = 6, backlog: int = 6,
+                 lost: Iterable[int] = (), error_rate: float = 0.0, segment_bytes: int = 262144,
+                 first_sequence: int = 1000, can_skip_until: Optional[float] = None,
+                 variants: Sequence[Tuple[str, int]] = ()):
+        self.clock = clock
+        self.segment_duration = segment_duration
+        self.window = window
+        self.lost = set(lost)
+        self.error_rate = error_rate
+        self.segment_bytes = segment_bytes
+        self.first_sequence = first_sequence
+        self.can_skip_until = can_skip_until
+        self.variants = dict(variants)
+        # Sequence first_sequence + backlog - 1 has just been published
+        self.start_time = clock.time() - backlog * segment_duration
+        self.requests = 0
+        self.bytes_served = 0
+        self.playlist_bytes = 0
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/live/v0-221.m3u8'
+
+    @property
+    def master_url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/live/master.m3u8'
+
+    def master_playlist(self) -> str:
+        lines = ['#EXTM3U', '#EXT-X-STREAM-INF:BANDWIDTH=221000,CODECS="mp4a.40.2"', 'v0-221.m3u8']
+        for name, bandwidth in self.variants.items():
+            lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},CODECS="mp4a.40.2"', f'{name}.m3u8']
+        return '\n'.join(lines) + '\n'
+
+    def published_time(self, sequence: int) -> float:
+        """Program date time of a segment"""
+        return self.start_time + (sequence - self.first_sequence) * self.segment_duration
+
+    def last_sequence(self) -> int:
+        """Newest segment published so far"""
+        elapsed = self.clock.time() - self.start_time
+        return self.first_sequence + int(elapsed // self.segment_duration) - 1
+
+    def playlist(self, skip: bool = False, variant: Optional[str] = None) -> str:
+        last = self.last_sequence()
+        first = max(self.first_sequence, last - self.window + 1)
+        lines = [
+            '#EXTM3U',
+            f'#EXT-X-VERSION:{9 if self.can_skip_until else 3}',
+            f'#EXT-X-TARGETDURATION:{math.ceil(self.segment_duration)}',
+            f'#EXT-X-MEDIA-SEQUENCE:{first}',
+        ]
+        listed = first
+        if self.can_skip_until:
+            lines.append(f'#EXT-X-SERVER-CONTROL:CAN-SKIP-UNTIL={self.can_skip_until:g}')
+            if skip:
+                # A delta update leaves out segments that end more than can_skip_until before the live edge
+                skipped = max(0, (last + 1 - first) - math.ceil(self.can_skip_until / self.segment_duration))
+                lines.append(f'#EXT-X-SKIP:SKIPPED-SEGMENTS={skipped}')
+                listed += skipped
+        for sequence in range(listed, last + 1):
+            program_date_time = datetime.fromtimestamp(self.published_time(sequence), timezone.utc)
+            lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{program_date_time.isoformat(timespec="milliseconds")}')
+            lines.append(f'#EXTINF:{self.segment_duration:.3f},')
+            lines.append(f'{variant}/seg_{sequence}.aac' if variant else f'seg_{sequence}.aac')
+        return '\n'.join(lines) + '\n'
+
+    def segment(self, sequence: int, variant: Optional[str] = None) -> bytes:
+        # Deterministic content, so downloads can be checked
+        size = self.segment_bytes * self.variants[variant] // 221000 if variant else self.segment_bytes
+        return bytes([sequence % 256]) * size
+
+    def start(self, port: int = 0):
+        origin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, which Nagle's algorithm would hold up behind a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                origin.requests += 1
+                path, _, query = self.path.partition('?')
+                variant = path[len('/live/'):-len('.m3u8')]
+                if path == '/live/master.m3u8':
+                    body = origin.master_playlist().encode('utf-8')
+                    content_type = 'application/vnd.apple.mpegurl'
+                    etag = f'"{zlib.crc32(body):x}"'
+                elif path == '/live/v0-221.m3u8' or (path.endswith('.m3u8') and variant in origin.variants):
+                    body = origin.playlist(skip='_HLS_skip=YES' in query,
+                                           variant=variant if variant in origin.variants else None).encode('utf-8')
+                    etag = f'"{zlib.crc32(body):x}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.end_headers()
+                        return
+                    origin.playlist_bytes += len(body)
+                    content_type = 'application/vnd.apple.mpegurl'
+                elif path.startswith('/live/') and '/seg_' in path and path.endswith('.aac'):
+                    folder, _, name = path[len('/live/'):].rpartition('/')
+                    sequence = int(name[len('seg_'):-len('.aac')])
+                    if (folder and folder not in origin.variants) or sequence > origin.last_sequence() \
+                            or sequence in origin.lost:
+                        self.send_error(404)
+                        return
+                    if random.random() < origin.error_rate:
+                        self.send_error(503)
+                        return
+                    body = origin.segment(sequence, folder or None)
+                    content_type = 'audio/aac'
+                else:
+                    self.send_error(404)
+                    return
+                origin.bytes_served += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if content_type == 'application/vnd.apple.mpegurl':
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import Optional, Tuple
+
+
+class HttpConnection:
+    """
+    Minimal asyncio HTTP/1.1 client connection for load testing.
+
+    Keeps the connection open between requests when the server allows it, and
+    reconnects transparently when the server closes it.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connects = 0
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.connects += 1
+
+    async def get(self, path: str, headers: dict = None) -> Tuple[int, dict, bytes, float]:
+        """
+        Send a GET request
+
+        Returns:
+            tuple: Status code, lower-cased response headers, body and latency in seconds
+        """
+        return await asyncio.wait_for(self._get(path, headers or {}), self.timeout)
+
+    async def _get(self, path: str, headers: dict):
+        if self.writer is None:
+            await self._connect()
+        started = time.perf_counter()
+        request = f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+        request += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        self.writer.write((request + '\r\n').encode('latin-1'))
+
+        try:
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Server closed the connection")
+        except (ConnectionResetError, BrokenPipeError):
+            # The server dropped an idle keep-alive connection, retry once on a new one
+            await self.close()
+            await self._connect()
+            started = time.perf_counter()
+            self.writer.write((request + '\r\n').encode('latin-1'))
+            status_line = await self.reader.readline()
+
+        version, status = status_line.split(b' ', 2)[:2]
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        length = int(response_headers.get('content-length', 0))
+        body = await self.reader.readexactly(length) if length else b''
+        latency = time.perf_counter() - started
+
+        connection = response_headers.get('connection', '').lower()
+        if connection == 'close' or (version == b'HTTP/1.0' and connection != 'keep-alive'):
+            await self.close()
+        return int(status), response_headers, body, latency
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.reader = self.writer = None
+
+
+def percentile(values, fraction: float) -> float:
+    """Return the value at a fraction (0-1) of the sorted values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def raise_open_file_limit():
+    """Raise the soft open file limit to the hard limit, so thousands of sockets can be opened"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
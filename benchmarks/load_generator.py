@@ -0,0 +1,189 @@
+"""
+Simulate thousands of HLS listeners against a running serve_http.
+
+Each player picks a delay, polls its delayed playlist once per target duration, fetches
+segments it hasn't seen yet and plays them back in real time, counting a rebuffer
+whenever its buffer runs dry. When the server advertises CAN-BLOCK-RELOAD, players
+instead ask for the next segment with _HLS_msn and the server holds the request until it
+is in the playlist (use --poll to keep polling). For example, against a local server:
+
+    python serve_http.py --quiet &
+    python benchmarks/load_generator.py --players 5000 --seconds 120
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from http_client import HttpConnection, percentile, raise_open_file_limit
+
+
+class PlaylistEntry(NamedTuple):
+    sequence: int
+    duration: float
+    uri: str
+    byte_range: Optional[Tuple[int, int]]
+
+
+def parse_playlist(text: str) -> Tuple[float, List[PlaylistEntry]]:
+    """Parse the target duration and segments out of a media playlist"""
+    target_duration = 10.0
+    sequence = 0
+    duration = 0.0
+    byte_range = None
+    entries = []
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',')[0])
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line.split(':', 1)[1].partition('@')
+            byte_range = (int(offset or 0), int(length))
+        elif line and not line.startswith('#'):
+            entries.append(PlaylistEntry(sequence, duration, line, byte_range))
+            sequence += 1
+            byte_range = None
+    return target_duration, entries
+
+
+class Stats:
+    def __init__(self):
+        self.playlist_latencies = []
+        self.segment_latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.rebuffers = 0
+        self.stalled_seconds = 0.0
+        self.played_seconds = 0.0
+        self.players_started = 0
+        self.blocking_reloads = 0
+
+
+async def player(host: str, port: int, path: str, stop_at: float, stats: Stats, start_segments: int = 3,
+                 blocking: bool = True):
+    # Long enough for a blocking reload, which the server holds for up to three target durations
+    connection = HttpConnection(host, port, timeout=45.0)
+    next_sequence = None
+    can_block_reload = False
+    buffered = 0.0
+    playing = False
+    last_update = time.perf_counter()
+    stats.players_started += 1
+    try:
+        while time.perf_counter() < stop_at:
+            target_duration = 10.0
+            reload_blocks = False
+            try:
+                if blocking and can_block_reload and next_sequence is not None:
+                    status, _, body, latency = await connection.get(
+                        f"{path}{'&' if '?' in path else '?'}_HLS_msn={next_sequence}")
+                    # Held until the segment is due, so the latency isn't comparable with a plain reload
+                    stats.blocking_reloads += 1
+                else:
+                    status, _, body, latency = await connection.get(path)
+                    stats.playlist_latencies.append(latency)
+                if status != 200:
+                    stats.errors += 1
+                else:
+                    text = body.decode('utf-8')
+                    can_block_reload = 'CAN-BLOCK-RELOAD=YES' in text
+                    reload_blocks = blocking and can_block_reload
+                    target_duration, entries = parse_playlist(text)
+                    if next_sequence is None and entries:
+                        # Like most players, join a few segments back from the live edge
+                        next_sequence = entries[max(len(entries) - start_segments, 0)].sequence
+                    for entry in entries:
+                        if entry.sequence < next_sequence:
+                            continue
+                        headers = {}
+                        if entry.byte_range:
+                            offset, length = entry.byte_range
+                            headers['Range'] = f'bytes={offset}-{offset + length - 1}'
+                        uri = entry.uri if entry.uri.startswith('/') else path.rsplit('/', 1)[0] + '/' + entry.uri
+                        status, _, segment, latency = await connection.get(uri, headers)
+                        stats.segment_latencies.append(latency)
+                        if status not in (200, 206):
+                            stats.errors += 1
+                            reload_blocks = False
+                            break
+                        stats.bytes += len(segment)
+                        buffered += entry.duration
+                        next_sequence = entry.sequence + 1
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                stats.errors += 1
+                reload_blocks = False
+                await connection.close()
+
+            # Play back what has been buffered until the next reload, which waits on the server if it blocks
+            if not reload_blocks:
+                await asyncio.sleep(max(min(target_duration, stop_at - time.perf_counter()), 0))
+            now = time.perf_counter()
+            elapsed, last_update = now - last_update, now
+            if playing:
+                played = min(elapsed, buffered)
+                stats.played_seconds += played
+                buffered -= played
+                if played < elapsed:
+                    stats.rebuffers += 1
+                    stats.stalled_seconds += elapsed - played
+                    playing = False
+            elif buffered >= target_duration:
+                playing = True
+    finally:
+        await connection.close()
+
+
+async def run(args) -> Tuple[Stats, float]:
+    stats = Stats()
+    stop_at = time.perf_counter() + args.seconds
+    players = []
+    for _ in range(args.players):
+        delay = random.choice(args.delays)
+        path = f'/playlist.m3u8?delay={delay}' if args.on_demand else f'/playlist_{delay}.m3u8'
+        players.append(asyncio.create_task(player(args.host, args.port, path, stop_at, stats, blocking=not args.poll)))
+        # Ramp up gradually rather than all players connecting in the same instant
+        await asyncio.sleep(args.ramp / args.players)
+    started = time.perf_counter()
+    await asyncio.gather(*players)
+    return stats, time.perf_counter() - started + args.ramp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--ramp', type=float, default=10, help="Seconds over which players join")
+    parser.add_argument('--delays', type=int, nargs='+', help="Delays to pick from, defaults to config.delays_seconds")
+    parser.add_argument('--on-demand', action='store_true', help="Request /playlist.m3u8?delay= instead of playlist files")
+    parser.add_argument('--poll', action='store_true', help="Poll once per target duration, even if the server blocks reloads")
+    args = parser.parse_args()
+    if not args.delays:
+        from config import delays_seconds
+        args.delays = delays_seconds
+
+    raise_open_file_limit()
+    stats, elapsed = asyncio.run(run(args))
+    requests = len(stats.playlist_latencies) + len(stats.segment_latencies)
+    listening = stats.played_seconds + stats.stalled_seconds
+    print(f"players={stats.players_started}  elapsed s={elapsed:.1f}  requests/s={requests / elapsed:.1f}  "
+          f"MB/s={stats.bytes / elapsed / 1e6:.2f}  errors={stats.errors}  blocking reloads={stats.blocking_reloads}")
+    print(f"playlist p50 ms={percentile(stats.playlist_latencies, 0.5) * 1000:.1f}  "
+          f"p99 ms={percentile(stats.playlist_latencies, 0.99) * 1000:.1f}")
+    print(f"segment p50 ms={percentile(stats.segment_latencies, 0.5) * 1000:.1f}  "
+          f"p99 ms={percentile(stats.segment_latencies, 0.99) * 1000:.1f}")
+    print(f"rebuffers={stats.rebuffers}  rebuffers/player-hour={stats.rebuffers / max(listening, 1) * 3600:.2f}  "
+          f"stalled={stats.stalled_seconds / max(listening, 1) * 100:.2f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from segment_index import SegmentIndex
+
+# A checkpoint is a header, the segment index columns packed little-endian, its table of
+# filenames that don't follow the per-segment naming, the per-delay cursors and a CRC32
+# of everything before it. It is only ever an accelerator: a missing, stale or damaged
+# checkpoint just means replaying the journal.
+MAGIC = b'JDCK'
+VERSION = 2
+# magic, version, journal st_dev, journal st_ino, journal offset, segments, cursors, filename table bytes
+_HEADER = struct.Struct('<4sHQQQIII')
+# delay, playlist start time, first segment (-1 for none), initialised
+_CURSOR = struct.Struct('<qdq?')
+# (typecode, SegmentIndex column) in file order, byte ranges are -1 and filename ids -1 where not set
+_COLUMNS = (('q', 'sequences'), ('d', 'timestamps'), ('d', 'durations'), ('d', 'start_offsets'),
+            ('d', 'end_offsets'), ('q', 'byte_offsets'), ('q', 'byte_lengths'), ('i', 'filename_ids'),
+            ('i', 'variant_masks'))
+
+
+class PlaylistCursor(NamedTuple):
+    """Where a delayed playlist is up to on the timeline"""
+    delay_seconds: int
+    playlist_start_time: float
+    first_segment_id: Optional[int]
+    is_initalised: bool
+
+
+def _pack(column: array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _unpack(typecode: str, data: memoryview, offset: int, count: int):
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, end
+
+
+def save_checkpoint(path: Path, segment_index: SegmentIndex, cursors: List[PlaylistCursor]):
+    """Atomically write the segment index and playlist cursors to path"""
+    count = len(segment_index)
+    table_bytes = '\n'.join(segment_index.filename_table).encode('utf-8')
+    file_id, offset = segment_index.journal_position()
+    st_dev, st_ino = file_id or (0, 0)
+
+    parts = [_HEADER.pack(MAGIC, VERSION, st_dev, st_ino, offset, count, len(cursors), len(table_bytes))]
+    parts.extend(_pack(getattr(segment_index, name)) for _, name in _COLUMNS)
+    parts.append(table_bytes)
+    for cursor in cursors:
+        first_segment_id = -1 if cursor.first_segment_id is None else cursor.first_segment_id
+        parts.append(_CURSOR.pack(cursor.delay_seconds, cursor.playlist_start_time, first_segment_id,
+                                  cursor.is_initalised))
+    data = b''.join(parts)
+
+    temp_file = path.with_suffix(path.suffix + '.tmp')
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+            f.write(struct.pack('<I', zlib.crc32(data)))
+        temp_file.replace(path)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+
+
+def load_checkpoint(path: Path, segment_index: SegmentIndex) -> Optional[List[PlaylistCursor]]:
+    """
+    Restore the segment index and playlist cursors from a checkpoint
+
+    The index resumes tailing the journal from where the checkpoint left off, so only
+    segments committed since it was written are read from the journal.
+
+    Returns:
+        list: The playlist cursors, or None (with the index left empty) if there is no usable checkpoint
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+    except FileNotFoundError:
+        return None
+
+    try:
+        if len(data) < _HEADER.size + 4 or struct.unpack('<I', data[-4:])[0] != zlib.crc32(data[:-4]):
+            raise ValueError("checksum mismatch")
+        magic, version, st_dev, st_ino, journal_offset, count, cursor_count, table_size = \
+            _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"unsupported checkpoint version {version}")
+
+        offset = _HEADER.size
+        columns = {}
+        for typecode, name in _COLUMNS:
+            columns[name], offset = _unpack(typecode, data, offset, count)
+        table = bytes(data[offset:offset + table_size]).decode('utf-8').split('\n') if table_size else []
+        offset += table_size
+        cursors = []
+        for _ in range(cursor_count):
+            delay_seconds, playlist_start_time, first_segment_id, is_initalised = _CURSOR.unpack_from(data, offset)
+            offset += _CURSOR.size
+            cursors.append(PlaylistCursor(delay_seconds, playlist_start_time,
+                                          None if first_segment_id < 0 else first_segment_id, is_initalised))
+        if offset != len(data) - 4:
+            raise ValueError("unexpected length")
+        if max(columns['filename_ids'], default=-1) >= len(table):
+            raise ValueError("unknown filename id")
+    except (struct.error, ValueError, IndexError) as e:
+        logging.warning(f"Ignoring unusable checkpoint {path}: {str(e)}")
+        return None
+
+    for _, name in _COLUMNS:
+        setattr(segment_index, name, columns[name])
+    segment_index.load_filename_table(table)
+    segment_index.resume((st_dev, st_ino) if st_ino else None, journal_offset)
+    logging.info(f"Restored {count} segments and {cursor_count} playlist cursors from {path}")
+    return cursors
+
+
+# Anchors read from each station's playlist_spec.json, by path, with the file's (inode, mtime, size) when read
+_anchors: Dict[str, Tuple[tuple, Dict[int, int]]] = {}
+
+
+def load_playlist_anchors(folder: str) -> Dict[int, int]:
+    """
+    The segment each of the playlist creator's initialised delays is anchored on, by delay, from the
+    playlist_spec.json it saves in the station's folder. The file is only re-read when it changes.
+    """
+    path = os.path.join(folder, 'playlist_spec.json')
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    loaded = _anchors.get(path)
+    if loaded and loaded[0] == stat_key:
+        return loaded[1]
+    try:
+        with open(path, 'r') as f:
+            anchors = {spec['delay_seconds']: spec['first_segment_id'] for spec in json.load(f)
+                       if spec['is_initalised']}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error(f"Error loading playlist anchors: {str(e)}")
+        return loaded[1] if loaded else {}
+    _anchors[path] = (stat_key, anchors)
+    return anchors
+
+
+def playlist_anchor(folder: str, delay_seconds: int, segment_index: SegmentIndex,
+                    segments_per_entry: int = 1) -> Optional[int]:
+    """
+    The segment the playlist creator builds a delay's playlist file from, on the index's timeline
+
+    That is the delay's saved anchor, or once retention has deleted it the oldest segment still
+    kept, which the playlist creator re-anchors on.
+
+    Args:
+        segments_per_entry: For an index of coalesced chunks, the segments in each chunk, to
+            find the chunk holding the anchor segment
+
+    Returns:
+        int: The anchor, or None if the delay hasn't started or its anchor isn't indexed yet
+    """
+    anchor = load_playlist_anchors(folder).get(delay_seconds)
+    if anchor is None or len(segment_index) == 0:
+        return None
+    anchor //= segments_per_entry
+    if anchor > segment_index.sequences[-1]:
+        return None
+    if segment_index.position(anchor) is None:
+        return segment_index.sequences[0]
+    return anchor
@@ -0,0 +1,154 @@
+import bisect
+import logging
+import os
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from segment_journal import SegmentJournal
+from segment_store import SegmentStore, segment_filename
+from retention import RetentionManager
+
+# Chunks are kept in this subfolder of the station's folder, with a journal of their own
+CHUNK_FOLDER = 'chunks'
+
+
+def chunk_folder(folder: str) -> Path:
+    return Path(folder) / CHUNK_FOLDER
+
+
+def strip_id3(data: bytes) -> bytes:
+    """Drop the ID3v2 tag packed audio segments start with (RFC 8216 3.4), leaving just ADTS frames"""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return data
+    # The size is syncsafe, 7 bits per byte, and excludes the header and any footer
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return data[10 + size + (10 if data[5] & 0x10 else 0):]
+
+
+class Coalescer:
+    """
+    Merges old segments into longer chunks, so long delays need fewer requests and files.
+
+    Chunk k holds segments k * chunk_segments up to (k + 1) * chunk_segments - 1, concatenated.
+    ADTS frames are self-delimiting, so only the ID3 tag of every segment but the first has
+    to go. Chunk numbers are consecutive, so they serve as the media sequence numbers of
+    chunked playlists, and which segments belong to a chunk never needs recording. Chunks are
+    stored as segment_<k>.aac in the chunks subfolder (with copies for each extra variant that
+    has every segment of the chunk), and recorded in a journal of their own there, so the
+    segment index, retention and playlist rendering all work on chunks unchanged.
+    """
+
+    def __init__(self, output_dir: Path, journal: SegmentJournal, coalesce_after: float, chunk_segments: int = 6,
+                 retention_seconds: Optional[float] = None, variant_folders: Optional[List[str]] = None,
+                 interval: float = 60.0, max_chunks: int = 60):
+        self.output_dir = Path(output_dir)
+        self.journal = journal
+        self.coalesce_after = coalesce_after
+        self.chunk_segments = chunk_segments
+        self.variant_folders = variant_folders if variant_folders is not None else []
+        self.interval = interval
+        # Catching up on a deep buffer is spread over several passes, so ingest isn't held up
+        self.max_chunks = max_chunks
+        self._next_run = 0.0
+
+        self.chunk_dir = chunk_folder(self.output_dir)
+        self.chunk_dir.mkdir(exist_ok=True)
+        self.chunk_journal = SegmentJournal(self.chunk_dir / 'segment_journal.jsonl')
+        self.chunks = self.chunk_journal.open()
+        self.retention = None
+        if retention_seconds:
+            self.retention = RetentionManager(self.chunk_dir, self.chunk_journal, retention_seconds,
+                                              variant_folders=self.variant_folders)
+
+    def run_if_due(self, now: float = None):
+        """Coalesce, and apply retention to the chunks, when the interval has elapsed"""
+        now = time.time() if now is None else now
+        if now < self._next_run:
+            return
+        self._next_run = now + self.interval
+        self.coalesce(now)
+        if self.retention:
+            self.retention.run_if_due(now)
+
+    def coalesce(self, now: float = None) -> int:
+        """
+        Merge every complete group of segments that is older than coalesce_after
+
+        Returns:
+            int: Number of chunks written
+        """
+        cutoff = (time.time() if now is None else now) - self.coalesce_after
+        segments = self.journal.segments
+        if len(segments) == 0:
+            return 0
+        chunk = self.chunks.sequences[-1] + 1 if len(self.chunks) else segments.sequences[0] // self.chunk_segments
+        written = 0
+        while written < self.max_chunks:
+            first = bisect.bisect_left(segments.sequences, chunk * self.chunk_segments)
+            end = bisect.bisect_left(segments.sequences, (chunk + 1) * self.chunk_segments)
+            # A group is complete once a later segment has arrived, and due once its last segment has aged
+            if end >= len(segments):
+                break
+            if first < end:
+                if segments.timestamps[end - 1] + segments.durations[end - 1] > cutoff:
+                    break
+                try:
+                    self.write_chunk(chunk, segments, first, end)
+                    written += 1
+                except OSError as e:
+                    logging.error(f"Error coalescing chunk {chunk}: {str(e)}")
+            chunk += 1
+        if written:
+            self.chunk_journal.sync()
+            logging.info(f"Coalesced {written} chunks of {self.chunk_segments} segments in {self.output_dir}")
+        return written
+
+    def read_segment(self, segments: SegmentStore, i: int) -> bytes:
+        byte_offset, byte_length = segments.byte_range(i)
+        with open(self.output_dir / segments.filename(i), 'rb') as f:
+            if byte_length is None:
+                return f.read()
+            return os.pread(f.fileno(), byte_length, byte_offset)
+
+    def write_chunk(self, chunk: int, segments: SegmentStore, first: int, end: int):
+        """Concatenate segments first to end - 1 into chunk, and record it in the chunk journal"""
+        self.write_file(self.chunk_dir / segment_filename(chunk),
+                        [self.read_segment(segments, i) for i in range(first, end)])
+
+        # A variant's chunk is only made if it has every segment of the chunk
+        variant_mask = -1
+        for i in range(first, end):
+            variant_mask &= segments.variant_masks[i]
+        for bit, folder in enumerate(self.variant_folders):
+            if variant_mask & (1 << bit):
+                (self.chunk_dir / folder).mkdir(exist_ok=True)
+                parts = []
+                for i in range(first, end):
+                    with open(self.output_dir / folder / segment_filename(segments.sequences[i]), 'rb') as f:
+                        parts.append(f.read())
+                self.write_file(self.chunk_dir / folder / segment_filename(chunk), parts)
+
+        self.chunk_journal.append({
+            'url': '',
+            'duration': sum(segments.durations[first:end]),
+            'timestamp': segments.timestamps[first],
+            'sequence': chunk,
+            'filename': segment_filename(chunk),
+            'variant_mask': max(variant_mask, 0),
+        })
+
+    def write_file(self, path: Path, parts: List[bytes]):
+        temp_file = path.with_suffix('.aac.tmp')
+        try:
+            with open(temp_file, 'wb') as f:
+                f.write(parts[0])
+                for data in parts[1:]:
+                    f.write(strip_id3(data))
+            temp_file.replace(path)
+        finally:
+            if temp_file.exists():
+                temp_file.unlink()
+
+    def close(self):
+        self.chunk_journal.close()
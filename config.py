@@ -0,0 +1,263 @@
+# Settings shared by every JDelay process. Importing this module has no side effects beyond reading the settings
+# file, so the child processes start without importing main.
+#
+# The values below are the defaults. Any of them can be overridden in a JSON settings file, named by the
+# JDELAY_CONFIG environment variable (jdelay.json in the working directory by default), eg.
+#   {"delays_seconds": [120, 300, 3600, 7200], "buffer_period_seconds": 90}
+# The running processes check the file for changes every reload_check_seconds. Delays, buffer parameters, the
+# source timezone and each station's origin URL apply live: read them as config.<name> rather than importing the
+# value, and compare config.generation to notice a change. The rest (folders, storage, coalescing, ports and the
+# list of stations) are only read at start up, so changing them needs a restart.
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+from typing import Optional
+
+config_file = os.environ.get('JDELAY_CONFIG', 'jdelay.json')
+reload_check_seconds = 1.0
+
+
+@dataclass
+class Station:
+    name: str
+    url: str
+    folder: str
+    # The origin's master playlist, to also record every other variant it lists (eg. a low bitrate for
+    # mobile listeners) and write a master_<delay>.m3u8 for each delay. None records only url.
+    variants_url: Optional[str] = None
+
+
+@dataclass
+class PlaylistSpec:
+    delay_seconds: int
+    playlist_start_time: float
+    playlist_file_name: str
+    first_segment_id: int
+    is_initalised: bool = False
+    is_running: bool = False
+
+
+playlist_folder = './output/'
+
+delays_seconds = [60*x for x in ([2,5,10, 30] + list(range(60, 24*60, 60)))]
+buffer_period_seconds = 1 * 60 # 1 minute
+hls_length = 1.0 * 60 # 1.0 minutes
+source_timezone = 'Australia/Sydney' # Timezone of the station being delayed
+retention_margin_seconds = 10 * 60 # 10 minutes
+# Segments older than coalesce_after_seconds are merged into chunks of coalesce_segments segments (60 seconds of
+# 10 second segments), which delays at least coalesce_margin_seconds longer play instead, cutting their requests and
+# files by as much. None turns coalescing off.
+coalesce_after_seconds = None # eg. 2 * 60 * 60
+coalesce_segments = 6
+coalesce_margin_seconds = 5 * 60 # 5 minutes, for the newest chunk to fill and be written
+segment_storage = 'files' # 'files' for one file per segment, 'archive' for hourly archive files
+# Local ports the child processes serve Prometheus metrics on, serve_http.py serves them at /metrics
+segment_downloader_metrics_port = 9101
+playlist_creator_metrics_port = 9102
+# 'processes' runs the downloader and playlist creator as supervised subprocesses (serve_http.py runs separately),
+# 'unified' runs ingest, playlist generation and serving as supervised tasks in this process
+runtime_mode = 'processes'
+
+# Stations to time-shift. Each records into its own folder, with its own journal and playlists, and they are all
+# downloaded by one process. The first station's folder is also what serve_http.py serves on-demand playlists for.
+stations = [
+    Station('triplejnsw', 'https://mediaserviceslive.akamaized.net/hls/live/2109456/triplejnsw/v0-221.m3u8', playlist_folder),
+    # Station('doublej', '<master playlist url>', os.path.join(playlist_folder, 'doublej')),
+]
+
+# Settings the file can override, and the ones of those that apply without a restart
+SETTINGS = ('playlist_folder', 'delays_seconds', 'buffer_period_seconds', 'hls_length', 'source_timezone',
+            'retention_margin_seconds', 'coalesce_after_seconds', 'coalesce_segments', 'coalesce_margin_seconds',
+            'segment_storage', 'segment_downloader_metrics_port', 'playlist_creator_metrics_port', 'runtime_mode',
+            'stations')
+LIVE_SETTINGS = ('delays_seconds', 'buffer_period_seconds', 'hls_length', 'source_timezone',
+                 'retention_margin_seconds', 'stations')
+DEFAULTS = {name: globals()[name] for name in SETTINGS}
+
+# Derived from the settings above, and recomputed whenever they change
+retention_seconds = 0.0
+coalesced_retention_seconds = None
+
+# Bumped every time settings are applied, so long-running loops can tell they have to reconfigure
+generation = 0
+_mtime_ns = None
+_next_check = 0.0
+_lock = threading.Lock()
+
+
+def derive_settings():
+    global retention_seconds, coalesced_retention_seconds
+    # Keep enough audio for the longest delay, everything older is deleted
+    retention_seconds = max(delays_seconds, default=0) + buffer_period_seconds + retention_margin_seconds
+    # Coalesced segments are then only kept for the shorter delays, the chunks are kept for retention_seconds
+    coalesced_retention_seconds = (coalesce_after_seconds + coalesce_margin_seconds + buffer_period_seconds + hls_length
+                                   + retention_margin_seconds) if coalesce_after_seconds is not None else None
+
+
+def plays_chunks(delay_seconds: int) -> bool:
+    """Whether a delay is long enough that its window is always coalesced, so it plays chunks rather than segments"""
+    return coalesce_after_seconds is not None and delay_seconds >= coalesce_after_seconds + coalesce_margin_seconds
+
+
+def parse_settings(overrides: dict) -> dict:
+    """
+    Every setting, from the defaults and a settings file's overrides
+
+    Raises:
+        ValueError: If the file names an unknown setting, or gives one a value of the wrong type
+    """
+    unknown = set(overrides) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings {', '.join(sorted(unknown))}")
+    settings = dict(DEFAULTS, **overrides)
+    # The default station records into playlist_folder, wherever the file moves it
+    if 'playlist_folder' in overrides and 'stations' not in overrides:
+        settings['stations'] = [replace(station, folder=overrides['playlist_folder'])
+                                if station.folder == DEFAULTS['playlist_folder'] else station
+                                for station in DEFAULTS['stations']]
+    for name, value in overrides.items():
+        default = DEFAULTS[name]
+        if name == 'stations':
+            if not isinstance(value, list) or not value:
+                raise ValueError("stations must be a list of at least one station")
+            station_fields = {field.name for field in fields(Station)}
+            try:
+                settings[name] = [Station(**{key: station[key] for key in station if key in station_fields})
+                                  for station in value]
+            except TypeError as e:
+                raise ValueError(f"Invalid station: {str(e)}")
+        elif name == 'delays_seconds':
+            if not isinstance(value, list) or not all(isinstance(delay, int) and delay >= 0 for delay in value):
+                raise ValueError("delays_seconds must be a list of whole seconds")
+            settings[name] = sorted(set(value))
+        elif isinstance(default, (int, float)) or name == 'coalesce_after_seconds':
+            if value is None and name == 'coalesce_after_seconds':
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"{name} must be a number of seconds (or a port) at least 0")
+        elif not isinstance(value, type(default)):
+            raise ValueError(f"{name} must be a {type(default).__name__}")
+    return settings
+
+
+def read_settings(path: str = None) -> Optional[dict]:
+    """The overrides in the settings file, or None if there isn't one"""
+    try:
+        with open(path or config_file, 'r') as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not isinstance(overrides, dict):
+        raise ValueError("The settings file must hold a JSON object")
+    return overrides
+
+
+def load(path: str = None):
+    """
+    Apply the settings file, if there is one, on top of the defaults. Called on import.
+
+    Raises:
+        ValueError: If the file can't be parsed, so a broken file stops the processes starting rather than
+        running them on the defaults
+    """
+    global config_file, generation, _mtime_ns
+    config_file = path or config_file
+    try:
+        _mtime_ns = os.stat(config_file).st_mtime_ns
+    except FileNotFoundError:
+        _mtime_ns = None
+    overrides = read_settings(config_file)
+    globals().update(parse_settings(overrides or {}))
+    derive_settings()
+    generation += 1
+
+
+def reload_if_changed(now: float = None) -> bool:
+    """
+    Apply the settings file if it has changed since it was last read, checking at most every reload_check_seconds
+
+    Settings that only apply at start up keep their current values, with a warning. A file that
+    can't be parsed is logged and ignored, leaving every setting as it was.
+
+    Returns:
+        bool: Whether any setting changed
+    """
+    global generation, _mtime_ns, _next_check
+    now = time.monotonic() if now is None else now
+    if now < _next_check:
+        return False
+    with _lock:
+        if now < _next_check:
+            return False
+        _next_check = now + reload_check_seconds
+        try:
+            mtime_ns = os.stat(config_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if mtime_ns == _mtime_ns:
+            return False
+        _mtime_ns = mtime_ns
+        try:
+            settings = parse_settings(read_settings(config_file) or {})
+        except (OSError, ValueError) as e:
+            logging.error(f"Ignoring {config_file}, keeping the current settings: {str(e)}")
+            return False
+
+        changed = {}
+        for name, value in settings.items():
+            current = globals()[name]
+            if value == current:
+                continue
+            if name == 'stations' and [(station.name, station.folder, station.variants_url) for station in value] \
+                    == [(station.name, station.folder, station.variants_url) for station in current]:
+                # Only origin URLs have changed, which the downloader can follow live
+                changed[name] = value
+            elif name in LIVE_SETTINGS and name != 'stations':
+                changed[name] = value
+            else:
+                logging.warning(f"{name} changed in {config_file}, restart to apply it")
+        if not changed:
+            return False
+        globals().update(changed)
+        derive_settings()
+        generation += 1
+        logging.info(f"Applied {', '.join(f'{name} = {value}' for name, value in changed.items())} from {config_file}")
+        return True
+
+
+def station_url(name: str) -> Optional[str]:
+    """The configured origin URL of a station, or None if it isn't configured"""
+    for station in stations:
+        if station.name == name:
+            return station.url
+    return None
+
+
+def playlist_specs(delays, start_time: float):
+    """A fresh playlist spec for each delay, from when recording started"""
+    return [PlaylistSpec(delay, start_time, f'playlist_{delay}.m3u8', first_segment_id=None, is_initalised=False)
+            for delay in delays]
+
+
+def load_start_time(folder: str = None) -> float:
+    """When recording started, kept across restarts so delays don't wait for the buffer to fill again"""
+    start_time_file = Path(folder or playlist_folder) / 'start_time.json'
+    try:
+        with open(start_time_file, 'r') as f:
+            return json.load(f)['start_time']
+    except (OSError, ValueError, KeyError):
+        start_time = time.time()
+        start_time_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = start_time_file.with_suffix('.json.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump({'start_time': start_time}, f)
+        temp_file.replace(start_time_file)
+        return start_time
+
+
+load()
@@ -0,0 +1,443 @@
+"""
+Publishes the delayed playlists and their segments to a bucket a CDN serves from, or to another folder.
+
+A manifest in each station's folder records the segments already published, so every
+segment is uploaded exactly once, even across restarts. Each round, only playlist files
+whose size or modification time has moved are read, and only those whose contents have
+changed are uploaded, together in one concurrent batch. Segments are read from the
+journal rather than by listing the folder, and are deleted from the target once they
+are past retention. With coalescing on, chunks are published from their own journal too,
+and coalesced segments are deleted from the target as soon as they are from the folder.
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import config
+from config import (playlist_folder, delays_seconds, retention_seconds, segment_storage, stations, Station,
+                    coalesce_after_seconds, coalesced_retention_seconds)
+from coalesce import CHUNK_FOLDER, chunk_folder
+from segment_index import SegmentIndex
+from segment_store import segment_filename
+from variants import StationVariants, load_variants
+from serve_http import SEGMENT_CACHE_CONTROL, PLAYLIST_CACHE_CONTROL
+from metrics import registry, start_metrics_server
+
+logging.basicConfig(
+    filename='export.log',
+    filemode='a',
+    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.DEBUG
+)
+
+SEGMENT_CONTENT_TYPE = 'audio/aac'
+PLAYLIST_CONTENT_TYPE = 'application/vnd.apple.mpegurl'
+
+export_uploads = registry.counter('jdelay_export_uploads_total', "Objects uploaded to the export target, by kind",
+                                  ['station', 'kind'])
+export_upload_bytes = registry.counter('jdelay_export_upload_bytes_total', "Bytes uploaded to the export target, by kind",
+                                       ['station', 'kind'])
+export_upload_failures = registry.counter('jdelay_export_upload_failures_total',
+                                          "Uploads that failed and will be retried next round", ['station', 'kind'])
+export_upload_seconds = registry.histogram('jdelay_export_upload_seconds', "Time to upload one object", ['kind'])
+export_deletes = registry.counter('jdelay_export_deletes_total', "Segments deleted from the export target past retention",
+                                  ['station'])
+export_published_segments = registry.gauge('jdelay_export_published_segments', "Segments currently published",
+                                            ['station'])
+
+
+class DirectoryTarget:
+    """Publishes into a local folder, eg. one served by a web server or synced elsewhere. Cache headers are dropped"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return str(self.root.resolve())
+
+    def put(self, key: str, body: bytes, content_type: str, cache_control: str):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = path.with_name(path.name + '.tmp')
+        with open(temp_file, 'wb') as f:
+            f.write(body)
+        temp_file.replace(path)
+
+    def delete(self, keys: List[str]) -> List[str]:
+        """
+        Delete objects
+
+        Returns:
+            list: Keys that could not be deleted
+        """
+        failed = []
+        for key in keys:
+            try:
+                os.unlink(self.root / key)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Error deleting {key}: {str(e)}")
+                failed.append(key)
+        return failed
+
+    def close(self):
+        pass
+
+
+class S3Target:
+    """
+    Publishes to an S3 bucket, or any S3-compatible store (eg. a local MinIO) given its endpoint_url.
+
+    The boto3 client is shared by every upload thread, with a connection pool as large as the
+    number of threads, so uploads reuse connections instead of reconnecting for each object.
+    """
+    # The most keys DeleteObjects accepts in one request
+    max_delete_batch = 1000
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None, max_connections: int = 16):
+        # Only needed for this target
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.endpoint_url = endpoint_url
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   config=Config(max_pool_connections=max_connections,
+                                                 retries={'max_attempts': 5, 'mode': 'standard'}))
+
+    def __str__(self):
+        return f's3://{self.bucket}/{self.prefix}' + (f' at {self.endpoint_url}' if self.endpoint_url else '')
+
+    def put(self, key: str, body: bytes, content_type: str, cache_control: str):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=body,
+                               ContentType=content_type, CacheControl=cache_control)
+
+    def delete(self, keys: List[str]) -> List[str]:
+        """
+        Delete objects, in as few requests as possible
+
+        Returns:
+            list: Keys that could not be deleted
+        """
+        failed = []
+        for start in range(0, len(keys), self.max_delete_batch):
+            batch = keys[start:start + self.max_delete_batch]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': self.prefix + key} for key in batch], 'Quiet': True})
+            except Exception as e:
+                logging.error(f"Error deleting {len(batch)} objects: {str(e)}")
+                failed.extend(batch)
+                continue
+            for error in response.get('Errors', []):
+                logging.error(f"Error deleting {error['Key']}: {error.get('Message')}")
+                failed.append(error['Key'][len(self.prefix):])
+        return failed
+
+    def close(self):
+        self.client.close()
+
+
+def open_target(target: str, endpoint_url: Optional[str] = None, max_connections: int = 16):
+    """An S3Target for s3://bucket/prefix, otherwise a DirectoryTarget for a folder"""
+    if target.startswith('s3://'):
+        bucket, _, prefix = target[len('s3://'):].partition('/')
+        return S3Target(bucket, prefix, endpoint_url, max_connections)
+    return DirectoryTarget(target)
+
+
+def station_prefix(station: Station) -> str:
+    """Where a station's objects go in the target, mirroring the URLs serve_http.py serves them at"""
+    relative = os.path.relpath(station.folder, playlist_folder)
+    if relative == '.':
+        return ''
+    if relative.startswith('..'):
+        return f'{station.name}/'
+    return relative.replace(os.sep, '/') + '/'
+
+
+class ExportManifest:
+    """
+    The segments published to a target, with their wall time, kept in a JSON file.
+
+    The manifest is only rewritten when segments are published or deleted. If the target
+    changes, everything is published again.
+    """
+
+    def __init__(self, path: Path, target: str):
+        self.path = Path(path)
+        self.target = target
+        self.segments: Dict[str, float] = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['target'] == self.target:
+                self.segments = manifest['segments']
+            else:
+                logging.info(f"{self.path} was for {manifest['target']}, publishing everything to {self.target}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Error loading export manifest: {str(e)}")
+
+    def save(self):
+        temp_file = self.path.with_suffix('.json.tmp')
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({'target': self.target, 'segments': self.segments}, f)
+            temp_file.replace(self.path)
+        except OSError as e:
+            logging.error(f"Error saving export manifest: {str(e)}")
+
+
+class StationExporter:
+    """Publishes one station's delayed playlists and segments"""
+
+    def __init__(self, station: Station, target, executor: ThreadPoolExecutor, delays: List[int] = delays_seconds,
+                 retention: float = retention_seconds, collect_interval: float = 60.0,
+                 segment_retention: Optional[float] = coalesced_retention_seconds,
+                 coalesce: bool = coalesce_after_seconds is not None):
+        self.station = station
+        self.folder = Path(station.folder)
+        self.target = target
+        self.executor = executor
+        self.prefix = station_prefix(station)
+        self.retention = retention
+        # Coalesced segments are only kept as long as the delays short of the chunks need them
+        self.segment_retention = segment_retention or retention
+        self.collect_interval = collect_interval
+        self._next_collect = 0.0
+        self.segment_index = SegmentIndex(self.folder / 'segment_journal.jsonl')
+        # Journals to publish from, by the folder their files are in ('' for the station's own)
+        self.indexes = {'': self.segment_index}
+        if coalesce:
+            self.indexes[f'{CHUNK_FOLDER}/'] = SegmentIndex(chunk_folder(self.folder) / 'segment_journal.jsonl')
+        self.manifest = ExportManifest(self.folder / 'export_manifest.json', str(target))
+        self.manifest.load()
+        # Segments before this sequence number have all been published (or have gone), by folder
+        self.scan_from = {folder: -1 for folder in self.indexes}
+        self.delays = delays
+        # (st_ino, st_mtime_ns, st_size) of each playlist file as last read, and a CRC32 of what was last published
+        self.playlist_stats: Dict[str, Tuple[int, int, int]] = {}
+        self.published_playlists: Dict[str, int] = {}
+
+    def upload(self, kind: str, key: str, body: bytes, content_type: str, cache_control: str) -> int:
+        started = time.perf_counter()
+        self.target.put(self.prefix + key, body, content_type, cache_control)
+        export_upload_seconds.observe(time.perf_counter() - started, kind=kind)
+        export_uploads.inc(station=self.station.name, kind=kind)
+        export_upload_bytes.inc(len(body), station=self.station.name, kind=kind)
+        return len(body)
+
+    def upload_segment(self, filename: str) -> Optional[int]:
+        """Upload a segment file, returning None if retention has already deleted it"""
+        try:
+            with open(self.folder / filename, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        return self.upload('segment', filename, body, SEGMENT_CONTENT_TYPE, SEGMENT_CACHE_CONTROL)
+
+    def playlist_names(self, variants: Optional[StationVariants]) -> List[str]:
+        """Every delayed playlist the station could have, masters last"""
+        names = [f'playlist_{delay}.m3u8' for delay in self.delays]
+        if variants:
+            names += [f'{variant.name}/playlist_{delay}.m3u8' for variant in variants.variants for delay in self.delays]
+            names += [f'master_{delay}.m3u8' for delay in self.delays]
+        return names
+
+    def reconfigure(self, delays: List[int], retention: float, segment_retention: Optional[float] = None):
+        """Follow a change to the configured delays and retention periods, deleting the playlists of removed delays"""
+        removed = set(self.delays) - set(delays)
+        self.delays = delays
+        self.retention = retention
+        self.segment_retention = segment_retention or retention
+        names = [name for name in self.published_playlists
+                 if int(re.search(r'_(\d+)\.m3u8$', name).group(1)) in removed]
+        if not names:
+            return
+        failed = set(self.target.delete([self.prefix + name for name in names]))
+        for name in names:
+            if self.prefix + name not in failed:
+                del self.published_playlists[name]
+                self.playlist_stats.pop(name, None)
+        logging.info(f"Deleted {len(names) - len(failed)} published playlists of removed delays for {self.station.name}")
+
+    def changed_playlists(self, variants: Optional[StationVariants]) -> List[Tuple[str, bytes, Tuple[int, int, int], int]]:
+        """Playlist files whose contents differ from what was last published, with their stat and CRC32"""
+        changed = []
+        for name in self.playlist_names(variants):
+            try:
+                stat = os.stat(self.folder / name)
+            except FileNotFoundError:
+                continue
+            stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if self.playlist_stats.get(name) == stat_key:
+                continue
+            try:
+                with open(self.folder / name, 'rb') as f:
+                    body = f.read()
+            except OSError as e:
+                logging.error(f"Error reading {name}: {str(e)}")
+                continue
+            checksum = zlib.crc32(body)
+            if self.published_playlists.get(name) == checksum:
+                self.playlist_stats[name] = stat_key
+                continue
+            changed.append((name, body, stat_key, checksum))
+        return changed
+
+    def publish_segments(self, now: float, variants: Optional[StationVariants]) -> bool:
+        """
+        Upload segments (and chunks) added to the journals since the last round, and the copies other
+        variants have of them, unless they are already past retention
+
+        Returns:
+            bool: Whether every new segment was published
+        """
+        uploads: Dict[Future, Tuple[str, int, str, float]] = {}
+        for folder, index in self.indexes.items():
+            cutoff = now - (self.retention if folder else self.segment_retention)
+            for i in range(bisect.bisect_left(index.sequences, self.scan_from[folder]), len(index)):
+                if index.timestamps[i] < cutoff:
+                    continue
+                filenames = [folder + index.filename(i)]
+                if variants and index.variant_masks[i]:
+                    filenames.extend(f'{folder}{variant.name}/{segment_filename(index.sequences[i])}'
+                                     for bit, variant in enumerate(variants.variants) if index.variant_masks[i] & (1 << bit))
+                for filename in filenames:
+                    if filename not in self.manifest.segments:
+                        future = self.executor.submit(self.upload_segment, filename)
+                        uploads[future] = (folder, index.sequences[i], filename, index.timestamps[i])
+
+        wait(uploads)
+        failed: Dict[str, List[int]] = {}
+        for future, (folder, sequence, filename, timestamp) in uploads.items():
+            try:
+                if future.result() is not None:
+                    self.manifest.segments[filename] = timestamp
+            except Exception as e:
+                logging.error(f"Error publishing {self.prefix}{filename}: {str(e)}")
+                export_upload_failures.inc(station=self.station.name, kind='segment')
+                failed.setdefault(folder, []).append(sequence)
+        if uploads:
+            self.manifest.save()
+        # Failed segments are retried next round
+        for folder, index in self.indexes.items():
+            if folder in failed:
+                self.scan_from[folder] = min(failed[folder])
+            elif len(index):
+                self.scan_from[folder] = index.sequences[-1] + 1
+        return not failed
+
+    def publish_playlists(self, playlists: List[Tuple[str, bytes, Tuple[int, int, int], int]]):
+        """Upload changed playlists as one concurrent batch"""
+        uploads = {self.executor.submit(self.upload, 'playlist', name, body, PLAYLIST_CONTENT_TYPE,
+                                        PLAYLIST_CACHE_CONTROL): (name, stat_key, checksum)
+                   for name, body, stat_key, checksum in playlists}
+        wait(uploads)
+        for future, (name, stat_key, checksum) in uploads.items():
+            try:
+                future.result()
+                self.playlist_stats[name] = stat_key
+                self.published_playlists[name] = checksum
+            except Exception as e:
+                logging.error(f"Error publishing {self.prefix}{name}: {str(e)}")
+                export_upload_failures.inc(station=self.station.name, kind='playlist')
+
+    def collect(self, now: float):
+        """Delete published segments (and chunks) that are past retention"""
+        segment_cutoff = now - self.segment_retention
+        chunk_cutoff = now - self.retention
+        expired = [filename for filename, timestamp in self.manifest.segments.items()
+                   if timestamp < (chunk_cutoff if filename.startswith(f'{CHUNK_FOLDER}/') else segment_cutoff)]
+        if not expired:
+            return
+        failed = set(self.target.delete([self.prefix + filename for filename in expired]))
+        deleted = 0
+        for filename in expired:
+            if self.prefix + filename not in failed:
+                del self.manifest.segments[filename]
+                deleted += 1
+        self.manifest.save()
+        export_deletes.inc(deleted, station=self.station.name)
+        logging.info(f"Deleted {deleted} published segments for {self.station.name} past retention")
+
+    def export_once(self, now: Optional[float] = None):
+        """Publish new segments, then the playlists that changed, and delete expired segments when due"""
+        now = time.time() if now is None else now
+        # Playlists are read before the journal, so every segment they list is published before they are
+        variants = load_variants(self.folder)
+        playlists = self.changed_playlists(variants)
+        for index in self.indexes.values():
+            index.refresh()
+        if self.publish_segments(now, variants):
+            # Master playlists go up once the variant playlists they list are there
+            self.publish_playlists([playlist for playlist in playlists if not playlist[0].startswith('master_')])
+            self.publish_playlists([playlist for playlist in playlists if playlist[0].startswith('master_')])
+        else:
+            logging.warning(f"Holding back {len(playlists)} playlists for {self.station.name} until their segments are published")
+        if now >= self._next_collect:
+            self._next_collect = now + self.collect_interval
+            self.collect(now)
+        export_published_segments.set(len(self.manifest.segments), station=self.station.name)
+
+
+def main(target, export_stations: List[Station] = stations, interval: float = 1.0, max_workers: int = 16):
+    """Publish every station to the target, once per interval"""
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export')
+    exporters = [StationExporter(station, target, executor) for station in export_stations]
+    logging.info(f"Exporting {', '.join(station.name for station in export_stations)} to {target}")
+    config_generation = config.generation
+    try:
+        while True:
+            started = time.monotonic()
+            # Delays added to or removed from the settings file are published (or deleted) from this round on
+            config.reload_if_changed()
+            if config_generation != config.generation:
+                config_generation = config.generation
+                for exporter in exporters:
+                    exporter.reconfigure(config.delays_seconds, config.retention_seconds,
+                                         config.coalesced_retention_seconds)
+            for exporter in exporters:
+                exporter.export_once()
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+    finally:
+        executor.shutdown(wait=True)
+        target.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the delayed playlists and segments to a bucket or folder")
+    parser.add_argument('target', help="s3://bucket/prefix, or a folder")
+    parser.add_argument('--endpoint-url', help="Endpoint of an S3-compatible store, eg. http://127.0.0.1:9000")
+    parser.add_argument('--interval', type=float, default=1.0, help="Seconds between publishing rounds")
+    parser.add_argument('--workers', type=int, default=16, help="Concurrent uploads, and connections to the target")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this local port")
+    args = parser.parse_args()
+
+    # Archives keep growing until their hour is over, and objects can't be appended to
+    if segment_storage != 'files':
+        parser.error("exporting needs segment_storage = 'files' in config.py")
+
+    # Exit through the normal shutdown path on terminate, so uploads in flight finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    main(open_target(args.target, args.endpoint_url, args.workers), interval=args.interval, max_workers=args.workers)
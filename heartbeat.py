@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+
+def heartbeat_path(folder: str, process_name: str) -> Path:
+    return Path(folder) / f'heartbeat_{process_name}.json'
+
+
+class Heartbeat:
+    """
+    Small status file a child process rewrites as it makes progress.
+
+    The supervisor reads one tiny file per check instead of scanning the output folder,
+    and the fields tell it what kind of progress is (or isn't) being made.
+    """
+
+    def __init__(self, path: Path, min_interval: float = 1.0):
+        self.path = Path(path)
+        self.min_interval = min_interval
+        self.fields = {'pid': os.getpid()}
+        self._last_write = 0.0
+
+    def beat(self, force: bool = False, **fields):
+        """Update status fields and write them out, at most once per min_interval unless forced"""
+        self.fields.update(fields)
+        now = time.time()
+        if not force and now - self._last_write < self.min_interval:
+            return
+        self.fields['time'] = now
+        temp_file = self.path.with_suffix('.json.tmp')
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self.fields, f)
+            temp_file.replace(self.path)
+            self._last_write = now
+        except OSError as e:
+            logging.error(f"Error writing heartbeat: {str(e)}")
+
+
+def read_heartbeat(path: Path) -> Optional[dict]:
+    """Read a heartbeat, or None if there isn't a complete one"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -3,19 +3,18 @@
 # The court ruled that Optus' TV Now service did not infringe copyright because it was the user, not Optus, who was responsible for making the recording.
 # It does not matter that the recording is made on Optus' servers, because the user is the one who initiates the recording.
 
-from dataclasses import dataclass
 import time
-import m3u8
 import subprocess
-from pathlib import Path
 import signal
 import os
 import logging
 import atexit
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-import threading
-import json
+import argparse
 import sys
+from heartbeat import read_heartbeat, heartbeat_path
+from config import (playlist_folder, delays_seconds, segment_storage, stations, runtime_mode,
+                    segment_downloader_metrics_port, playlist_creator_metrics_port, playlist_specs, load_start_time)
+import config
 
 logging.basicConfig(filename='main.log',
                     filemode='a',
@@ -25,23 +24,10 @@ logging.basicConfig(filename='main.log',
 
 # Global variables
 ffmpeg_process = None
+segment_downloader_process = None
 playlist_process = None
 
-playlist_folder = './output/'
-
-
-delays_seconds = [60*x for x in ([2,5,10, 30] + list(range(60, 24*60, 60)))]
-buffer_period_seconds = 1 * 60 # 1 minute
-hls_length = 1.0 * 60 # 1.0 minutes
-
-@dataclass
-class PlaylistSpec:
-    delay_seconds: int
-    playlist_start_time: float
-    playlist_file_name: str
-    first_segment_id: int
-    is_initalised: bool = False
-    is_running: bool = False
+# Settings are in config.py, and can be changed while running in the settings file it names
 
 
 def start_segment_downloader():
@@ -49,13 +35,19 @@ def start_segment_downloader():
     global segment_downloader_process
     
     try:
+        # The downloader reads its settings from config.py, and follows changes to the settings file itself
+        env = os.environ.copy()
+        env['METRICS_PORT'] = str(segment_downloader_metrics_port)
+
         segment_downloader_process = subprocess.Popen(
             [sys.executable, './segment_downloader.py'],
+            env=env,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True
         )
+        segment_downloader_process.started_at = time.time()
         logging.info("Started segment downloader process")
         return segment_downloader_process
     except Exception as e:
@@ -73,14 +65,13 @@ def cleanup_segment_downloader():
             segment_downloader_process.kill()
 
 
-def start_playlist_creator(playlists_spec):
+def start_playlist_creator():
     """Start the playlist creator subprocess"""
     global playlist_process
     try:
-        # Convert PlaylistSpec objects to dictionaries
-        playlists_dict = [vars(spec) for spec in playlists_spec]
+        # The playlist creator makes a playlist for each delay in config.py, and follows changes to the settings file
         env = os.environ.copy()
-        env['PLAYLISTS_SPEC'] = json.dumps(playlists_dict)
+        env['METRICS_PORT'] = str(playlist_creator_metrics_port)
         
         playlist_process = subprocess.Popen(
             [sys.executable, './playlist_creator.py'],
@@ -89,6 +80,7 @@ def start_playlist_creator(playlists_spec):
             stderr=subprocess.PIPE,
             universal_newlines=True
         )
+        playlist_process.started_at = time.time()
         
         # Check if process started successfully
         if playlist_process.poll() is not None:
@@ -117,16 +109,16 @@ def cleanup_processes():
     cleanup_segment_downloader()
     cleanup_playlist_creator()
     
-def check_process_health(process, process_name, folder=None, file_extension=None, timeout_seconds=60):
+def check_process_health(process, process_name, heartbeat_file=None, timeout_seconds=60, expect_segments=False):
     """
     Check if a process is healthy and restart if necessary
     
     Args:
         process: The subprocess to check
         process_name: Name of the process for logging
-        folder: Folder to check for new files (optional)
-        file_extension: File extension to check for (optional)
+        heartbeat_file: Heartbeat file the process keeps up to date (optional)
         timeout_seconds: Timeout in seconds before considering process unhealthy
+        expect_segments: Whether the process should be reporting new segments
         
     Returns:
         bool: True if process is healthy, False if it needs to be restarted
@@ -136,25 +128,32 @@ def check_process_health(process, process_name, folder=None, file_extension=None
         logging.error(f"{process_name} process died unexpectedly")
         return False
     
-    # If folder and file extension are provided, check for new files
-    if folder and file_extension:
-        current_time = time.time()
-        try:
-            # Get most recent file modification time
-            files = [f for f in os.listdir(folder) if f.endswith(file_extension)]
-            if files:
-                newest_file = max(
-                    files,
-                    key=lambda f: os.path.getmtime(os.path.join(folder, f))
-                )
-                last_file_time = os.path.getmtime(os.path.join(folder, newest_file))
-                
-                # If no new files in the specified timeout period, consider process unhealthy
-                if current_time - last_file_time > timeout_seconds:
-                    logging.warning(f"No new {file_extension} files in last {timeout_seconds} seconds. {process_name} may be stuck.")
-                    return False
-        except Exception as e:
-            logging.error(f"Error checking {process_name} files: {str(e)}")
+    if heartbeat_file is None:
+        return True
+
+    current_time = time.time()
+    heartbeat = read_heartbeat(heartbeat_file)
+    if heartbeat is None or heartbeat.get('pid') != process.pid:
+        # Give a freshly started process time to report in
+        if current_time - process.started_at > timeout_seconds:
+            logging.warning(f"No heartbeat from {process_name} in {timeout_seconds} seconds. It may be stuck.")
+            return False
+        return True
+
+    if current_time - heartbeat['time'] > timeout_seconds:
+        logging.warning(f"{process_name} heartbeat is {current_time - heartbeat['time']:.0f} seconds old. It may be stuck.")
+        return False
+
+    # The downloader also reports whether the origin is answering and whether new segments are arriving
+    if expect_segments:
+        last_segment_time = heartbeat.get('last_segment_time', process.started_at)
+        if current_time - last_segment_time > timeout_seconds:
+            if current_time - heartbeat.get('last_poll_time', 0) <= timeout_seconds:
+                logging.warning(f"Origin is up but no new sequence numbers since {heartbeat.get('last_sequence')} "
+                                f"in the last {timeout_seconds} seconds. {process_name} may be stuck.")
+            else:
+                logging.warning(f"Origin playlist unreachable for {timeout_seconds} seconds. {process_name} may be stuck.")
+            return False
     
     return True
 
@@ -164,41 +163,38 @@ def signal_handler(signum, frame):
     cleanup_processes()
     exit(0)
 
-# Register cleanup and signal handlers
-atexit.register(cleanup_processes)
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
-
-# Create output folder if it does not exist
-if not os.path.exists(playlist_folder):
-    os.makedirs(playlist_folder)
-
-
 # main loop
 def main():
-    start_time = time.time()
-    # Create output directory
-    if not os.path.exists(playlist_folder):
-        os.makedirs(playlist_folder)
+    # Create output folders if they do not exist
+    for folder in [playlist_folder] + [station.folder for station in stations]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    start_time = load_start_time()
+
+    if runtime_mode == 'unified':
+        from runtime import run_unified
+        run_unified(playlist_specs(delays_seconds, start_time), storage=segment_storage)
+        return
+
+    # Register cleanup and signal handlers
+    atexit.register(cleanup_processes)
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
 
     start_segment_downloader()
-
-    playlists_to_create = []
-    for delay in delays_seconds:
-        playlists_to_create.append(PlaylistSpec(delay, start_time, f'playlist_{delay}.m3u8', first_segment_id=None, is_initalised= False))
-    
-    start_playlist_creator(playlists_to_create)
+    start_playlist_creator()
 
     # Keep main process running and monitor subprocesses
     try:
         while True:
-            # Check segment downloader health
+            # Check segment downloader health. Every station is downloaded by the same process, so the first
+            # station's heartbeat shows it is alive, and another station's origin going down doesn't restart it.
             if not check_process_health(
                 segment_downloader_process, 
                 "Segment downloader", 
-                playlist_folder, 
-                '.aac', 
-                60
+                heartbeat_path(stations[0].folder, 'segment_downloader'),
+                60,
+                expect_segments=True
             ):
                 logging.warning("Restarting segment downloader...")
                 cleanup_segment_downloader()
@@ -210,14 +206,15 @@ def main():
             if not check_process_health(
                 playlist_process, 
                 "Playlist creator",
-                playlist_folder,
-                '.m3u8',
+                heartbeat_path(playlist_folder, 'playlist_creator'),
                 60
             ):
                 logging.warning("Restarting playlist creator...")
                 cleanup_playlist_creator()
-                start_playlist_creator(playlists_to_create)
-                
+                start_playlist_creator()
+
+            # Only to log settings that need a restart, the children apply the rest themselves
+            config.reload_if_changed()
             time.sleep(1)  # Check every second
     except KeyboardInterrupt:
         logging.info("Received keyboard interrupt, shutting down...")
@@ -226,6 +223,10 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the station and keep the delayed playlists up to date")
+    parser.add_argument('--mode', choices=['processes', 'unified'], default=runtime_mode,
+                        help="Run as separate processes, or as tasks in a single process")
+    runtime_mode = parser.parse_args().mode
     main()
     
     
\ No newline at end of file
@@ -0,0 +1,114 @@
+import re
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+_CAN_SKIP_UNTIL = re.compile(r'CAN-SKIP-UNTIL=([\d.]+)')
+_SKIPPED_SEGMENTS = re.compile(r'SKIPPED-SEGMENTS=(\d+)')
+# An attribute list entry (RFC 8216 4.2), with the value quoted or not
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class MediaSegment(NamedTuple):
+    uri: str
+    duration: float
+    media_sequence: int
+    program_date_time: Optional[datetime]
+
+
+class MediaPlaylist(NamedTuple):
+    media_sequence: int
+    target_duration: Optional[float]
+    segments: List[MediaSegment]
+    # Seconds back from the live edge an LL-HLS origin will leave out of a delta update, if it offers them
+    can_skip_until: Optional[float] = None
+
+
+class VariantStream(NamedTuple):
+    uri: str
+    bandwidth: int
+    average_bandwidth: Optional[int]
+    codecs: Optional[str]
+
+
+def parse_attributes(value: str) -> Dict[str, str]:
+    """Parse a tag's attribute list, with quotes taken off quoted strings"""
+    return {name: value.strip('"') for name, value in _ATTRIBUTE.findall(value)}
+
+
+def parse_master_playlist(text: str) -> List[VariantStream]:
+    """Parse the variant streams listed in a master playlist (RFC 8216 4.3.4.2)"""
+    variants = []
+    attributes = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line[len('#EXT-X-STREAM-INF:'):])
+        elif line and not line.startswith('#') and attributes is not None:
+            # The URI line following each EXT-X-STREAM-INF
+            average_bandwidth = attributes.get('AVERAGE-BANDWIDTH')
+            variants.append(VariantStream(line, int(attributes.get('BANDWIDTH', 0)),
+                                          int(average_bandwidth) if average_bandwidth else None,
+                                          attributes.get('CODECS')))
+            attributes = None
+    return variants
+
+
+def parse_program_date_time(value: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def parse_media_playlist(text: str, after_sequence: int = -1) -> MediaPlaylist:
+    """
+    Parse the tags the downloader needs from a live media playlist (RFC 8216 4.3)
+
+    Only segments after after_sequence are returned. Lines belonging to earlier segments
+    are counted but not parsed, so a playlist that has only moved on by a segment costs
+    little more than splitting it into lines. An EXT-X-SKIP tag in a delta update
+    (_HLS_skip=YES) stands in for the segments it skipped.
+
+    Args:
+        text: Playlist body
+        after_sequence: Newest media sequence number the caller doesn't need
+
+    Returns:
+        MediaPlaylist: The playlist, with only the segments after after_sequence
+    """
+    media_sequence = 0
+    target_duration = None
+    can_skip_until = None
+    segments = []
+    sequence = 0
+    duration = None
+    program_date_time = None
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            uri = line.strip()
+            if uri:
+                # A URI ends each segment
+                if sequence > after_sequence:
+                    segments.append(MediaSegment(uri, duration or 0.0, sequence, program_date_time))
+                sequence += 1
+                duration = program_date_time = None
+        elif sequence <= after_sequence and line.startswith(('#EXTINF:', '#EXT-X-PROGRAM-DATE-TIME:')):
+            # A segment we already have
+            continue
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            program_date_time = parse_program_date_time(line[len('#EXT-X-PROGRAM-DATE-TIME:'):].strip())
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = sequence = int(line[len('#EXT-X-MEDIA-SEQUENCE:'):])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line[len('#EXT-X-TARGETDURATION:'):])
+        elif line.startswith('#EXT-X-SERVER-CONTROL:'):
+            match = _CAN_SKIP_UNTIL.search(line)
+            if match:
+                can_skip_until = float(match.group(1))
+        elif line.startswith('#EXT-X-SKIP:'):
+            match = _SKIPPED_SEGMENTS.search(line)
+            if match:
+                sequence += int(match.group(1))
+    return MediaPlaylist(media_sequence, target_duration, segments, can_skip_until)
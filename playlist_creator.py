@@ -1,169 +1,426 @@
 import time
-import m3u8
 from pathlib import Path
 import logging
 import sys
-from dataclasses import dataclass
-from typing import List
-from main import playlist_folder, buffer_period_seconds, PlaylistSpec, hls_length
+from typing import Dict, List, Optional
+import config
+from config import (playlist_folder, PlaylistSpec, Station, coalesce_after_seconds, coalesce_segments,
+                    plays_chunks, playlist_specs, load_start_time)
 import json
 import os
+import signal
+from dataclasses import replace
+from segment_index import SegmentIndex, render_playlist
+from segment_events import SegmentEventListener, wait_any
+from heartbeat import Heartbeat, heartbeat_path
+from metrics import registry, start_metrics_server
+from profiling import install_profiler, timed_stage
+from checkpoint import PlaylistCursor, save_checkpoint, load_checkpoint
+from variants import StationVariants, load_variants, render_master_playlist
+from coalesce import CHUNK_FOLDER, chunk_folder
 
 # Configure logging
 logging.basicConfig(
-    filename='/Users/danielpayten/Desktop/JDelay Logs/JDelay/playlist_creator.log',
+    filename='playlist_creator.log',
     filemode='a',
     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
     level=logging.DEBUG
 )
 
+# Upper bound on sleeping, in case a notification is missed
+max_sleep_seconds = 30
+# Wake just after a window edge rather than exactly on it
+wake_margin_seconds = 0.01
+# How often the index and playlist cursors are checkpointed for a warm restart
+checkpoint_interval_seconds = 60
 
+playlist_regeneration_seconds = registry.histogram('jdelay_playlist_regeneration_seconds',
+                                                   "Time to look up and render a delayed playlist", ['station', 'delay'])
+playlist_writes = registry.counter('jdelay_playlist_writes_total', "Delayed playlists rewritten with a new window",
+                                   ['station', 'delay'])
+playlist_delay_drift_seconds = registry.gauge('jdelay_playlist_delay_drift_seconds',
+                                              "How far behind its target delay the newest segment in a playlist started",
+                                              ['station', 'delay'])
+indexed_segments = registry.gauge('jdelay_playlist_indexed_segments', "Segments in the playlist creator's index",
+                                  ['station'])
 
 
-def get_segment_infos():
-    segment_info_file = Path(playlist_folder) / 'segment_info.json'
-    if not os.path.exists(segment_info_file):
+# The functions below take the station to work on, or None for a single station recorded into playlist_folder
+def station_folder(station: Optional[Station] = None) -> Path:
+    return Path(station.folder if station else playlist_folder)
+
+
+def station_name(station: Optional[Station] = None) -> str:
+    return station.name if station else ''
+
+
+def get_segment_index(station: Optional[Station] = None) -> SegmentIndex:
+    return SegmentIndex(station_folder(station) / 'segment_journal.jsonl')
+
+
+# Index of each station's coalesced chunks, by folder, tailing the chunk journal
+chunk_indexes: Dict[Path, SegmentIndex] = {}
+
+
+def get_chunk_index(station: Optional[Station] = None) -> Optional[SegmentIndex]:
+    """The station's chunks, up to date with their journal, or None when coalescing is off"""
+    if coalesce_after_seconds is None:
         return None
-    with open(segment_info_file, 'r') as f:
-        segment_infos = json.load(f)
-    return segment_infos
+    folder = station_folder(station)
+    chunk_index = chunk_indexes.get(folder)
+    if chunk_index is None:
+        chunk_index = chunk_indexes[folder] = SegmentIndex(chunk_folder(folder) / 'segment_journal.jsonl')
+    chunk_index.refresh()
+    return chunk_index
+
+
+def get_checkpoint_path(station: Optional[Station] = None) -> Path:
+    return station_folder(station) / 'playlist_checkpoint.bin'
+
+
+def restore_playlists(playlists_spec: List[PlaylistSpec], segment_index: SegmentIndex,
+                      station: Optional[Station] = None) -> List[PlaylistSpec]:
+    """
+    Warm start from the last checkpoint, or from the saved playlist spec if there isn't one
+
+    Playlists that were running carry on from their saved anchor, and the index only reads
+    journal records written since the checkpoint. Delays not seen before start from scratch.
+    """
+    cursors = load_checkpoint(get_checkpoint_path(station), segment_index)
+    saved = {}
+    spec_file = station_folder(station) / 'playlist_spec.json'
+    if cursors is not None:
+        saved = {cursor.delay_seconds: cursor._asdict() for cursor in cursors}
+    elif os.path.exists(spec_file):
+        try:
+            with open(spec_file, 'r') as f:
+                saved = {spec['delay_seconds']: spec for spec in json.load(f)}
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Error loading playlist spec: {str(e)}")
+
+    for spec in playlists_spec:
+        state = saved.get(spec.delay_seconds)
+        if state:
+            spec.playlist_start_time = state['playlist_start_time']
+            spec.first_segment_id = state['first_segment_id']
+            spec.is_initalised = state['is_initalised']
 
-    
-def initialise_playlist(playlist_spec: PlaylistSpec, output_folder: Path):
-    segment_infos = get_segment_infos()
-    segment_metadata = segment_infos['segment_metadata']
+    segment_index.refresh()
+    return playlists_spec
 
-    # Convert dictionary values to list and filter
-    segments_in_delay = [
-        segment for segment in segment_metadata.values()
-        if segment['timestamp'] - (playlist_spec.playlist_start_time - playlist_spec.delay_seconds - buffer_period_seconds) > 0
-    ]
 
-    # Get the first segment_id which meets the delay
-    first_segment = min(segments_in_delay, key=lambda x: x['timestamp'])
-    playlist_spec.first_segment_id = first_segment['sequence']
+def checkpoint_playlists(playlists_spec: List[PlaylistSpec], segment_index: SegmentIndex,
+                         station: Optional[Station] = None):
+    """Checkpoint the segment index and where each playlist is up to"""
+    cursors = [PlaylistCursor(spec.delay_seconds, spec.playlist_start_time, spec.first_segment_id, spec.is_initalised)
+               for spec in playlists_spec]
+    try:
+        save_checkpoint(get_checkpoint_path(station), segment_index, cursors)
+    except OSError as e:
+        logging.error(f"Error writing checkpoint: {str(e)}")
 
+
+def initialise_playlist(playlist_spec: PlaylistSpec, segment_index: SegmentIndex,
+                        chunk_index: Optional[SegmentIndex] = None):
+    threshold = playlist_spec.playlist_start_time - playlist_spec.delay_seconds - config.buffer_period_seconds
+
+    # A delay that plays chunks only has the chunks left to start from, its segments may already be deleted
+    chunks = chunk_index is not None and plays_chunks(playlist_spec.delay_seconds)
+    index = chunk_index if chunks else segment_index
+
+    # Get the first segment_id (or chunk) which meets the delay
+    position = index.first_after(threshold)
+    if position is None:
+        return playlist_spec
+
+    # Chunk k starts with segment k * coalesce_segments, and the playlist is anchored on a segment
+    first_id = index.sequences[position]
+    playlist_spec.first_segment_id = first_id * coalesce_segments if chunks else first_id
     playlist_spec.is_initalised = True
 
     return playlist_spec
 
-def populate_playlist(playlist_spec: PlaylistSpec, segment_infos: dict):
-    segment_metadata = segment_infos['segment_metadata']
-    
-    # This will be run every 1 second
-
-    # We build a list of every segment, with start and end times.
-    # 
-    wall_time_segment_0 = segment_metadata[str(playlist_spec.first_segment_id)]
-
-    # We need to get the segments which are in after the wall time of the first segment
-    segments_in_delay = [
-        segment for segment in segment_metadata.values()
-        if segment['sequence'] > playlist_spec.first_segment_id
-    ]
-
-    segments_in_delay = sorted(segments_in_delay, key=lambda x: x['sequence'])
-
-    # Build a table of segments with start and end times, with the first segment being the wall time of the first segment,
-    # then recursively adding the duration of the previous segment to the start time of the next segment.
-    segments_table = [
-        {
-            'sequence': wall_time_segment_0['sequence'],
-            'start_time': wall_time_segment_0['timestamp'],
-            'end_time': wall_time_segment_0['timestamp'] + wall_time_segment_0['duration'],
-            'filename': wall_time_segment_0['filename'],
-            'duration': wall_time_segment_0['duration']
-        }
-    ]
-    
-    for segment in segments_in_delay:
-        segments_table.append({
-            'sequence': segment['sequence'],
-            'start_time': segments_table[-1]['end_time'],
-            'end_time': segments_table[-1]['end_time'] + segment['duration'],
-            'filename': segment['filename'],
-            'duration': segment['duration']
-        })
-    
-    # We need to get the segments which are in the delay
-
-    broadcast_time = time.time() - playlist_spec.delay_seconds - buffer_period_seconds
-    # We need to get the segments which are in the delay
-    output_segments = [
-        segment for segment in segments_table
-        if segment['start_time'] <= broadcast_time <= segment['end_time'] + hls_length
-    ]
+# Contents of each playlist as last written, by path, so unchanged playlists are not rewritten
+written_playlists = {}
 
+def write_playlist(playlist_path: Path, playlist: str) -> bool:
+    """
+    Atomically write a playlist, unless it is unchanged since it was last written
+
+    Returns:
+        bool: Whether the playlist was written
+    """
+    if written_playlists.get(playlist_path) == playlist:
+        return False
     # Create temporary file
-    playlist_path = Path(playlist_folder) / f'playlist_{playlist_spec.delay_seconds}.m3u8'
     temp_file = playlist_path.with_suffix('.m3u8.tmp')
-    
+    try:
+        # Write to temporary file
+        with open(temp_file, 'w') as f:
+            f.write(playlist)
+
+        # Atomic rename operation
+        temp_file.replace(playlist_path)
+        written_playlists[playlist_path] = playlist
+        return True
+
+    except Exception as e:
+        logging.error(f"Error writing playlist: {str(e)}")
+        # Clean up temp file if it exists
+        if temp_file.exists():
+            temp_file.unlink()
+        return False
+
+
+def chunk_anchor(playlist_spec: PlaylistSpec, chunk_index: Optional[SegmentIndex]) -> Optional[int]:
+    """
+    The chunk a delay that plays chunks is anchored on, or None if it doesn't play chunks or can't yet
+
+    A playlist's anchor is a segment, and chunk k holds segments from k * coalesce_segments,
+    so it is anchored on the chunk holding its anchor segment. Until that chunk is written, or
+    while there are no chunks at all, the delay has nothing to play.
+    """
+    if chunk_index is None or len(chunk_index) == 0 or not plays_chunks(playlist_spec.delay_seconds):
+        return None
+    anchor = playlist_spec.first_segment_id // coalesce_segments
+    if anchor > chunk_index.sequences[-1]:
+        return None
+    # Retention eventually deletes the anchor chunk too, so re-anchor on the oldest chunk still kept
+    if chunk_index.position(anchor) is None:
+        logging.info(f"Chunk {anchor} has expired, re-anchoring playlist_{playlist_spec.delay_seconds} on chunk {chunk_index.sequences[0]}")
+        anchor = chunk_index.sequences[0]
+        playlist_spec.first_segment_id = anchor * coalesce_segments
+    return anchor
+
+
+@timed_stage('populate_playlist')
+def populate_playlist(playlist_spec: PlaylistSpec, segment_index: SegmentIndex,
+                      station: Optional[Station] = None, variants: Optional[StationVariants] = None,
+                      chunk_index: Optional[SegmentIndex] = None) -> Optional[float]:
+    """
+    Write the playlist for a delay if its window of segments has changed
+
+    With variants, the same window is also written as each variant's playlist, in the variant's
+    folder, along with a master playlist for the delay listing every variant the window has
+    segments of. Delays long enough to play coalesced chunks take their window from chunk_index, and are only
+    written once it holds the chunk they start on.
+
+    Returns:
+        float: Wall time at which the window will next change, or None if that depends on segments not downloaded yet
+    """
+    anchor = chunk_anchor(playlist_spec, chunk_index)
+    if anchor is not None:
+        # A live playlist has to last at least three target durations (RFC 8216 6.2.2), which chunks soon outgrow
+        index, uri_folder = chunk_index, f'{CHUNK_FOLDER}/'
+        length = max(config.hls_length, 3 * chunk_index.durations[-1])
+        target_duration = chunk_index.target_duration()
+    elif chunk_index is not None and plays_chunks(playlist_spec.delay_seconds):
+        # Chunks are numbered apart from segments and last far longer, so a playlist that started on segments
+        # couldn't switch to chunks without its media sequence and target duration changing (RFC 8216 6.2.1)
+        return None
+    else:
+        # Retention eventually deletes the anchor segment, so re-anchor on the oldest segment still kept
+        if segment_index.position(playlist_spec.first_segment_id) is None and len(segment_index) > 0:
+            logging.info(f"Segment {playlist_spec.first_segment_id} has expired, re-anchoring playlist_{playlist_spec.delay_seconds} on {segment_index.sequences[0]}")
+            playlist_spec.first_segment_id = segment_index.sequences[0]
+        index, anchor, uri_folder, length = segment_index, playlist_spec.first_segment_id, '', config.hls_length
+        target_duration = None
+
+    # The index keeps a cumulative timeline of segments, with the first segment starting at its wall time
+    # and each later segment starting when the previous one ended, so we only need to look up the window.
+    started = time.perf_counter()
+    delay = playlist_spec.delay_seconds + config.buffer_period_seconds
+    now = time.time()
+    broadcast_time = now - delay
+    output_segments = index.window(anchor, broadcast_time, length)
+    next_change = index.next_change(anchor, broadcast_time, length)
+
     # If there are no segments, we don't need to write a playlist
-    if len(output_segments) > 0:
+    playlist = render_playlist(output_segments, uri_folder, target_duration=target_duration) if output_segments else None
+    name = station_name(station)
+    playlist_regeneration_seconds.observe(time.perf_counter() - started, station=name, delay=playlist_spec.delay_seconds)
+    if output_segments:
+        # The timeline is built from segment durations, so compare against the newest segment's own wall time
+        newest_start = index.timestamps[index.position(output_segments[-1].sequence)]
+        playlist_delay_drift_seconds.set(now - newest_start - delay, station=name, delay=playlist_spec.delay_seconds)
+    if playlist is not None:
+        folder = station_folder(station)
+        file_name = f'playlist_{playlist_spec.delay_seconds}.m3u8'
+        if write_playlist(folder / file_name, playlist):
+            playlist_writes.inc(station=name, delay=playlist_spec.delay_seconds)
+        if variants:
+            # The window is only looked up once, every variant is rendered from it
+            window_mask = 0
+            for segment in output_segments:
+                window_mask |= segment.variant_mask
+            listed = StationVariants(variants.primary, [])
+            for bit, variant in enumerate(variants.variants):
+                if window_mask & (1 << bit):
+                    # Variant playlists are in the variant's folder, their chunks in the variant's folder under chunks
+                    uri_prefix = f'../{uri_folder}{variant.name}/' if uri_folder else ''
+                    write_playlist(folder / variant.name / file_name,
+                                   render_playlist(output_segments, uri_prefix, variant_bit=bit,
+                                                   target_duration=target_duration))
+                    listed.variants.append(variant)
+            write_playlist(folder / f'master_{playlist_spec.delay_seconds}.m3u8', render_master_playlist(listed, file_name))
+
+    return next_change + delay if next_change is not None else None
+
+
+def update_playlists(playlists_spec: List[PlaylistSpec], segment_index: SegmentIndex,
+                     station: Optional[Station] = None) -> float:
+    """
+    Initialise playlists whose delay has been reached and rewrite any whose window has moved
+
+    Returns:
+        float: Wall time to update again, unless new segments arrive first
+    """
+    current_time = time.time()
+    wake_times = []
+    variants = load_variants(station_folder(station))
+    chunk_index = get_chunk_index(station)
+    for spec in playlists_spec:
+        if not spec.is_initalised:
+            initialise_at = spec.playlist_start_time + spec.delay_seconds + config.buffer_period_seconds
+            if current_time >= initialise_at:
+                initialise_playlist(spec, segment_index, chunk_index)
+            else:
+                wake_times.append(initialise_at)
+        if spec.is_initalised:
+            next_change = populate_playlist(spec, segment_index, station, variants, chunk_index)
+            if next_change is not None:
+                wake_times.append(next_change)
+    indexed_segments.set(len(segment_index), station=station_name(station))
+
+    wake_at = min(wake_times, default=current_time + max_sleep_seconds)
+    return min(wake_at, current_time + max_sleep_seconds)
+
+
+def save_playlist_spec(playlists_spec: List[PlaylistSpec], saved_spec: Optional[str] = None,
+                       station: Optional[Station] = None) -> str:
+    """Save the playlist spec if it has changed, so we can resume from where we left off in case of a crash"""
+    spec = json.dumps([spec.__dict__ for spec in playlists_spec])
+    if spec != saved_spec:
+        # Written whole and renamed into place, so a restart never reads it half written
+        spec_file = station_folder(station) / 'playlist_spec.json'
+        temp_file = spec_file.with_suffix('.json.tmp')
+        with open(temp_file, 'w') as f:
+            f.write(spec)
+        temp_file.replace(spec_file)
+    return spec
+
+
+def remove_playlist(delay_seconds: int, station: Optional[Station] = None):
+    """Delete the playlists of a delay that is no longer configured, so players stop rather than stall on them"""
+    folder = station_folder(station)
+    variants = load_variants(folder)
+    paths = [folder / f'playlist_{delay_seconds}.m3u8', folder / f'master_{delay_seconds}.m3u8']
+    if variants:
+        paths += [folder / variant.name / f'playlist_{delay_seconds}.m3u8' for variant in variants.variants]
+    for path in paths:
+        written_playlists.pop(path, None)
         try:
-            # Write to temporary file
-            with open(temp_file, 'w') as f:
-                f.write('#EXTM3U\n')
-                f.write('#EXT-X-VERSION:3\n')
-                f.write('#EXT-X-TARGETDURATION:11\n')
-                f.write(f'#EXT-X-MEDIA-SEQUENCE:{output_segments[0]["sequence"]}\n')
-                for segment in output_segments:
-                    f.write(f'#EXTINF:{segment["duration"]}\n')
-                    f.write(f'{segment["filename"]}\n')
-            
-            # Atomic rename operation
-            temp_file.replace(playlist_path)
-        
-        except Exception as e:
-            logging.error(f"Error writing playlist: {str(e)}")
-            # Clean up temp file if it exists
-            if temp_file.exists():
-                temp_file.unlink()
-
-
-def main(playlists_spec: List[PlaylistSpec]):
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error removing playlist: {str(e)}")
+
+
+def reconcile_playlists(playlists_spec: List[PlaylistSpec], delays: List[int],
+                        station: Optional[Station] = None) -> List[PlaylistSpec]:
+    """
+    Follow a change to the configured delays, without disturbing the playlists of the others
+
+    Delays that are still configured keep their spec, and so their anchor. A new delay is timed
+    from when recording started, like every other, so it starts playing straight away if the
+    buffer already reaches back that far.
+
+    Returns:
+        list: The spec of every configured delay
+    """
+    specs = {spec.delay_seconds: spec for spec in playlists_spec}
+    for delay in specs.keys() - set(delays):
+        logging.info(f"Delay {delay} is no longer configured, removing playlist_{delay}")
+        remove_playlist(delay, station)
+    added = [delay for delay in delays if delay not in specs]
+    if added:
+        logging.info(f"Adding playlists for delays {added}")
+        start_time = min((spec.playlist_start_time for spec in playlists_spec), default=None) or load_start_time()
+        specs.update((spec.delay_seconds, spec) for spec in playlist_specs(added, start_time))
+    return [specs[delay] for delay in sorted(set(delays))]
+
+
+class StationPlaylists:
+    """The delayed playlists of one station, and the index and notifications they are built from"""
+
+    def __init__(self, playlists_spec: List[PlaylistSpec], station: Optional[Station] = None):
+        self.station = station
+        station_folder(station).mkdir(parents=True, exist_ok=True)
+        # If we have run before, resume from where we left off
+        self.segment_index = get_segment_index(station)
+        self.playlists_spec = restore_playlists(playlists_spec, self.segment_index, station)
+        # The segment downloader notifies us as soon as it commits new segments
+        self.segment_events = SegmentEventListener(station_folder(station) / 'segment_events.sock')
+        self.saved_spec = None
+        # Delays are reconciled with config.py whenever its settings change
+        self.config_generation = config.generation
+
+    def update(self, checkpoint_due: bool) -> float:
+        """Rewrite playlists whose window has moved, checkpointing if the spec changed or checkpoint_due"""
+        if self.config_generation != config.generation:
+            self.config_generation = config.generation
+            self.playlists_spec = reconcile_playlists(self.playlists_spec, config.delays_seconds, self.station)
+        # Only the journal records written since the last wake up are read
+        self.segment_index.refresh()
+        wake_at = update_playlists(self.playlists_spec, self.segment_index, self.station)
+        spec = save_playlist_spec(self.playlists_spec, self.saved_spec, self.station)
+        if spec != self.saved_spec or checkpoint_due:
+            checkpoint_playlists(self.playlists_spec, self.segment_index, self.station)
+        self.saved_spec = spec
+        return wake_at
+
+    def close(self):
+        checkpoint_playlists(self.playlists_spec, self.segment_index, self.station)
+        self.segment_events.close()
+
+
+def main(playlists_spec: List[PlaylistSpec], stations: Optional[List[Station]] = None):
     """Main function for playlist creator process"""
-    
-
-    # If the playlist spec file exists, we need to resume from where we left off
-    if os.path.exists(Path(playlist_folder) / 'playlist_spec.json'):
-        with open(Path(playlist_folder) / 'playlist_spec.json', 'r') as f:
-            playlists_spec = json.load(f)
-
-    specs_to_run = []
-    while True:
-        current_time = time.time()
-            
-        # Process the list of playlists which have the delays met
-        for initial_spec in playlists_spec:
-            if not initial_spec.is_initalised and current_time >= initial_spec.playlist_start_time + initial_spec.delay_seconds + buffer_period_seconds:
-                initial_spec = initialise_playlist(initial_spec, Path(playlist_folder))
-                specs_to_run.append(initial_spec)
-
-        # If there are any playlists to run, we get the segment infos
-        if os.path.exists(Path(playlist_folder) / 'segment_info.json') and len(specs_to_run) > 0:
-            segment_infos = get_segment_infos()
-            
-        for run in specs_to_run:
-            populate_playlist(run, segment_infos)
-
-        # Save the playlist spec, so we can resume from where we left off, in case of a crash
-        with open(Path(playlist_folder) / 'playlist_spec.json', 'w') as f:
-            json.dump([spec.__dict__ for spec in playlists_spec], f)
-        
-        # Wait for 1 second
-        time.sleep(1)
+    # Every station gets its own copy of the delays, and they are all kept up to date from this one process
+    all_playlists = [StationPlaylists([replace(spec) for spec in playlists_spec], station)
+                     for station in stations or [None]]
+    last_checkpoint = time.monotonic()
+    heartbeat = Heartbeat(heartbeat_path(playlist_folder, 'playlist_creator'))
+    try:
+        while True:
+            # Delays and buffer parameters changed in the settings file apply from this update on
+            config.reload_if_changed()
+            checkpoint_due = time.monotonic() - last_checkpoint >= checkpoint_interval_seconds
+            wake_at = min(playlists.update(checkpoint_due) for playlists in all_playlists)
+            if checkpoint_due:
+                last_checkpoint = time.monotonic()
+            active_playlists = sum(spec.is_initalised for playlists in all_playlists for spec in playlists.playlists_spec)
+            heartbeat.beat(force=True, active_playlists=active_playlists,
+                           indexed_segments=sum(len(playlists.segment_index) for playlists in all_playlists))
+
+            # Sleep until the next playlist window moves, or a new segment arrives for any station
+            wait_any([playlists.segment_events for playlists in all_playlists], wake_at - time.time() + wake_margin_seconds)
+    finally:
+        for playlists in all_playlists:
+            playlists.close()
 
 
 if __name__ == "__main__":
-    import sys
-    import json
-    
-    # Get playlists to create from environment variable
-    playlists_spec = []
-    if 'PLAYLISTS_SPEC' in os.environ:
-        playlists_dict = json.loads(os.environ['PLAYLISTS_SPEC'])
-        playlists_spec = [PlaylistSpec(**spec) for spec in playlists_dict]
-
-    main(playlists_spec)
+    # Exit through the normal shutdown path on terminate so a final checkpoint is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # A playlist for every configured delay, for every station
+    playlists_spec = playlist_specs(config.delays_seconds, load_start_time())
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']))
+    # SIGUSR1 profiles the running playlist creator
+    install_profiler(playlist_folder, 'playlist_creator')
+
+    main(playlists_spec, config.stations)
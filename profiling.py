@@ -0,0 +1,143 @@
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Optional
+
+from metrics import registry
+
+# How long a capture runs unless it is stopped early, and how often the sampler looks at every thread
+PROFILE_SECONDS = 30
+SAMPLE_INTERVAL_SECONDS = 0.01
+
+stage_seconds = registry.histogram('jdelay_stage_seconds', "Time spent in each stage of the hot path", ['stage'])
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block as a stage in jdelay_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+def timed_stage(stage: str):
+    """Time every call of a function as a stage in jdelay_stage_seconds"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collapse(frame) -> str:
+    """A thread's stack, outermost frame first, in the collapsed format flame graph tools read"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """
+    Time-boxed profile captures of a running process, started with a signal.
+
+    The first signal starts a capture, and a second stops it early. A capture runs cProfile
+    over the main thread, written as <name>-<pid>-<time>.pstats for pstats or snakeviz, and at the
+    same time samples the stacks of every thread (download workers and the HTTP server's
+    threads included), written as <name>-<pid>-<time>.folded for flamegraph.pl or speedscope. Both
+    go to the profiles subfolder of folder. cProfile only sees the thread that enables it
+    and can only be stopped from it, so the sampler signals the main thread when time is up.
+    """
+
+    def __init__(self, folder: str, name: str, duration: float = PROFILE_SECONDS,
+                 interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.folder = Path(folder) / 'profiles'
+        self.name = name
+        self.duration = duration
+        self.interval = interval
+        self.signum = None
+        self.profile: Optional[cProfile.Profile] = None
+        self.stopped: Optional[threading.Event] = None
+        self.sampler: Optional[threading.Thread] = None
+        self.path_stem = ''
+
+    def install(self, signum: int = getattr(signal, 'SIGUSR1', None)) -> bool:
+        """Start and stop captures on signum, from the main thread. Returns False where there is no such signal"""
+        if signum is None:
+            return False
+        self.signum = signum
+        signal.signal(signum, self.handle_signal)
+        return True
+
+    def handle_signal(self, signum, frame):
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        """Start a capture, on the main thread"""
+        # Still writing out the last capture (and perhaps racing to stop it)
+        if self.sampler is not None and self.sampler.is_alive():
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.path_stem = str(self.folder / f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, args=(self.stopped, self.path_stem), name='profiler',
+                                        daemon=True)
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logging.info(f"Profiling {self.name} for up to {self.duration}s into {self.path_stem}.*")
+
+    def stop(self):
+        """Stop the capture and write its results, on the main thread"""
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.stopped.set()
+        try:
+            self.profile.dump_stats(f'{self.path_stem}.pstats')
+            logging.info(f"Wrote {self.path_stem}.pstats")
+        except OSError as e:
+            logging.error(f"Error writing profile: {str(e)}")
+        self.profile = None
+
+    def sample(self, stopped: threading.Event, path_stem: str):
+        stacks = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while not stopped.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[f'{names.get(thread_id, thread_id)};{collapse(frame)}'] += 1
+            stopped.wait(self.interval)
+        try:
+            with open(f'{path_stem}.folded', 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in stacks.most_common())
+            logging.info(f"Wrote {path_stem}.folded from {sum(stacks.values())} samples")
+        except OSError as e:
+            logging.error(f"Error writing profile samples: {str(e)}")
+        if not stopped.is_set():
+            signal.pthread_kill(threading.main_thread().ident, self.signum)
+
+
+def install_profiler(folder: str, name: str) -> Optional[Profiler]:
+    """Let SIGUSR1 start (and stop) a profile capture of this process, written to folder/profiles"""
+    profiler = Profiler(folder, name)
+    return profiler if profiler.install() else None
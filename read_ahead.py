@@ -0,0 +1,217 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+from config import coalesce_segments, plays_chunks
+from checkpoint import playlist_anchor
+from coalesce import CHUNK_FOLDER
+from segment_index import SegmentIndex
+from segment_store import segment_filename
+from variants import load_variants
+from metrics import registry
+
+# Segments due to enter an active delay's window within this many seconds are read ahead
+READ_AHEAD_SECONDS = 3 * 60
+# A delay is active while any of its playlists has been requested this recently
+ACTIVE_DELAY_SECONDS = 2 * 60
+READ_AHEAD_INTERVAL_SECONDS = 10
+# Upper bound on what is held in the page cache for the active delays, the soonest due first
+READ_AHEAD_BYTES = 256 * 1024 * 1024
+
+read_ahead_segments = registry.gauge('jdelay_read_ahead_segments', "Segments held in the page cache for the active delays")
+read_ahead_bytes = registry.gauge('jdelay_read_ahead_bytes', "Bytes held in the page cache for the active delays")
+read_ahead_prefetches = registry.counter('jdelay_read_ahead_prefetches_total',
+                                         "Segments read ahead of entering an active delay's window")
+read_ahead_evictions = registry.counter('jdelay_read_ahead_evictions_total',
+                                        "Read ahead segments dropped once no active delay was about to play them")
+active_delays_gauge = registry.gauge('jdelay_read_ahead_active_delays', "Delays with listeners, as far as read ahead knows")
+
+
+class ReadAhead:
+    """
+    Keeps the segments the active delays are about to play in the page cache.
+
+    A segment of a long delay was written hours before anyone plays it, and is usually
+    long gone from the page cache by then, so the first listener on each delay would wait
+    on cold disk reads. The delay schedule says which segments enter each delay's window
+    next: for every delay whose playlists are being requested, the segments due in the
+    next READ_AHEAD_SECONDS, on the same timeline and from the same anchor as the playlist,
+    are handed to the kernel with POSIX_FADV_WILLNEED (or read once, where there is no
+    posix_fadvise). Once no active delay is about to play a segment, it is dropped again
+    with POSIX_FADV_DONTNEED, and from the server's segment cache with evict, rather than
+    waiting for the segments of every other hour to push it out.
+    """
+
+    def __init__(self, folder: str, segment_index: SegmentIndex, chunk_index: SegmentIndex, lock: threading.Lock,
+                 follow_journal: bool = True, evict: Optional[Callable[[str], None]] = None,
+                 horizon_seconds: float = READ_AHEAD_SECONDS, max_bytes: int = READ_AHEAD_BYTES):
+        self.folder = folder
+        self.segment_index = segment_index
+        self.chunk_index = chunk_index
+        self.lock = lock
+        self.follow_journal = follow_journal
+        self.evict = evict
+        self.horizon_seconds = horizon_seconds
+        self.max_bytes = max_bytes
+        # Last request time of each active delay, by (variant folder, delay, whether it was the playlist file).
+        # Handler threads note requests while the read ahead thread goes through them, so it has its own lock.
+        self.active: Dict[Tuple[str, int, bool], float] = {}
+        self._active_lock = threading.Lock()
+        # Byte ranges held in the page cache, by (path, offset), with their length
+        self.hot: Dict[Tuple[str, int], int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def delay_requested(self, delay_seconds: int, variant: str = '', playlist_file: bool = True):
+        """
+        Note a request for a delay's playlist
+
+        Args:
+            delay_seconds: The delay
+            variant: Folder of the extra variant whose playlist it was, '' for the station's own
+            playlist_file: Whether it was the playlist creator's file, rather than an on-demand playlist
+        """
+        with self._active_lock:
+            self.active[(variant, delay_seconds, playlist_file)] = time.time()
+
+    def wanted(self, now: float) -> Dict[Tuple[str, int], Tuple[float, Optional[int]]]:
+        """
+        Byte ranges the active delays play next, with when each is due and its length if known
+
+        Returns:
+            dict: (path, offset) to (due time, length or None for a whole file)
+        """
+        with self._active_lock:
+            for key in [key for key, requested in self.active.items() if requested <= now - ACTIVE_DELAY_SECONDS]:
+                del self.active[key]
+            active = dict(self.active)
+        active_delays_gauge.set(len(active))
+        variants = load_variants(self.folder)
+        variant_names = {variant.name for variant in variants.variants} if variants else set()
+        wanted = {}
+        with self.lock:
+            if self.follow_journal:
+                self.segment_index.refresh()
+            self.chunk_index.refresh()
+            for variant, delay_seconds, playlist_file in active:
+                if variant and variant not in variant_names:
+                    continue
+                chunks = plays_chunks(delay_seconds)
+                index = self.chunk_index if chunks else self.segment_index
+                if len(index) == 0:
+                    continue
+                window_length = config.hls_length
+                if chunks:
+                    window_length = max(window_length, 3 * index.durations[-1])
+                # The anchor the playlist is built from: the playlist creator's for its files, the oldest segment
+                # (or chunk) for on-demand playlists
+                if playlist_file:
+                    anchor = playlist_anchor(self.folder, delay_seconds, index, coalesce_segments if chunks else 1)
+                    if anchor is None:
+                        continue
+                else:
+                    anchor = index.sequences[0]
+                # From the oldest segment still in the window, to the last due within the horizon
+                delay = delay_seconds + config.buffer_period_seconds
+                folder = os.path.join(self.folder, CHUNK_FOLDER) if chunks else self.folder
+                for segment in index.window(anchor, now - delay + self.horizon_seconds,
+                                            window_length + self.horizon_seconds):
+                    if variant:
+                        key = (os.path.join(folder, variant, segment_filename(segment.sequence)), 0)
+                        length = None
+                    elif segment.byte_length is not None:
+                        key = (os.path.join(folder, segment.filename), segment.byte_offset)
+                        length = segment.byte_length
+                    else:
+                        key = (os.path.join(folder, segment.filename), 0)
+                        length = None
+                    due = segment.start_time + delay
+                    if key not in wanted or due < wanted[key][0]:
+                        wanted[key] = (due, length)
+        return wanted
+
+    def run_once(self, now: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Read ahead what the active delays play next, and drop what they no longer need
+
+        Returns:
+            tuple: Number of segments read ahead, and number dropped
+        """
+        now = time.time() if now is None else now
+        wanted = self.wanted(now)
+        hot = {}
+        used_bytes = 0
+        prefetched = 0
+        for key, (due, length) in sorted(wanted.items(), key=lambda item: item[1][0]):
+            if key in self.hot:
+                length = self.hot.pop(key)
+            else:
+                length = self.prefetch(key[0], key[1], length)
+                if length is None:
+                    continue
+                prefetched += 1
+            hot[key] = length
+            used_bytes += length
+            if used_bytes >= self.max_bytes:
+                break
+
+        # Whatever is left was read ahead for a window that has moved on, or a delay nobody listens to any more
+        for (path, offset), length in self.hot.items():
+            self.drop(path, offset, length)
+        evicted = len(self.hot)
+        self.hot = hot
+
+        read_ahead_prefetches.inc(prefetched)
+        read_ahead_evictions.inc(evicted)
+        read_ahead_segments.set(len(hot))
+        read_ahead_bytes.set(used_bytes)
+        return prefetched, evicted
+
+    def prefetch(self, path: str, offset: int, length: Optional[int]) -> Optional[int]:
+        """Ask the kernel to read a byte range into the page cache, returning its length, or None if it is gone"""
+        try:
+            with open(path, 'rb') as f:
+                if length is None:
+                    length = os.fstat(f.fileno()).st_size
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+                else:
+                    os.pread(f.fileno(), length, offset)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.error(f"Error reading ahead {path}: {str(e)}")
+            return None
+        return length
+
+    def drop(self, path: str, offset: int, length: int):
+        if self.evict:
+            self.evict(path)
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            with open(path, 'rb') as f:
+                os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error dropping {path} from the page cache: {str(e)}")
+
+    def run(self, interval: float = READ_AHEAD_INTERVAL_SECONDS):
+        while not self._stop.wait(interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Error reading ahead: {str(e)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='read-ahead', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,133 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from segment_journal import SegmentJournal
+from segment_store import segment_filename
+
+
+class RetentionManager:
+    """
+    Deletes segments once they are older than every delay needs.
+
+    Expired segments are found from the journal's segment store, so routine collection never
+    lists the output folder. The folder is only scanned by the occasional sweep, which
+    removes files the journal doesn't know about and reports disk usage. A segment's copies
+    in the folders of the station's extra variants (variant_folders, by bit in its variant
+    mask) are deleted along with it.
+    """
+
+    def __init__(self, output_dir: Path, journal: SegmentJournal, retention_seconds: float,
+                 batch_size: int = 500, collect_interval: float = 60.0, sweep_interval: float = 60 * 60.0,
+                 on_remove: Optional[Callable[[dict], None]] = None, variant_folders: Optional[List[str]] = None):
+        self.output_dir = Path(output_dir)
+        self.journal = journal
+        self.retention_seconds = retention_seconds
+        self.batch_size = batch_size
+        self.collect_interval = collect_interval
+        self.sweep_interval = sweep_interval
+        self.on_remove = on_remove
+        self.variant_folders = variant_folders if variant_folders is not None else []
+        self._next_collect = 0.0
+        self._next_sweep = 0.0
+
+    def run_if_due(self, now: float = None):
+        """Collect and sweep when their intervals have elapsed"""
+        now = time.time() if now is None else now
+        if now >= self._next_collect:
+            self._next_collect = now + self.collect_interval
+            self.collect(now)
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep(now)
+
+    def collect(self, now: float = None) -> int:
+        """
+        Delete expired segments and their journal entries, in batches
+
+        Returns:
+            int: Number of segments deleted
+        """
+        cutoff = (time.time() if now is None else now) - self.retention_seconds
+        segments = self.journal.segments
+        expired = segments.older_than(cutoff)
+        deleted = 0
+        for start in range(0, len(expired), self.batch_size):
+            filenames = set()
+            for sequence in expired[start:start + self.batch_size]:
+                segment = segments.metadata(segments.position(sequence))
+                self.journal.remove(sequence)
+                if self.on_remove:
+                    self.on_remove(segment)
+                filenames.add(segment['filename'])
+                for bit, folder in enumerate(self.variant_folders):
+                    if segment.get('variant_mask', 0) & (1 << bit):
+                        filenames.add(f"{folder}/{segment_filename(sequence)}")
+                deleted += 1
+            self.journal.sync()
+
+            # An hourly archive is only deleted once none of its segments are left
+            for filename in filenames:
+                if segments.file_in_use(filename):
+                    continue
+                try:
+                    os.unlink(self.output_dir / filename)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"Error deleting {filename}: {str(e)}")
+
+        if deleted:
+            logging.info(f"Retention deleted {deleted} segments older than {self.retention_seconds}s, "
+                         f"{len(self.journal.segments)} segments remain indexed")
+        return deleted
+
+    def sweep(self, now: float = None) -> dict:
+        """
+        Remove expired files the journal doesn't reference and report storage use
+
+        Returns:
+            dict: Segment count and bytes on disk, and the size of the journal
+        """
+        cutoff = (time.time() if now is None else now) - self.retention_seconds
+        segments = self.journal.segments
+        report = {'segments': 0, 'segment_bytes': 0, 'orphans_deleted': 0,
+                  'indexed_segments': len(segments), 'journal_bytes': 0}
+        for bit, folder in [(None, self.output_dir)] + [(bit, self.output_dir / folder)
+                                                          for bit, folder in enumerate(self.variant_folders)]:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.name == self.journal.path.name:
+                            report['journal_bytes'] = entry.stat().st_size
+                            continue
+                        if not entry.name.startswith(('segment_', 'archive_')) or not entry.name.endswith(('.aac', '.tmp')):
+                            continue
+                        stat = entry.stat()
+                        if stat.st_mtime < cutoff and not self.file_in_use(entry.name, bit):
+                            os.unlink(entry.path)
+                            report['orphans_deleted'] += 1
+                        elif entry.name.endswith('.aac'):
+                            report['segments'] += 1
+                            report['segment_bytes'] += stat.st_size
+            except OSError as e:
+                logging.error(f"Error sweeping {folder}: {str(e)}")
+
+        logging.info(f"Storage: {report['segments']} segments using {report['segment_bytes'] / 1e6:.1f} MB, "
+                     f"{report['indexed_segments']} indexed, journal {report['journal_bytes'] / 1e3:.1f} KB, "
+                     f"{report['orphans_deleted']} orphaned files deleted")
+        return report
+
+    def file_in_use(self, filename: str, variant_bit: Optional[int] = None) -> bool:
+        """Whether a file in the output folder, or in the folder of the variant with variant_bit, holds a stored segment"""
+        segments = self.journal.segments
+        if variant_bit is None:
+            return segments.file_in_use(filename)
+        # A variant's copy of a segment is named like the station's own, but the variant may not have it
+        try:
+            i = segments.position(int(filename[len('segment_'):-len('.aac')]))
+        except ValueError:
+            return False
+        return i is not None and bool(segments.variant_masks[i] & (1 << variant_bit))
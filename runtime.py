@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import playlist_creator
+import serve_http
+from heartbeat import Heartbeat, heartbeat_path
+from profiling import install_profiler
+import config
+from config import playlist_folder, PlaylistSpec, Station, coalesce_after_seconds, coalesce_segments
+from segment_downloader import IngestScheduler, SegmentDownloader
+from segment_index import SegmentIndex
+
+
+class TaskSupervisor:
+    """
+    Restarts tasks that fail, and cancels and restarts tasks that stop making progress.
+
+    The task level counterpart of main.check_process_health: a task reports progress
+    with beat(), and one that hasn't reported within its timeout is treated as stuck.
+    """
+
+    def __init__(self, restart_delay: float = 1.0):
+        self.restart_delay = restart_delay
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.timeouts: Dict[str, float] = {}
+        self.progress: Dict[str, float] = {}
+
+    def beat(self, name: str):
+        self.progress[name] = time.monotonic()
+
+    async def supervise(self, name: str, factory: Callable[[], Awaitable], timeout_seconds: Optional[float] = None):
+        """Run the coroutine factory makes, restarting it whenever it stops"""
+        if timeout_seconds:
+            self.timeouts[name] = timeout_seconds
+        while True:
+            self.beat(name)
+            task = asyncio.create_task(factory(), name=name)
+            self.tasks[name] = task
+            try:
+                await task
+                logging.warning(f"{name} task stopped, restarting...")
+            except asyncio.CancelledError:
+                # Shutting down, rather than the watchdog cancelling a stuck task
+                if asyncio.current_task().cancelling():
+                    raise
+                logging.warning(f"Restarting {name} task...")
+            except Exception as e:
+                logging.error(f"{name} task failed, restarting: {str(e)}")
+            await asyncio.sleep(self.restart_delay)
+
+    async def watchdog(self, check_interval: float = 1.0):
+        while True:
+            await asyncio.sleep(check_interval)
+            now = time.monotonic()
+            for name, timeout_seconds in self.timeouts.items():
+                task = self.tasks.get(name)
+                if task and not task.done() and now - self.progress[name] > timeout_seconds:
+                    logging.warning(f"No progress from {name} in {timeout_seconds} seconds. It may be stuck.")
+                    task.cancel()
+
+
+class UnifiedRuntime:
+    """
+    Ingest, playlist generation and serving in one process, around one segment index per station.
+
+    Committed segments go straight into the station's index rather than through the journal
+    and a second process tailing it, and the playlist task is woken directly. Blocking
+    work stays off the event loop: ingest runs on its own worker thread and the HTTP
+    server on its thread pool, so the indexes are only touched under index_lock.
+    """
+
+    def __init__(self, playlists_spec: List[PlaylistSpec], port: int = serve_http.PORT,
+                 retention_seconds: Optional[float] = None, storage: str = 'files', check_interval: float = 3,
+                 stall_timeout_seconds: float = 60, stations: Optional[List[Station]] = None):
+        self.stations = stations or config.stations
+        self.port = port
+        # Without a retention period of its own, the runtime keeps the one config.py works out from the delays
+        self.retention_seconds = retention_seconds
+        self.storage = storage
+        self.check_interval = check_interval
+        self.stall_timeout_seconds = stall_timeout_seconds
+        self.index_lock = threading.Lock()
+        # Every station gets its own copy of the delays, and its own index, by station name
+        self.playlists_specs = {station.name: [replace(spec) for spec in playlists_spec] for station in self.stations}
+        self.segment_indexes = {station.name: SegmentIndex(Path(station.folder) / 'segment_journal.jsonl')
+                                for station in self.stations}
+        self.supervisor = TaskSupervisor()
+        # One worker, so a restarted ingest task queues behind a poll that is still stuck
+        self.ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+        self.scheduler = IngestScheduler()
+        self.server = None
+        self.loop = None
+        self.segments_committed = None
+        # The settings the playlists were last reconciled with, to notice changes to the settings file
+        self.playlists_generation = config.generation
+
+    def segment_committed(self, station_name: str, metadata: dict):
+        """Called on the ingest thread as each segment is committed"""
+        with self.index_lock:
+            self.segment_indexes[station_name].add(metadata['sequence'], metadata['timestamp'], metadata['duration'],
+                                                   metadata['filename'], metadata.get('byte_offset'),
+                                                   metadata.get('byte_length'), metadata.get('variant_mask', 0))
+        self.loop.call_soon_threadsafe(self.segments_committed.set)
+
+    def segment_removed(self, station_name: str, segment: dict):
+        with self.index_lock:
+            self.segment_indexes[station_name].remove(segment['sequence'])
+
+    def create_downloaders(self):
+        for station in self.stations:
+            SegmentDownloader(output_dir=station.folder, master_url=station.url, name=station.name,
+                              variants_url=station.variants_url,
+                              retention_seconds=self.retention_seconds or config.retention_seconds,
+                              storage=self.storage, scheduler=self.scheduler,
+                              coalesce_after=coalesce_after_seconds, coalesce_segments=coalesce_segments,
+                              coalesced_retention_seconds=config.coalesced_retention_seconds,
+                              on_commit=functools.partial(self.segment_committed, station.name),
+                              on_remove=functools.partial(self.segment_removed, station.name))
+
+    def poll_once(self):
+        """Poll every station, on the ingest thread, after following any change to the settings"""
+        self.scheduler.follow_config(self.retention_seconds)
+        self.scheduler.poll_once(self.check_interval)
+
+    async def ingest(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(self.ingest_executor, self.poll_once)
+            self.supervisor.beat('ingest')
+
+    async def playlists(self):
+        heartbeat = Heartbeat(heartbeat_path(playlist_folder, 'playlist_creator'))
+        saved_specs = {}
+        last_checkpoint = time.monotonic()
+        while True:
+            # Cleared before updating, so a segment committed during the update wakes us straight away
+            self.segments_committed.clear()
+            wake_times = []
+            config.reload_if_changed()
+            with self.index_lock:
+                if self.playlists_generation != config.generation:
+                    self.playlists_generation = config.generation
+                    for station in self.stations:
+                        self.playlists_specs[station.name] = playlist_creator.reconcile_playlists(
+                            self.playlists_specs[station.name], config.delays_seconds, station)
+                for station in self.stations:
+                    wake_times.append(playlist_creator.update_playlists(
+                        self.playlists_specs[station.name], self.segment_indexes[station.name], station))
+                indexed_segments = sum(len(segment_index) for segment_index in self.segment_indexes.values())
+            # Blocked playlist reloads can be answered as soon as the files are rewritten
+            self.server.playlist_generator.playlists_changed()
+            active_playlists = sum(spec.is_initalised for specs in self.playlists_specs.values() for spec in specs)
+            heartbeat.beat(force=True, active_playlists=active_playlists, indexed_segments=indexed_segments)
+            spec_changed = False
+            for station in self.stations:
+                spec = playlist_creator.save_playlist_spec(self.playlists_specs[station.name],
+                                                           saved_specs.get(station.name), station)
+                spec_changed = spec_changed or spec != saved_specs.get(station.name)
+                saved_specs[station.name] = spec
+            if spec_changed or time.monotonic() - last_checkpoint >= playlist_creator.checkpoint_interval_seconds:
+                self.checkpoint()
+                last_checkpoint = time.monotonic()
+            self.supervisor.beat('playlists')
+
+            # Sleep until the next playlist window moves, or a new segment arrives
+            try:
+                await asyncio.wait_for(self.segments_committed.wait(),
+                                       min(wake_times) - time.time() + playlist_creator.wake_margin_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def checkpoint(self):
+        # Segments are added to the indexes directly, so catch their journal positions up first. Records the
+        # hooks have already applied (or are about to) apply idempotently.
+        with self.index_lock:
+            for station in self.stations:
+                segment_index = self.segment_indexes[station.name]
+                segment_index.refresh()
+                playlist_creator.checkpoint_playlists(self.playlists_specs[station.name], segment_index, station)
+
+    async def serve(self):
+        try:
+            await asyncio.to_thread(self.server.serve_forever)
+        finally:
+            self.server.shutdown()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.segments_committed = asyncio.Event()
+        main_task = asyncio.current_task()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, main_task.cancel)
+        # SIGUSR1 profiles the whole runtime, its worker threads included
+        install_profiler(playlist_folder, 'runtime')
+
+        # Opening a journal can migrate or compact it, so the indexes are loaded after the downloaders start
+        await self.loop.run_in_executor(self.ingest_executor, self.create_downloaders)
+        with self.index_lock:
+            for station in self.stations:
+                playlist_creator.restore_playlists(self.playlists_specs[station.name],
+                                                   self.segment_indexes[station.name], station)
+        # On-demand playlists are for the first station, stations recorded into its subfolders are served as files
+        primary = self.stations[0]
+        generator = serve_http.PlaylistGenerator(primary.folder, segment_index=self.segment_indexes[primary.name],
+                                                 lock=self.index_lock)
+        self.server = serve_http.StreamServer(('', self.port), primary.folder, log_requests=False,
+                                              playlist_generator=generator)
+        logging.info(f"Started unified runtime, serving {playlist_folder} at port {self.port}")
+
+        try:
+            await asyncio.gather(
+                self.supervisor.supervise('ingest', self.ingest, self.stall_timeout_seconds),
+                self.supervisor.supervise('playlists', self.playlists, self.stall_timeout_seconds),
+                self.supervisor.supervise('serve', self.serve),
+                self.supervisor.watchdog(),
+            )
+        except asyncio.CancelledError:
+            logging.info("Stopping unified runtime")
+        finally:
+            self.server.server_close()
+            # Let a poll in progress finish before closing the journal under it
+            self.ingest_executor.shutdown(wait=True, cancel_futures=True)
+            self.scheduler.close()
+            self.checkpoint()
+
+
+def run_unified(playlists_spec: List[PlaylistSpec], **kwargs):
+    """Run ingest, playlist generation and serving in this process until terminated"""
+    asyncio.run(UnifiedRuntime(playlists_spec, **kwargs).run())
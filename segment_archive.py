@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Tuple
+
+
+def archive_name(timestamp: float) -> str:
+    """Name of the archive holding segments broadcast in the same UTC hour as timestamp"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('archive_%Y%m%d%H.aac')
+
+
+class SegmentArchive:
+    """
+    Appends raw segment bytes into one archive file per hour of broadcast.
+
+    ADTS AAC frames are self-delimiting, so each segment stays independently playable as a
+    byte range of its archive. This keeps the output folder to a handful of files, and
+    retention deletes a whole hour at once.
+    """
+
+    def __init__(self, output_dir: Path, max_open: int = 2):
+        self.output_dir = Path(output_dir)
+        self.max_open = max_open
+        self._files: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, data: bytes) -> Tuple[str, int, int]:
+        """
+        Append a segment to its hour's archive
+
+        Returns:
+            tuple: Archive filename, byte offset and byte length of the segment
+        """
+        name = archive_name(timestamp)
+        with self._lock:
+            f = self._open(name)
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+            f.flush()
+            # Make the bytes durable before the journal can reference them
+            os.fsync(f.fileno())
+        return name, offset, len(data)
+
+    def _open(self, name: str):
+        f = self._files.get(name)
+        if f is None:
+            f = open(self.output_dir / name, 'ab')
+            self._files[name] = f
+            # Late segments may still land in the previous hour, older archives can be closed
+            while len(self._files) > self.max_open:
+                oldest = min(self._files)
+                logging.info(f"Closing archive {oldest}")
+                self._files.pop(oldest).close()
+        return f
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
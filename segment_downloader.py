@@ -1,16 +1,30 @@
 import time
-import m3u8
+import hashlib
 import requests
 from pathlib import Path
 import logging
-import json
 import os
-from typing import Set, Dict, Optional
-from urllib.parse import urljoin
-from dataclasses import dataclass
-from datetime import datetime
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urljoin, urlsplit
+from dataclasses import dataclass, field
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
+from segment_journal import SegmentJournal
+from media_playlist import MediaPlaylist, parse_media_playlist, parse_master_playlist
+from segment_store import SegmentStore, segment_filename
+from retention import RetentionManager
+from coalesce import Coalescer
+from segment_archive import SegmentArchive
+from segment_events import SegmentEventNotifier
+from variants import MAX_VARIANTS, StationVariants, Variant, load_variants, save_variants, variant_name
+from heartbeat import Heartbeat, heartbeat_path
+from metrics import registry, start_metrics_server
+from profiling import install_profiler, timed, timed_stage
+import config
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +35,26 @@ logging.basicConfig(
     level=logging.DEBUG
 )
 
+playlist_fetch_seconds = registry.histogram('jdelay_playlist_fetch_seconds', "Time to fetch and parse the origin playlist",
+                                            ['station'])
+playlist_fetch_retries = registry.counter('jdelay_playlist_fetch_retries_total', "Origin playlist fetches retried", ['station'])
+playlist_fetches = registry.counter('jdelay_playlist_fetches_total',
+                                    "Origin playlist fetches, by whether the origin sent a new playlist and it had changed",
+                                    ['station', 'result'])
+segment_download_seconds = registry.histogram('jdelay_segment_download_seconds', "Time to download and store a segment",
+                                              ['station'])
+segment_download_bytes = registry.counter('jdelay_segment_download_bytes_total', "Bytes of segments downloaded", ['station'])
+segment_download_retries = registry.counter('jdelay_segment_download_retries_total', "Segment downloads retried", ['station'])
+segment_download_failures = registry.counter('jdelay_segment_download_failures_total',
+                                             "Segments given up on after every retry", ['station'])
+download_queue_depth = registry.gauge('jdelay_download_queue_depth', "Segment downloads queued or in flight", ['station'])
+indexed_segments = registry.gauge('jdelay_downloader_indexed_segments', "Segments recorded in the journal", ['station'])
+variant_download_failures = registry.counter('jdelay_variant_download_failures_total',
+                                             "Segments of extra variants given up on, and left as gaps", ['station', 'variant'])
+
+# How often the origin's master playlist is reloaded for changes to its variants
+variants_refresh_seconds = 60 * 60
+
 @dataclass
 class SegmentInfo:
     url: str
@@ -28,18 +62,49 @@ class SegmentInfo:
     timestamp: float
     sequence: int
     filename: str
+    byte_offset: Optional[int] = None
+    byte_length: Optional[int] = None
+    variant_mask: int = 0
+
+@dataclass
+class VariantPlaylist:
+    """An extra variant of a station, and what its media playlist last told us"""
+    variant: Variant
+    # Media playlist URL, or None if the origin no longer lists the variant
+    url: Optional[str]
+    etag: Optional[str] = None
+    digest: Optional[bytes] = None
+    # Segment URLs by media sequence number
+    segment_urls: Dict[int, str] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+def same_playlist(url: str, other: str) -> bool:
+    """Whether two URLs name the same playlist, ignoring query strings"""
+    return urlsplit(url)[:3] == urlsplit(other)[:3]
+
+class IngestScheduler:
+    """
+    Multiplexes the playlist reloads and segment downloads of every station.
+
+    Stations share one requests.Session, so one connection pool, and one pool of download
+    workers. Each station only adds its journal, its pending downloads and a timer for its
+    next playlist reload. Requests to the same host are limited to max_per_host at a time,
+    however many stations it serves.
+    """
+
+    def __init__(self, max_retries: int = 5, initial_backoff: float = 1.0, max_workers: int = 16,
+                 max_per_host: int = 8):
+        self.max_per_host = max_per_host
+        self.stations: List['SegmentDownloader'] = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        # Playlist reloads in flight, with the time each started
+        self.pending_polls: Dict['SegmentDownloader', Tuple[float, Future]] = {}
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+        # The settings the stations were last reconfigured with, see follow_config
+        self.config_generation = config.generation
 
-class SegmentDownloader:
-    def __init__(self, output_dir: str = './output/', max_retries: int = 5, initial_backoff: float = 1.0):
-        self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(exist_ok=True)
-        self.master_url = 'https://mediaserviceslive.akamaized.net/hls/live/2109456/triplejnsw/v0-221.m3u8'
-        self.fetched_segments: Set[str] = set()
-        self.segment_metadata: Dict[str, SegmentInfo] = {}
-        self.segment_info_file = self.output_dir / 'segment_info.json'
-        self.max_retries = max_retries
-        self.initial_backoff = initial_backoff
-        
         # Configure retry strategy
         retry_strategy = Retry(
             total=max_retries,
@@ -47,165 +112,654 @@ class SegmentDownloader:
             status_forcelist=[500, 502, 503, 504],
         )
         self.session = requests.Session()
-        self.session.mount("http://", HTTPAdapter(max_retries=retry_strategy))
-        self.session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
-        
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def add(self, station: 'SegmentDownloader'):
+        self.stations.append(station)
+
+    def host_slot(self, url: str) -> threading.BoundedSemaphore:
+        """Semaphore to hold while talking to url's host"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return slot
+
+    def poll_once(self, check_interval: float = 3):
+        """
+        Reload the playlist of every station that is due, then commit downloads as they complete
+        until the next reload is due
+        """
+        now = time.monotonic()
+        for station in self.stations:
+            if station.next_poll <= now and station not in self.pending_polls:
+                logging.info(f"Fetching playlist from {station.master_url}")
+                self.pending_polls[station] = (now, self.executor.submit(station.fetch_playlist, station.master_url))
+
+        deadline = min((station.next_poll for station in self.stations if station not in self.pending_polls),
+                       default=now + check_interval)
+        while True:
+            for station, (started, future) in list(self.pending_polls.items()):
+                if future.done():
+                    del self.pending_polls[station]
+                    station.queue_segments(future.result())
+                    # Until the playlist has told us its target duration, poll every check_interval
+                    station.next_poll = started + (station.poll_interval or check_interval)
+                    deadline = min(deadline, station.next_poll)
+            for station in self.stations:
+                if station.commit_segments():
+                    station.segment_events.notify()
+
+            # A finished download can be held back behind one still in flight, so only wait on those
+            futures = [future for _, future in self.pending_polls.values()]
+            for station in self.stations:
+                futures.extend(future for future in station.pending_downloads.values() if not future.done())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not futures:
+                time.sleep(remaining)
+                break
+            wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+
+        for station in self.stations:
+            station.maintain()
+
+    def follow_config(self, retention_seconds: Optional[float] = None):
+        """
+        Apply changes to the settings file to every station: its origin URL, and the retention periods the delays need
+
+        Args:
+            retention_seconds: Retention period to keep to, rather than the one config.py works out from the delays
+        """
+        config.reload_if_changed()
+        if self.config_generation == config.generation:
+            return
+        self.config_generation = config.generation
+        for station in self.stations:
+            station.reconfigure(config.station_url(station.name) or station.master_url,
+                                retention_seconds or config.retention_seconds, config.coalesced_retention_seconds)
+
+    def run(self, check_interval: int = 3, follow_config: bool = False):
+        """Download every station until interrupted, following changes to the settings file if follow_config"""
+        logging.info(f"Starting segment downloader for {', '.join(station.name for station in self.stations)}")
+        try:
+            while True:
+                if follow_config:
+                    self.follow_config()
+                self.poll_once(check_interval)
+        except KeyboardInterrupt:
+            logging.info("Stopping segment downloader")
+        except Exception as e:
+            logging.error(f"Error in main loop: {str(e)}")
+        finally:
+            self.close()
+
+    def close(self):
+        """Abandon downloads in flight and close every station's journal"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for station in self.stations:
+            station.close()
+
+
+class SegmentDownloader:
+    """
+    Downloads one station into its own output folder and journal.
+
+    Without a scheduler the station gets one of its own, otherwise it shares the
+    scheduler's connection pool and download workers with the other stations.
+
+    Given the origin's master playlist as variants_url, every other variant it lists is
+    recorded too, into a subfolder of its own. Each variant's segment is downloaded by the
+    same task as the station's own, so a segment is only committed once every variant has
+    it or has given up on it, and the journal records which variants have it.
+
+    Given coalesce_after, segments older than that are merged into chunks of coalesce_segments
+    (see coalesce.py) for long delays to play.
+    """
+
+    def __init__(self, output_dir: str = './output/', max_retries: int = 5, initial_backoff: float = 1.0,
+                 max_concurrent_downloads: int = 8, retention_seconds: Optional[float] = None,
+                 storage: str = 'files', on_commit: Optional[Callable[[dict], None]] = None,
+                 on_remove: Optional[Callable[[dict], None]] = None,
+                 master_url: str = 'https://mediaserviceslive.akamaized.net/hls/live/2109456/triplejnsw/v0-221.m3u8',
+                 name: str = 'triplejnsw', scheduler: Optional[IngestScheduler] = None,
+                 variants_url: Optional[str] = None, coalesce_after: Optional[float] = None,
+                 coalesce_segments: int = 6, coalesced_retention_seconds: Optional[float] = None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.master_url = master_url
+        self.name = name
+        # Segments downloaded and recorded in the journal, by sequence number
+        self.segments = SegmentStore()
+        self.segment_info_file = self.output_dir / 'segment_info.json'
+        self.journal = SegmentJournal(self.output_dir / 'segment_journal.jsonl')
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        # 'files' writes one file per segment, 'archive' appends segments to hourly archive files
+        self.archive = SegmentArchive(self.output_dir) if storage == 'archive' else None
+
+        if scheduler is None:
+            scheduler = IngestScheduler(max_retries, initial_backoff, max_concurrent_downloads, max_concurrent_downloads)
+        self.scheduler = scheduler
+        self.session = scheduler.session
+        self.executor = scheduler.executor
+        scheduler.add(self)
+
+        # Downloads in flight, keyed by sequence so they can be committed in order
+        self.pending_downloads: Dict[int, Future] = {}
+        self.pending_segments: Dict[int, SegmentInfo] = {}
+        self.poll_interval: Optional[float] = None
+        # Monotonic time the scheduler next reloads this station's playlist
+        self.next_poll = 0.0
+        # The last playlist fetched, its validators and a hash of its body, so an unchanged playlist
+        # is neither sent again nor parsed again
+        self.playlist: Optional[MediaPlaylist] = None
+        self.playlist_text = ''
+        self.playlist_parsed_after = -1
+        self.playlist_etag: Optional[str] = None
+        self.playlist_last_modified: Optional[str] = None
+        self.playlist_digest: Optional[bytes] = None
+        self.playlist_fetched_at = 0.0
+        # Playlists are only parsed after this sequence: every segment up to it is downloaded or queued,
+        # except failed ones, which hold it back so they are retried
+        self.parse_after = -1
+        self.failed_sequences: Set[int] = set()
+        # Wakes the playlist creator as soon as segments are committed
+        self.segment_events = SegmentEventNotifier(self.output_dir / 'segment_events.sock')
+        # Progress report for the supervisor's health checks
+        self.heartbeat = Heartbeat(heartbeat_path(self.output_dir, 'segment_downloader'))
+        # Called with each segment's metadata as it is committed to, or removed from, the journal
+        self.on_commit = on_commit
+        self.on_remove = on_remove
+        # Extra variants, in the order of their bits in the variant mask, with their folder names alongside
+        self.variants_url = variants_url
+        self.variants: List[VariantPlaylist] = []
+        self.variant_names: List[str] = []
+        self.variants_fetched_at: Optional[float] = None
+        if variants_url:
+            self.load_variants()
+
         self.load_segment_info()
 
+        # Once segments are coalesced into chunks, the chunks are kept for the retention period instead,
+        # and the segments only for as long as coalesced_retention_seconds
+        self.coalescer = None
+        if coalesce_after:
+            self.coalescer = Coalescer(self.output_dir, self.journal, coalesce_after, coalesce_segments,
+                                       retention_seconds, variant_folders=self.variant_names)
+            retention_seconds = coalesced_retention_seconds or retention_seconds
+
+        # Without a retention period, segments are kept forever
+        self.retention = None
+        if retention_seconds:
+            self.retention = RetentionManager(self.output_dir, self.journal, retention_seconds,
+                                              on_remove=self.segment_removed, variant_folders=self.variant_names)
+
+    def reconfigure(self, master_url: str, retention_seconds: Optional[float],
+                    coalesced_retention_seconds: Optional[float] = None):
+        """
+        Follow a new origin URL or retention period, leaving downloads in flight and the journal as they are
+
+        A longer retention period keeps segments from now on, a shorter one deletes the
+        segments past it on the next retention pass.
+        """
+        if master_url != self.master_url:
+            logging.info(f"Origin of {self.name} changed from {self.master_url} to {master_url}")
+            self.master_url = master_url
+            # The next reload is unconditional and parsed in full, the validators were the old origin's
+            self.playlist = None
+            self.playlist_etag = self.playlist_last_modified = self.playlist_digest = None
+        if self.coalescer:
+            if self.coalescer.retention and retention_seconds:
+                self.coalescer.retention.retention_seconds = retention_seconds
+            retention_seconds = coalesced_retention_seconds or retention_seconds
+        if self.retention and retention_seconds and retention_seconds != self.retention.retention_seconds:
+            logging.info(f"Keeping {self.name} segments for {retention_seconds}s, was {self.retention.retention_seconds}s")
+            self.retention.retention_seconds = retention_seconds
+
+    def segment_removed(self, segment: dict):
+        if self.on_remove:
+            self.on_remove(segment)
+
     def load_segment_info(self):
-        """Load previously fetched segment information"""
+        """Replay the segment journal, migrating segment_info.json on first start"""
         try:
-            if self.segment_info_file.exists():
-                with open(self.segment_info_file, 'r') as f:
-                    data = json.load(f)
-                    self.fetched_segments = set(data.get('fetched_segments', []))
-                    self.segment_metadata = data.get('segment_metadata', {})
-                logging.info(f"Loaded {len(self.fetched_segments)} previously fetched segments")
+            self.segments = self.journal.open(legacy_file=self.segment_info_file)
+            logging.info(f"Loaded {len(self.segments)} previously fetched segments for {self.name}")
         except Exception as e:
             logging.error(f"Error loading segment info: {str(e)}")
 
     def save_segment_info(self):
-        """Save fetched segment information using atomic file operations"""
+        """Flush the segment journal to stable storage"""
         try:
-            # Create temporary file in the same directory
-            temp_file = self.segment_info_file.with_suffix('.json.tmp')
-            
-            # Write to temporary file
-            with open(temp_file, 'w') as f:
-                json.dump({
-                    'fetched_segments': list(self.fetched_segments),
-                    'segment_metadata': self.segment_metadata,
-                    'last_updated': datetime.now().isoformat()
-                }, f)
-            
-            # Atomic rename operation
-            temp_file.replace(self.segment_info_file)
-            
+            self.journal.sync()
         except Exception as e:
             logging.error(f"Error saving segment info: {str(e)}")
-            # Clean up temp file if it exists
-            if temp_file.exists():
-                temp_file.unlink()
 
-    def fetch_playlist(self, url: str) -> Optional[m3u8.M3U8]:
-        """Fetch and parse a playlist with retry logic"""
+    def load_variants(self):
+        """Pick up the variants recorded before a restart, so they keep their bits"""
+        station_variants = load_variants(self.output_dir)
+        if station_variants:
+            for variant in station_variants.variants:
+                self.add_variant(variant, None)
+
+    def add_variant(self, variant: Variant, url: Optional[str]):
+        (self.output_dir / variant.name).mkdir(exist_ok=True)
+        self.variants.append(VariantPlaylist(variant, url))
+        self.variant_names.append(variant.name)
+
+    def fetch_variants(self):
+        """Reload the origin's master playlist, adding any variants not seen before"""
+        self.variants_fetched_at = time.monotonic()
+        try:
+            with self.scheduler.host_slot(self.variants_url):
+                response = self.session.get(self.variants_url, timeout=(5, 30))
+            response.raise_for_status()
+            streams = parse_master_playlist(response.content.decode('utf-8'))
+        except Exception as e:
+            logging.error(f"Error fetching variants from {self.variants_url}: {str(e)}")
+            # Try again on the next poll
+            self.variants_fetched_at = None
+            return
+
+        primary = None
+        listed = {}
+        for stream in streams:
+            url = urljoin(self.variants_url, stream.uri)
+            variant = Variant(variant_name(url), stream.bandwidth, stream.average_bandwidth, stream.codecs)
+            if same_playlist(url, self.master_url):
+                primary = variant._replace(name='')
+            else:
+                listed[variant.name] = (variant, url)
+        if primary is None:
+            logging.warning(f"{self.master_url} isn't listed in {self.variants_url}, not recording other variants")
+            return
+
+        # Known variants keep their bit, even if the origin has stopped listing them
+        for variant_playlist in self.variants:
+            variant_playlist.variant, variant_playlist.url = listed.pop(variant_playlist.variant.name,
+                                                                        (variant_playlist.variant, None))
+        for variant, url in listed.values():
+            if len(self.variants) >= MAX_VARIANTS:
+                logging.warning(f"Not recording {variant.name}, {self.name} already has {MAX_VARIANTS} variants")
+                continue
+            logging.info(f"Recording variant {variant.name} of {self.name} at {variant.bandwidth} bps")
+            self.add_variant(variant, url)
+
+        station_variants = StationVariants(primary, [variant_playlist.variant for variant_playlist in self.variants])
+        if station_variants != load_variants(self.output_dir):
+            save_variants(self.output_dir, station_variants)
+
+    def fetch_variant_playlist(self, variant_playlist: VariantPlaylist):
+        """Reload a variant's media playlist, if it has changed, to learn its newest segment URLs"""
+        headers = {'If-None-Match': variant_playlist.etag} if variant_playlist.etag else {}
+        with self.scheduler.host_slot(variant_playlist.url):
+            response = self.session.get(variant_playlist.url, headers=headers, timeout=(5, 30))
+        response.raise_for_status()
+        if response.status_code == 304:
+            return
+        variant_playlist.etag = response.headers.get('ETag')
+        digest = hashlib.blake2b(response.content, digest_size=16).digest()
+        if digest == variant_playlist.digest:
+            return
+        variant_playlist.digest = digest
+        playlist = parse_media_playlist(response.content.decode('utf-8'))
+        variant_playlist.segment_urls = {segment.media_sequence: urljoin(variant_playlist.url, segment.uri)
+                                         for segment in playlist.segments}
+
+    def download_variant_segment(self, variant_playlist: VariantPlaylist, sequence: int) -> bool:
+        """Download a variant's copy of a segment into the variant's folder, with retry logic"""
+        output_path = os.path.join(self.output_dir, variant_playlist.variant.name, segment_filename(sequence))
+        if os.path.exists(output_path):
+            return True
+
         for attempt in range(self.max_retries):
             try:
-                response = self.session.get(url)
+                # Variant playlists are only reloaded when they don't list a segment we need yet
+                with variant_playlist.lock:
+                    url = variant_playlist.segment_urls.get(sequence)
+                    if url is None and variant_playlist.url:
+                        self.fetch_variant_playlist(variant_playlist)
+                        url = variant_playlist.segment_urls.get(sequence)
+                if url is None:
+                    raise ValueError(f"{variant_playlist.variant.name} doesn't list segment {sequence}")
+                started = time.perf_counter()
+                with self.scheduler.host_slot(url):
+                    response = self.session.get(url, stream=True, timeout=(5, 30))
+                    response.raise_for_status()
+                    size = self.save_response(response, output_path)
+                segment_download_seconds.observe(time.perf_counter() - started, station=self.name)
+                segment_download_bytes.inc(size, station=self.name)
+                return True
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    logging.error(f"Failed to download segment {sequence} of {variant_playlist.variant.name} "
+                                  f"after {self.max_retries} attempts: {str(e)}")
+                    variant_download_failures.inc(station=self.name, variant=variant_playlist.variant.name)
+                    return False
+                segment_download_retries.inc(station=self.name)
+                time.sleep(self.initial_backoff * (2 ** attempt))
+
+    def download(self, segment_info: SegmentInfo) -> bool:
+        """Download a segment, then every extra variant's copy of it, recording which variants have it"""
+        if not self.download_segment(segment_info):
+            return False
+        for bit, variant_playlist in enumerate(list(self.variants)):
+            if variant_playlist.url and self.download_variant_segment(variant_playlist, segment_info.sequence):
+                segment_info.variant_mask |= 1 << bit
+        return True
+
+    def playlist_url(self, url: str) -> str:
+        """The playlist URL to reload, asking for a delta update (RFC 8216bis 6.2.5.1) if we can use one"""
+        playlist = self.playlist
+        # Only while every segment the origin would skip is one we already have
+        if (playlist is not None and playlist.can_skip_until and not self.failed_sequences
+                and time.monotonic() - self.playlist_fetched_at < playlist.can_skip_until / 2):
+            return url + ('&' if '?' in url else '?') + '_HLS_skip=YES'
+        return url
+
+    @timed_stage('fetch_playlist')
+    def fetch_playlist(self, url: str) -> Optional[MediaPlaylist]:
+        """
+        Fetch and parse a playlist with retry logic
+
+        The request is conditional on the last response's validators, and a body identical
+        to the last one isn't parsed again, so a playlist that hasn't changed costs a 304
+        or a hash rather than a parse.
+        """
+        if self.variants_url and (self.variants_fetched_at is None
+                                  or time.monotonic() - self.variants_fetched_at >= variants_refresh_seconds):
+            self.fetch_variants()
+        url = self.playlist_url(url)
+        headers = {}
+        if self.playlist is not None:
+            if self.playlist_etag:
+                headers['If-None-Match'] = self.playlist_etag
+            if self.playlist_last_modified:
+                headers['If-Modified-Since'] = self.playlist_last_modified
+        for attempt in range(self.max_retries):
+            try:
+                started = time.perf_counter()
+                with self.scheduler.host_slot(url):
+                    response = self.session.get(url, headers=headers)
                 response.raise_for_status()
-                return m3u8.loads(response.text)
+                self.playlist_fetched_at = time.monotonic()
+                if response.status_code == 304 and self.playlist is not None:
+                    result = 'not_modified'
+                else:
+                    self.playlist_etag = response.headers.get('ETag')
+                    self.playlist_last_modified = response.headers.get('Last-Modified')
+                    digest = hashlib.blake2b(response.content, digest_size=16).digest()
+                    result = 'unchanged' if digest == self.playlist_digest and self.playlist is not None else 'changed'
+                    if result == 'changed':
+                        # Playlists are always UTF-8 (RFC 8216 4.1), so skip requests' charset detection
+                        self.playlist_text, self.playlist_digest = response.content.decode('utf-8'), digest
+                        self.playlist = None
+                # Parsed again if a failed download has held parse_after back since it was last parsed
+                if self.playlist is None or self.parse_after < self.playlist_parsed_after:
+                    self.playlist_parsed_after = self.parse_after
+                    with timed('parse_playlist'):
+                        self.playlist = parse_media_playlist(self.playlist_text, self.playlist_parsed_after)
+                playlist_fetches.inc(station=self.name, result=result)
+                playlist_fetch_seconds.observe(time.perf_counter() - started, station=self.name)
+                return self.playlist
             except Exception as e:
                 if attempt == self.max_retries - 1:
                     logging.error(f"Failed to fetch playlist after {self.max_retries} attempts: {str(e)}")
                     return None
+                playlist_fetch_retries.inc(station=self.name)
                 backoff = self.initial_backoff * (2 ** attempt)  # Exponential backoff
                 logging.warning(f"Attempt {attempt + 1} failed to fetch playlist. Retrying in {backoff} seconds...")
                 time.sleep(backoff)
 
+    @timed_stage('download_segment')
     def download_segment(self, segment_info: SegmentInfo) -> bool:
         """Download a single segment with retry logic"""
         output_path = os.path.join(self.output_dir, segment_info.filename)
-        if os.path.exists(output_path):
+        if self.archive is None and os.path.exists(output_path):
             logging.debug(f"Segment already exists: {segment_info.filename}")
             return True
 
         for attempt in range(self.max_retries):
             try:
-                # Add timeout to prevent hanging on slow connections
-                response = self.session.get(segment_info.url, stream=True, timeout=(5, 30))
-                response.raise_for_status()
-                
-                # Use a temporary file for atomic writes
-                temp_path = output_path + '.tmp'
-                try:
-                    with open(temp_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    # Atomic rename
-                    os.replace(temp_path, output_path)
-                finally:
-                    # Clean up temp file if something went wrong
-                    if os.path.exists(temp_path):
-                        os.unlink(temp_path)
-                
+                started = time.perf_counter()
+                # The body is streamed, so the host's slot is held until it has all been read
+                with self.scheduler.host_slot(segment_info.url):
+                    # Add timeout to prevent hanging on slow connections
+                    response = self.session.get(segment_info.url, stream=True, timeout=(5, 30))
+                    response.raise_for_status()
+
+                    if self.archive is not None:
+                        # Buffer the whole segment so it lands in the archive in one append
+                        data = b''.join(response.iter_content(chunk_size=65536))
+                        segment_info.filename, segment_info.byte_offset, segment_info.byte_length = \
+                            self.archive.append(segment_info.timestamp, data)
+                        segment_download_seconds.observe(time.perf_counter() - started, station=self.name)
+                        segment_download_bytes.inc(len(data), station=self.name)
+                        logging.info(f"Archived segment {segment_info.sequence} in {segment_info.filename}")
+                        return True
+
+                    size = self.save_response(response, output_path)
+
+                segment_download_seconds.observe(time.perf_counter() - started, station=self.name)
+                segment_download_bytes.inc(size, station=self.name)
                 logging.info(f"Downloaded segment: {segment_info.filename}")
                 return True
             except Exception as e:
                 if attempt == self.max_retries - 1:
                     logging.error(f"Failed to download segment {segment_info.url} after {self.max_retries} attempts: {str(e)}")
+                    segment_download_failures.inc(station=self.name)
                     return False
+                segment_download_retries.inc(station=self.name)
                 backoff = self.initial_backoff * (2 ** attempt)  # Exponential backoff
                 logging.warning(f"Attempt {attempt + 1} failed to download segment. Retrying in {backoff} seconds...")
                 time.sleep(backoff)
 
+    def save_response(self, response: requests.Response, output_path: str) -> int:
+        """
+        Stream a response body into a file
+
+        Returns:
+            int: Bytes written
+        """
+        # Use a temporary file for atomic writes
+        temp_path = output_path + '.tmp'
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+                        size += len(chunk)
+            # Atomic rename
+            os.replace(temp_path, output_path)
+        finally:
+            # Clean up temp file if something went wrong
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        return size
+
     def process_segments(self):
-        """Process and download new segments"""
+        """Poll the playlist and start downloading any new segments"""
+        logging.info(f"Fetching playlist from {self.master_url}")
+        self.queue_segments(self.fetch_playlist(self.master_url))
+
+    @timed_stage('queue_segments')
+    def queue_segments(self, playlist: Optional[MediaPlaylist]):
+        """Start downloading the segments of a freshly fetched playlist that we don't have yet"""
         try:
-            # Fetch playlist
-            logging.info(f"Fetching playlist from {self.master_url}")
-            playlist = self.fetch_playlist(self.master_url)
             if not playlist:
                 return
+            self.heartbeat.beat(last_poll_time=time.time())
 
             base_url = self.master_url.rsplit('/', 1)[0] + '/'
             new_segments = 0
 
-
-            # Process segments
+            # Queue segments, each download retries on its own worker without holding up the others
             for segment in playlist.segments:
                 segment_url = urljoin(base_url, segment.uri)
-                if segment_url not in self.fetched_segments:
+                # Media sequence numbers identify segments (RFC 8216 6.3.2), so no per-segment URL is kept
+                if segment.media_sequence not in self.segments and segment.media_sequence not in self.pending_downloads:
                     # Create segment info
                     segment_info = SegmentInfo(
                         url=segment_url,
                         duration=segment.duration,
                         timestamp=segment.program_date_time.timestamp() if segment.program_date_time else time.time(),
                         sequence=segment.media_sequence,
-                        filename=f"segment_{segment.media_sequence:04d}.aac"
+                        filename=segment_filename(segment.media_sequence)
                     )
                     logging.info(f"Attempting to download segment {segment_info.filename}")
-                    if self.download_segment(segment_info):
-                        logging.info(f"Downloaded segment {segment_info.filename}")
-                        self.fetched_segments.add(segment_url)
-                        self.segment_metadata[str(segment.media_sequence)] = {
-                            'url': segment_url,
-                            'duration': segment_info.duration,
-                            'timestamp': segment_info.timestamp,
-                            'sequence': segment_info.sequence,
-                            'filename': segment_info.filename
-                        }
-                        new_segments += 1
+                    self.pending_segments[segment_info.sequence] = segment_info
+                    self.pending_downloads[segment_info.sequence] = self.executor.submit(self.download, segment_info)
+                    new_segments += 1
 
             if new_segments > 0:
-                logging.info(f"Downloaded {new_segments} new segments")
-                self.save_segment_info()
+                logging.info(f"Queued {new_segments} new segments for {self.name}")
+            download_queue_depth.set(len(self.pending_downloads), station=self.name)
+
+            # Failed segments are retried until they leave the playlist
+            self.failed_sequences = {sequence for sequence in self.failed_sequences
+                                     if sequence >= playlist.media_sequence and sequence not in self.segments}
+            newest = playlist.segments[-1].media_sequence if playlist.segments else self.parse_after
+            self.parse_after = min([newest] + [sequence - 1 for sequence in self.failed_sequences])
 
-            # Clean up old segments from memory (keep last 1000)
-            if len(self.fetched_segments) > 1000:
-                old_segments = set(list(self.fetched_segments)[:-1000])
-                self.fetched_segments = set(list(self.fetched_segments)[-1000:])
-                # Clean up metadata for old segments
-                for segment_url in old_segments:
-                    self.segment_metadata.pop(segment_url, None)
+            # Reload after a target duration if the playlist moved on, or half of one if it didn't (RFC 8216 6.3.4)
+            if playlist.target_duration:
+                self.poll_interval = playlist.target_duration if new_segments > 0 else playlist.target_duration / 2
 
         except Exception as e:
             logging.error(f"Error processing segments: {str(e)}")
 
+    @timed_stage('commit_segments')
+    def commit_segments(self) -> int:
+        """
+        Record finished downloads in the journal, in sequence order
+
+        A download still in flight holds back the segments after it, so the journal
+        never has a gap that is filled in later.
+
+        Returns:
+            int: Number of segments committed
+        """
+        committed = 0
+        for sequence in sorted(self.pending_downloads):
+            future = self.pending_downloads[sequence]
+            if not future.done():
+                break
+            del self.pending_downloads[sequence]
+            segment_info = self.pending_segments.pop(sequence)
+            try:
+                downloaded = future.result()
+            except Exception as e:
+                logging.error(f"Error downloading segment {segment_info.filename}: {str(e)}")
+                downloaded = False
+            if not downloaded:
+                # Left out of the journal, so the next poll retries it while it's still in the playlist
+                self.failed_sequences.add(sequence)
+                self.parse_after = min(self.parse_after, sequence - 1)
+                continue
+            self.failed_sequences.discard(sequence)
+            logging.info(f"Downloaded segment {segment_info.filename}")
+            metadata = {
+                'url': segment_info.url,
+                'duration': segment_info.duration,
+                'timestamp': segment_info.timestamp,
+                'sequence': segment_info.sequence,
+                'filename': segment_info.filename
+            }
+            if segment_info.byte_length is not None:
+                metadata['byte_offset'] = segment_info.byte_offset
+                metadata['byte_length'] = segment_info.byte_length
+            if segment_info.variant_mask:
+                metadata['variant_mask'] = segment_info.variant_mask
+            self.journal.append(metadata)
+            if self.on_commit:
+                self.on_commit(metadata)
+            committed += 1
+            self.heartbeat.beat(last_sequence=segment_info.sequence, last_segment_time=time.time())
+        download_queue_depth.set(len(self.pending_downloads), station=self.name)
+        indexed_segments.set(len(self.segments), station=self.name)
+        return committed
+
+    def wait_for_downloads(self, timeout: float):
+        """Commit downloads as they complete, until they are all done or timeout expires"""
+        deadline = time.monotonic() + timeout
+        while self.pending_downloads:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # A finished download can be held back behind one still in flight, so only wait on those
+            in_flight = [future for future in self.pending_downloads.values() if not future.done()]
+            wait(in_flight, timeout=remaining, return_when=FIRST_COMPLETED)
+            if self.commit_segments():
+                self.segment_events.notify()
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def poll_once(self, check_interval: float = 3):
+        """Poll the playlist, then commit downloads until it is time to poll again"""
+        started = time.monotonic()
+        self.process_segments()
+        # Until the playlist has told us its target duration, poll every check_interval
+        interval = self.poll_interval or check_interval
+        self.wait_for_downloads(interval - (time.monotonic() - started))
+        self.maintain()
+
+    def maintain(self):
+        """Coalesce old segments, apply retention and report progress, after each poll"""
+        # Segments are coalesced before retention can delete them
+        if self.coalescer:
+            self.coalescer.run_if_due()
+        # Old segments leave disk and the journal together
+        if self.retention:
+            self.retention.run_if_due()
+            indexed_segments.set(len(self.segments), station=self.name)
+        self.heartbeat.beat(force=True, pending_downloads=len(self.pending_downloads))
+
+    def close(self):
+        """Abandon downloads in flight and close the journal"""
+        if self.scheduler.stations == [self]:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for future in self.pending_downloads.values():
+                future.cancel()
+        if self.archive:
+            self.archive.close()
+        if self.coalescer:
+            self.coalescer.close()
+        self.journal.close()
+
     def run(self, check_interval: int = 3):
         """Run the segment downloader"""
         logging.info("Starting segment downloader")
         try:
             while True:
-                self.process_segments()
-                time.sleep(check_interval)
+                self.poll_once(check_interval)
         except KeyboardInterrupt:
             logging.info("Stopping segment downloader")
-            self.save_segment_info()
         except Exception as e:
             logging.error(f"Error in main loop: {str(e)}")
-            self.save_segment_info()
+        finally:
+            self.close()
 
 if __name__ == "__main__":
-    downloader = SegmentDownloader()
-    downloader.run()
+    # Exit through the normal shutdown path on terminate so the journal is synced
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']))
+    # SIGUSR1 profiles the running downloader, into the first station's folder
+    install_profiler(config.stations[0].folder, 'segment_downloader')
+    # Every configured station, all sharing one scheduler
+    scheduler = IngestScheduler()
+    for station in config.stations:
+        SegmentDownloader(output_dir=station.folder, master_url=station.url, name=station.name,
+                          variants_url=station.variants_url,
+                          retention_seconds=config.retention_seconds, storage=config.segment_storage,
+                          coalesce_after=config.coalesce_after_seconds, coalesce_segments=config.coalesce_segments,
+                          coalesced_retention_seconds=config.coalesced_retention_seconds, scheduler=scheduler)
+    scheduler.run(follow_config=True)
@@ -0,0 +1,77 @@
+import logging
+import os
+import select
+import socket
+from pathlib import Path
+from typing import List
+
+
+class SegmentEventNotifier:
+    """Tells a listening process that new segments were committed, over a local datagram socket"""
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def notify(self):
+        """Send a notification, dropping it if nobody is listening"""
+        try:
+            self.sock.sendto(b'segments', self.path)
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            # No listener yet, or it already has notifications queued
+            pass
+        except OSError as e:
+            logging.debug(f"Could not notify {self.path}: {str(e)}")
+
+    def close(self):
+        self.sock.close()
+
+
+class SegmentEventListener:
+    """Waits for segment notifications from the downloader"""
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        # A socket left behind by a crashed process would stop us binding
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Block until a notification arrives or timeout expires
+
+        Returns:
+            bool: True if notified, False on timeout
+        """
+        return wait_any([self], timeout)
+
+    def drain(self):
+        # Several segments may have been committed since we last looked, one refresh covers them all
+        try:
+            while self.sock.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def wait_any(listeners: List[SegmentEventListener], timeout: float) -> bool:
+    """
+    Block until any of the listeners is notified or timeout expires
+
+    Returns:
+        bool: True if notified, False on timeout
+    """
+    readable, _, _ = select.select([listener.sock for listener in listeners], [], [], max(timeout, 0))
+    for listener in listeners:
+        if listener.sock in readable:
+            listener.drain()
+    return bool(readable)
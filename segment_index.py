@@ -0,0 +1,270 @@
+import bisect
+import logging
+import math
+import os
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from segment_journal import read_journal
+from segment_store import SegmentStore, segment_filename
+
+
+class Segment(NamedTuple):
+    sequence: int
+    start_time: float
+    end_time: float
+    filename: str
+    duration: float
+    byte_offset: Optional[int] = None
+    byte_length: Optional[int] = None
+    variant_mask: int = 0
+
+
+class SegmentIndex(SegmentStore):
+    """
+    In-memory timeline of downloaded segments.
+
+    The index tails the segment journal, so each refresh only ingests records appended
+    since the previous one. Segments are kept in the columns of a SegmentStore, with
+    the cumulative start offset of each segment along the timeline alongside, so a delayed
+    window is found with a binary search rather than a scan of the whole buffer.
+    """
+
+    def __init__(self, journal_path: Path):
+        self.journal_path = Path(journal_path)
+        self._reset()
+
+    def _reset(self):
+        super().__init__()
+        self._offset = 0
+        self._file_id = None
+        # Cumulative start and end of each segment, measured from the first indexed segment
+        self.start_offsets = array('d')
+        self.end_offsets = array('d')
+        # Longest segment ever indexed, which expiry doesn't shrink
+        self.longest_duration = 0.0
+
+    def journal_position(self) -> Tuple[Optional[Tuple[int, int]], int]:
+        """The journal file (st_dev, st_ino) and byte offset the index has read up to"""
+        return self._file_id, self._offset
+
+    def resume(self, file_id: Optional[Tuple[int, int]], offset: int):
+        """Continue tailing the journal from a position saved with journal_position()"""
+        self._file_id = file_id
+        self._offset = offset
+
+    def refresh(self) -> int:
+        """
+        Ingest journal records written since the last refresh
+
+        Returns:
+            int: Number of records ingested
+        """
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+        # A compacted journal is a new file, so start again from the top
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self._file_id or stat.st_size < self._offset:
+            if self._file_id is not None:
+                logging.info(f"{self.journal_path} was replaced, rebuilding segment index")
+            self._reset()
+            self._file_id = file_id
+
+        if stat.st_size == self._offset:
+            return 0
+
+        records, self._offset = read_journal(self.journal_path, self._offset)
+        for record in records:
+            if record.get('op') == 'del':
+                self.remove(record['s'])
+            else:
+                self.add(record['s'], record['t'], record['d'], record['f'], record.get('o'), record.get('n'),
+                         record.get('v', 0))
+        return len(records)
+
+    def add(self, sequence: int, timestamp: float, duration: float, filename: str,
+            byte_offset: Optional[int] = None, byte_length: Optional[int] = None,
+            variant_mask: int = 0) -> Tuple[int, bool]:
+        """Insert or replace a segment, keeping the index sorted by sequence"""
+        i, inserted = super().add(sequence, timestamp, duration, filename, byte_offset, byte_length, variant_mask)
+        self.longest_duration = max(self.longest_duration, duration)
+        if inserted:
+            self.start_offsets.insert(i, 0.0)
+            self.end_offsets.insert(i, 0.0)
+        # Appending at the end (the normal case) only touches the last entry
+        self._recompute_offsets(i)
+        return i, inserted
+
+    def remove(self, sequence: int) -> Optional[int]:
+        """Remove a segment from the index"""
+        i = super().remove(sequence)
+        if i is None:
+            return None
+        del self.start_offsets[i]
+        del self.end_offsets[i]
+        # Removing from the front (the normal case) leaves later offsets untouched
+        if 0 < i < len(self.sequences):
+            self._recompute_offsets(i)
+        return i
+
+    def _recompute_offsets(self, start: int):
+        for i in range(start, len(self.sequences)):
+            self.start_offsets[i] = self.end_offsets[i - 1] if i > 0 else 0.0
+            self.end_offsets[i] = self.start_offsets[i] + self.durations[i]
+
+    def target_duration(self) -> int:
+        """A target duration that fits every segment indexed so far, so it stays the same as a window moves"""
+        return max(math.floor(self.longest_duration + 0.5), 1)
+
+    def window(self, anchor_sequence: int, broadcast_time: float, hls_length: float) -> List[Segment]:
+        """
+        Find the segments covering a broadcast time
+
+        The timeline starts at the wall time of the anchor segment and each later segment
+        starts where the previous one ended. A segment is returned if
+        start_time <= broadcast_time <= end_time + hls_length.
+
+        Args:
+            anchor_sequence: Sequence number of the segment the timeline is anchored to
+            broadcast_time: Wall time of the original broadcast to play
+            hls_length: How far behind broadcast_time the window extends, in seconds
+
+        Returns:
+            list: The matching segments, in sequence order
+        """
+        anchor = self.position(anchor_sequence)
+        if anchor is None:
+            return []
+
+        # Map the broadcast time onto the cumulative offsets
+        anchor_time = self.timestamps[anchor]
+        anchor_offset = self.start_offsets[anchor]
+        position = broadcast_time - anchor_time + anchor_offset
+        first = bisect.bisect_left(self.end_offsets, position - hls_length, anchor)
+        last = bisect.bisect_right(self.start_offsets, position, anchor)
+        return self._segments(first, last,
+                              [anchor_time + (start - anchor_offset) for start in self.start_offsets[first:last]],
+                              [anchor_time + (end - anchor_offset) for end in self.end_offsets[first:last]])
+
+    def between(self, start_time: float, end_time: Optional[float] = None) -> List[Segment]:
+        """
+        Find the segments of the broadcast between two wall times, by their own wall times
+
+        Unlike window(), this follows the segments' wall times rather than a timeline built
+        from their durations, so it finds what was on air at a given time of day.
+
+        Args:
+            start_time: Wall time to start from, the segment on air then is the first returned
+            end_time: Wall time to end at, or None for every segment since start_time
+
+        Returns:
+            list: The matching segments, in sequence order
+        """
+        first = max(bisect.bisect_right(self.timestamps, start_time) - 1, 0)
+        last = len(self.timestamps) if end_time is None else bisect.bisect_left(self.timestamps, end_time)
+        starts = self.timestamps[first:last]
+        return self._segments(first, last, starts,
+                              [start + duration for start, duration in zip(starts, self.durations[first:last])])
+
+    def _segments(self, first: int, last: int, start_times, end_times) -> List[Segment]:
+        # Slicing the columns copies them in C, so only the returned segments are boxed
+        table = self.filename_table
+        return [
+            Segment(
+                sequence,
+                start,
+                end,
+                segment_filename(sequence) if filename_id < 0 else table[filename_id],
+                duration,
+                *((None, None) if byte_length < 0 else (byte_offset, byte_length)),
+                variant_mask
+            )
+            for sequence, start, end, duration, filename_id, byte_offset, byte_length, variant_mask in zip(
+                self.sequences[first:last], start_times, end_times,
+                self.durations[first:last], self.filename_ids[first:last], self.byte_offsets[first:last],
+                self.byte_lengths[first:last], self.variant_masks[first:last])
+        ]
+
+    def next_change(self, anchor_sequence: int, broadcast_time: float, hls_length: float) -> Optional[float]:
+        """
+        Find the next broadcast time at which window() will return a different list
+
+        That is when the next segment starts, or when the oldest segment in the window
+        falls more than hls_length behind, whichever comes first.
+
+        Returns:
+            float: The broadcast time of the next change, or None if nothing is indexed past the window
+        """
+        anchor = self.position(anchor_sequence)
+        if anchor is None:
+            return None
+
+        anchor_time = self.timestamps[anchor]
+        anchor_offset = self.start_offsets[anchor]
+        position = broadcast_time - anchor_time + anchor_offset
+        first = bisect.bisect_left(self.end_offsets, position - hls_length, anchor)
+        last = bisect.bisect_right(self.start_offsets, position, anchor)
+
+        changes = []
+        if last < len(self.sequences):
+            changes.append(self.start_offsets[last])
+        if first < last:
+            changes.append(self.end_offsets[first] + hls_length)
+        if not changes:
+            return None
+        return min(changes) - anchor_offset + anchor_time
+
+
+def render_playlist(segments: List[Segment], uri_prefix: str = '', variant_bit: Optional[int] = None,
+                    playlist_type: Optional[str] = None, start_offset: Optional[float] = None,
+                    target_duration: Optional[int] = None, program_date_time: bool = False) -> str:
+    """
+    Render a list of segments as an HLS media playlist
+
+    Args:
+        segments: The segments to list
+        uri_prefix: Prepended to each segment's filename
+        variant_bit: Render the station's extra variant with this bit in the variant mask instead, whose
+            segments are always stored one per file. Segments the variant doesn't have are marked EXT-X-GAP.
+        playlist_type: 'EVENT' or 'VOD' for a fixed stretch of the buffer rather than a sliding window,
+            starting with the first segment's wall time. A VOD playlist is complete, so it is ended.
+        start_offset: Where players should start playing, in seconds from the start of the first segment
+        target_duration: At least this target duration, for a playlist that must keep the same one as it moves
+        program_date_time: Give the first segment's wall time, as a fixed stretch's playlist always does,
+            for a live playlist of the buffer that players seek through by wall time
+    """
+    # EXT-X-BYTERANGE needs protocol version 4
+    archived = variant_bit is None and any(segment.byte_length is not None for segment in segments)
+    # Every EXTINF, rounded to the nearest second, must fit in the target duration (RFC 8216 4.3.3.1)
+    target_duration = max([math.floor(segment.duration + 0.5) for segment in segments] + [target_duration or 1])
+    lines = [
+        '#EXTM3U',
+        f'#EXT-X-VERSION:{4 if archived else 3}',
+        f'#EXT-X-TARGETDURATION:{max(target_duration, 1)}',
+        f'#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence}',
+    ]
+    if playlist_type:
+        lines.append(f'#EXT-X-PLAYLIST-TYPE:{playlist_type}')
+    if start_offset:
+        lines.append(f'#EXT-X-START:TIME-OFFSET={start_offset:.3f},PRECISE=YES')
+    if playlist_type or program_date_time:
+        start = datetime.fromtimestamp(segments[0].start_time, timezone.utc)
+        lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{start.isoformat(timespec='milliseconds')}")
+    for segment in segments:
+        lines.append(f'#EXTINF:{segment.duration}')
+        if variant_bit is not None:
+            if not segment.variant_mask & (1 << variant_bit):
+                lines.append('#EXT-X-GAP')
+            lines.append(f'{uri_prefix}{segment_filename(segment.sequence)}')
+            continue
+        if segment.byte_length is not None:
+            lines.append(f'#EXT-X-BYTERANGE:{segment.byte_length}@{segment.byte_offset}')
+        lines.append(f'{uri_prefix}{segment.filename}')
+    if playlist_type == 'VOD':
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from segment_store import SegmentStore
+
+# Each journal line is one compact JSON record:
+#   {"op": "add", "s": sequence, "u": url, "d": duration, "t": timestamp, "f": filename}
+#   {"op": "del", "s": sequence}
+# Segments stored in an hourly archive also carry "o": byte offset and "n": byte length, and
+# segments other variants of the station have too carry "v": variant mask.
+# Replaying the lines in order yields the current segments. The URL is kept for reference
+# only, segments are identified by their media sequence number.
+_FIELDS = {'s': 'sequence', 'u': 'url', 'd': 'duration', 't': 'timestamp', 'f': 'filename',
+           'o': 'byte_offset', 'n': 'byte_length', 'v': 'variant_mask'}
+
+
+def encode_record(op: str, metadata: dict) -> bytes:
+    """Encode a journal record as a single compact line"""
+    record = {'op': op}
+    for short, name in _FIELDS.items():
+        if name in metadata:
+            record[short] = metadata[name]
+    return (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def read_journal(path: Path, offset: int = 0) -> Tuple[List[dict], int]:
+    """
+    Read complete journal records starting at a byte offset
+
+    Args:
+        path: Path of the journal file
+        offset: Byte offset to start reading from
+
+    Returns:
+        tuple: The decoded records and the offset just past the last complete line.
+        A torn trailing line (e.g. from a crash mid-write) is left unread.
+    """
+    records = []
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return records, offset
+
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            logging.warning(f"Skipping corrupt journal record: {line[:80]!r}")
+    return records, offset + end
+
+
+def apply_records(segments: SegmentStore, records: List[dict]):
+    """Apply journal records to a segment store"""
+    for record in records:
+        if record.get('op') == 'del':
+            segments.remove(record['s'])
+        else:
+            segments.add(record['s'], record['t'], record['d'], record['f'], record.get('o'), record.get('n'),
+                         record.get('v', 0))
+
+
+class SegmentJournal:
+    """
+    Durable append-only journal of downloaded segments.
+
+    Appending a segment writes one short line, so the cost per segment stays constant
+    however deep the buffer is. Lines are flushed to the OS immediately (so readers can
+    tail the file) and fsync'd in batches. The journal is compacted once it holds
+    mostly superseded records.
+    """
+
+    def __init__(self, path: Path, sync_every: int = 32, sync_interval: float = 30.0,
+                 compact_min_records: int = 1000, compact_ratio: float = 2.0):
+        self.path = Path(path)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_min_records = compact_min_records
+        self.compact_ratio = compact_ratio
+        self.segments = SegmentStore()
+        self._file = None
+        self._records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def open(self, legacy_file: Optional[Path] = None) -> SegmentStore:
+        """
+        Replay the journal and open it for appending
+
+        Args:
+            legacy_file: Old full-rewrite segment_info.json to migrate from if no journal exists yet
+
+        Returns:
+            SegmentStore: The segments currently recorded
+        """
+        if not self.path.exists() and legacy_file is not None and Path(legacy_file).exists():
+            self._migrate(Path(legacy_file))
+
+        records, offset = read_journal(self.path)
+        apply_records(self.segments, records)
+        self._records = len(records)
+
+        # Drop a torn trailing line so the next append starts on a fresh line
+        if self.path.exists() and self.path.stat().st_size > offset:
+            logging.warning(f"Truncating incomplete record at end of {self.path}")
+            os.truncate(self.path, offset)
+
+        self._file = open(self.path, 'ab')
+        return self.segments
+
+    def _migrate(self, legacy_file: Path):
+        """Convert a segment_info.json snapshot into a journal"""
+        try:
+            with open(legacy_file, 'r') as f:
+                data = json.load(f)
+            for metadata in data.get('segment_metadata', {}).values():
+                self.segments.add_metadata(metadata)
+            self._write_snapshot()
+            legacy_file.replace(legacy_file.with_suffix('.json.migrated'))
+            logging.info(f"Migrated {len(self.segments)} segments from {legacy_file} to {self.path}")
+        except Exception as e:
+            logging.error(f"Error migrating {legacy_file}: {str(e)}")
+            self.segments = SegmentStore()
+
+    def append(self, metadata: dict):
+        """Record a newly downloaded segment"""
+        self.segments.add_metadata(metadata)
+        self._write(encode_record('add', metadata))
+
+    def remove(self, sequence: int):
+        """Record that a segment is no longer available"""
+        if self.segments.remove(sequence) is not None:
+            self._write(encode_record('del', {'sequence': sequence}))
+
+    def _write(self, line: bytes):
+        self._file.write(line)
+        self._file.flush()
+        self._records += 1
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+        self.maybe_compact()
+
+    def sync(self):
+        """Force buffered records to stable storage"""
+        if self._file is None or self._unsynced == 0:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def maybe_compact(self):
+        """Compact the journal if most of its records are superseded"""
+        if (self._records >= self.compact_min_records
+                and self._records > self.compact_ratio * len(self.segments)):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the journal with only the live records"""
+        if self._file is not None:
+            self._file.close()
+        self._write_snapshot()
+        self._file = open(self.path, 'ab')
+        logging.info(f"Compacted segment journal to {self._records} records")
+
+    def _write_snapshot(self):
+        """Write the live records to a temporary file and atomically replace the journal"""
+        temp_file = self.path.with_suffix(self.path.suffix + '.tmp')
+        try:
+            with open(temp_file, 'wb') as f:
+                f.writelines(encode_record('add', self.segments.metadata(i)) for i in range(len(self.segments)))
+                f.flush()
+                os.fsync(f.fileno())
+            temp_file.replace(self.path)
+            self._records = len(self.segments)
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+        finally:
+            if temp_file.exists():
+                temp_file.unlink()
+
+    def close(self):
+        """Sync and close the journal"""
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
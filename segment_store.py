@@ -0,0 +1,158 @@
+import bisect
+import re
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# Segments stored one per file are named after their sequence number, so their names aren't stored at all
+_SEGMENT_FILENAME = re.compile(r'segment_(\d+)\.aac')
+
+
+def segment_filename(sequence: int) -> str:
+    return f'segment_{sequence:04d}.aac'
+
+
+class SegmentStore:
+    """
+    Columnar store of segment metadata, kept sorted by sequence.
+
+    Each field is a typed array rather than a dict per segment, so a segment costs about
+    sixty bytes however deep the buffer gets. Filenames that follow segment_filename() are
+    derived from the sequence (filename id -1), any other name (an hourly archive, shared by
+    hundreds of segments) is interned once in filename_table. A missing byte offset or
+    length is stored as -1. Bit i of a segment's variant mask is set when the station's
+    i-th extra variant (see variants.py) has the same segment.
+    """
+
+    def __init__(self):
+        self.sequences = array('q')
+        self.timestamps = array('d')
+        self.durations = array('d')
+        self.byte_offsets = array('q')
+        self.byte_lengths = array('q')
+        self.filename_ids = array('i')
+        self.variant_masks = array('i')
+        self.filename_table: List[str] = []
+        self._filename_ids: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __contains__(self, sequence: int) -> bool:
+        return self.position(sequence) is not None
+
+    def position(self, sequence: int) -> Optional[int]:
+        """Return the position of a sequence number in the store, or None"""
+        i = bisect.bisect_left(self.sequences, sequence)
+        if i < len(self.sequences) and self.sequences[i] == sequence:
+            return i
+        return None
+
+    def intern_filename(self, sequence: int, filename: str) -> int:
+        if filename == segment_filename(sequence):
+            return -1
+        filename_id = self._filename_ids.get(filename)
+        if filename_id is None:
+            filename_id = self._filename_ids[filename] = len(self.filename_table)
+            self.filename_table.append(filename)
+        return filename_id
+
+    def load_filename_table(self, table: List[str]):
+        """Replace the interned filenames with a table saved from filename_table"""
+        self.filename_table = table
+        self._filename_ids = {filename: i for i, filename in enumerate(table)}
+
+    def filename(self, i: int) -> str:
+        filename_id = self.filename_ids[i]
+        return segment_filename(self.sequences[i]) if filename_id < 0 else self.filename_table[filename_id]
+
+    def byte_range(self, i: int) -> Tuple[Optional[int], Optional[int]]:
+        """Offset and length of a segment within its archive, or (None, None) for a file of its own"""
+        if self.byte_lengths[i] < 0:
+            return None, None
+        return self.byte_offsets[i], self.byte_lengths[i]
+
+    def metadata(self, i: int) -> dict:
+        """The segment at position i, as a journal metadata dict"""
+        metadata = {'sequence': self.sequences[i], 'timestamp': self.timestamps[i],
+                    'duration': self.durations[i], 'filename': self.filename(i)}
+        byte_offset, byte_length = self.byte_range(i)
+        if byte_length is not None:
+            metadata['byte_offset'] = byte_offset
+            metadata['byte_length'] = byte_length
+        if self.variant_masks[i]:
+            metadata['variant_mask'] = self.variant_masks[i]
+        return metadata
+
+    def add(self, sequence: int, timestamp: float, duration: float, filename: str,
+            byte_offset: Optional[int] = None, byte_length: Optional[int] = None,
+            variant_mask: int = 0) -> Tuple[int, bool]:
+        """
+        Insert or replace a segment
+
+        Returns:
+            tuple: The segment's position, and whether it was inserted rather than replaced
+        """
+        filename_id = self.intern_filename(sequence, filename)
+        byte_offset = -1 if byte_offset is None else byte_offset
+        byte_length = -1 if byte_length is None else byte_length
+        i = bisect.bisect_left(self.sequences, sequence)
+        if i < len(self.sequences) and self.sequences[i] == sequence:
+            self.timestamps[i] = timestamp
+            self.durations[i] = duration
+            self.byte_offsets[i] = byte_offset
+            self.byte_lengths[i] = byte_length
+            self.filename_ids[i] = filename_id
+            self.variant_masks[i] = variant_mask
+            return i, False
+        self.sequences.insert(i, sequence)
+        self.timestamps.insert(i, timestamp)
+        self.durations.insert(i, duration)
+        self.byte_offsets.insert(i, byte_offset)
+        self.byte_lengths.insert(i, byte_length)
+        self.filename_ids.insert(i, filename_id)
+        self.variant_masks.insert(i, variant_mask)
+        return i, True
+
+    def add_metadata(self, metadata: dict) -> Tuple[int, bool]:
+        return self.add(metadata['sequence'], metadata['timestamp'], metadata['duration'], metadata['filename'],
+                        metadata.get('byte_offset'), metadata.get('byte_length'), metadata.get('variant_mask', 0))
+
+    def remove(self, sequence: int) -> Optional[int]:
+        """
+        Remove a segment
+
+        Returns:
+            int: The position it was removed from, or None if it wasn't stored
+        """
+        i = self.position(sequence)
+        if i is None:
+            return None
+        for column in (self.sequences, self.timestamps, self.durations,
+                       self.byte_offsets, self.byte_lengths, self.filename_ids, self.variant_masks):
+            del column[i]
+        return i
+
+    def first_after(self, wall_time: float) -> Optional[int]:
+        """
+        Position of the first segment whose wall time is after wall_time, or None if there isn't one
+
+        Wall times rise with sequence numbers, so this is a binary search.
+        """
+        i = bisect.bisect_right(self.timestamps, wall_time)
+        return i if i < len(self.timestamps) else None
+
+    def older_than(self, cutoff: float) -> List[int]:
+        """Sequence numbers of segments whose wall time is before cutoff"""
+        return [sequence for sequence, timestamp in zip(self.sequences, self.timestamps) if timestamp < cutoff]
+
+    def file_in_use(self, filename: str) -> bool:
+        """Whether any stored segment lives in filename"""
+        filename_id = self._filename_ids.get(filename)
+        if filename_id is not None:
+            return filename_id in self.filename_ids
+        match = _SEGMENT_FILENAME.fullmatch(filename)
+        if not match:
+            return False
+        sequence = int(match.group(1))
+        i = self.position(sequence)
+        return i is not None and self.filename_ids[i] < 0 and filename == segment_filename(sequence)
@@ -1,23 +1,690 @@
+import argparse
+import email.utils
+import functools
 import http.server
-import socketserver
+import mmap
 import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, unquote
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import config
+from config import playlist_folder, coalesce_segments, plays_chunks
+from segment_index import SegmentIndex, render_playlist
+from media_playlist import parse_media_playlist
+from checkpoint import playlist_anchor
+from coalesce import CHUNK_FOLDER, chunk_folder
+from read_ahead import ReadAhead
+from profiling import install_profiler
+from metrics import registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 PORT = 8080
+PLAYLIST_CACHE_SECONDS = 2.0 # Well under one segment duration
+SEGMENT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Segments never change once written, playlists change every few seconds
+SEGMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PLAYLIST_CACHE_CONTROL = 'public, max-age=1'
+
+# Segment requests are attributed to the delay they were played at, rounded to this many seconds
+DELAY_LABEL_SECONDS = 15 * 60
+
+# Blocking playlist reloads (_HLS_msn) are answered with a 503 after this many target durations
+BLOCKING_RELOAD_TARGET_DURATIONS = 3
+# How often a blocked reload checks a playlist file that is due to be rewritten by the playlist creator
+BLOCKING_RELOAD_POLL_SECONDS = 0.05
+SERVER_CONTROL = '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES'
+
+# Seek playlists are rendered on first request, and the most recently requested are kept
+SEEK_CACHE_ENTRIES = 256
+
+served_requests = registry.counter('jdelay_served_requests_total', "Requests served, by delay and kind", ['delay', 'kind'])
+served_bytes = registry.counter('jdelay_served_bytes_total', "Response body bytes served, by delay and kind", ['delay', 'kind'])
+
+class PlaylistGenerator:
+    """
+    Builds delayed playlists on request from the in-memory segment index
+
+    By default the generator tails the segment journal itself. A segment_index shared with
+    the ingest side is kept up to date by its owner instead, under the shared lock.
+    """
+
+    def __init__(self, folder: str = playlist_folder, cache_seconds: float = PLAYLIST_CACHE_SECONDS,
+                 segment_index: Optional[SegmentIndex] = None, lock: Optional[threading.Lock] = None):
+        self.folder = folder
+        self.follow_journal = segment_index is None
+        if segment_index is None:
+            segment_index = SegmentIndex(Path(folder) / 'segment_journal.jsonl')
+        self.segment_index = segment_index
+        # Coalesced chunks, for the delays that play them, which this generator always tails itself
+        self.chunk_index = SegmentIndex(chunk_folder(folder) / 'segment_journal.jsonl')
+        self.cache_seconds = cache_seconds
+        self._cache = {}
+        self._seek_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        # Whether each live seek playlist, by (start_time, end_time), plays chunks rather than segments
+        self._seek_sources: "OrderedDict[tuple, bool]" = OrderedDict()
+        self._lock = lock or threading.Lock()
+        # Notified when the delayed playlist files are rewritten in this process, to wake blocked reloads
+        self._changed = threading.Condition()
+
+    def playlist_for_delay(self, delay_seconds: int):
+        """Return the playlist for a delay, or None if the buffer does not reach back that far"""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(delay_seconds)
+            if cached and cached[0] > now:
+                return cached[1]
+
+            # Long delays are only left with the coalesced chunks, once their segments have been deleted
+            chunks = plays_chunks(delay_seconds)
+            index = self.chunk_index if chunks else self.segment_index
+            if chunks or self.follow_journal:
+                index.refresh()
+            if len(index) == 0:
+                return None
+
+            # Anchor every on-demand playlist to the same timeline, so any delay lines up with the others
+            anchor = index.sequences[0]
+            broadcast_time = now - delay_seconds - config.buffer_period_seconds
+            length = config.hls_length
+            target_duration = None
+            if chunks:
+                # As for the playlist files, chunk playlists last three target durations and keep the same one
+                length = max(length, 3 * index.durations[-1])
+                target_duration = index.target_duration()
+            segments = index.window(anchor, broadcast_time, length)
+            playlist = render_playlist(segments, uri_prefix=f'/{CHUNK_FOLDER}/' if chunks else '/',
+                                       target_duration=target_duration) if segments else None
+            # Cached until the window next moves, so a blocked reload sees the new segment straight away
+            expires = now + self.cache_seconds
+            next_change = index.next_change(anchor, broadcast_time, length)
+            if next_change is not None:
+                expires = min(expires, next_change + delay_seconds + config.buffer_period_seconds)
+
+            # Drop expired entries so one-off delays don't accumulate
+            self._cache = {delay: entry for delay, entry in self._cache.items() if entry[0] > now}
+            self._cache[delay_seconds] = (expires, playlist)
+            return playlist
+
+    def seek_playlist(self, start_time: float, end_time: Optional[float] = None) -> Optional[str]:
+        """
+        Return a playlist of the buffer from a wall time, to end_time or as far as has been recorded
+
+        Players start at start_time and can scrub through the whole playlist. A stretch already
+        recorded to its end is a VOD playlist, played from the coalesced chunks where only they
+        are left. Otherwise it is a live playlist that grows as the stretch is recorded and loses
+        its head to retention. Its entries have to keep their media sequence numbers across
+        reloads, so it plays just the chunks or just the segments, whichever it started on.
+
+        Returns:
+            str: The playlist, or None if nothing between the times is buffered
+        """
+        with self._lock:
+            if self.follow_journal:
+                self.segment_index.refresh()
+            self.chunk_index.refresh()
+            # Cached until the buffer gains or loses a segment or chunk
+            stretch = (start_time, end_time)
+            key = stretch + tuple(index.sequences[i] if len(index) else None
+                                  for index in (self.segment_index, self.chunk_index) for i in (0, -1))
+            playlist = self._seek_cache.get(key)
+            if playlist is not None:
+                self._seek_cache.move_to_end(key)
+                return playlist
+
+            segments = self.segment_index.between(start_time, end_time)
+            on_chunks = self._seek_sources.get(stretch)
+            chunks = []
+            if on_chunks or (on_chunks is None and len(self.chunk_index)
+                             and (not segments or segments[0].start_time > start_time)):
+                chunks = [chunk._replace(filename=f'{CHUNK_FOLDER}/{chunk.filename}')
+                          for chunk in self.chunk_index.between(start_time, end_time)]
+            if on_chunks is None:
+                complete = end_time is not None and len(self.segment_index) > 0 and \
+                    end_time <= self.segment_index.timestamps[-1] + self.segment_index.durations[-1]
+                if complete:
+                    if segments and chunks:
+                        # Chunk k holds segments k * coalesce_segments onwards, so carry on with the segment after its last
+                        chunks = [chunk for chunk in chunks if chunk.sequence * coalesce_segments < segments[0].sequence]
+                        resume = (chunks[-1].sequence + 1) * coalesce_segments if chunks else segments[0].sequence
+                        segments = chunks + [segment for segment in segments if segment.sequence >= resume]
+                    return self._render_seek_playlist(key, start_time, segments or chunks, 'VOD')
+                on_chunks = bool(chunks)
+                if segments or chunks:
+                    self._seek_sources[stretch] = on_chunks
+                    if len(self._seek_sources) > SEEK_CACHE_ENTRIES:
+                        self._seek_sources.popitem(last=False)
+            else:
+                self._seek_sources.move_to_end(stretch)
+
+            index, entries = (self.chunk_index, chunks) if on_chunks else (self.segment_index, segments)
+            # Once its stretch has been recorded a live playlist is ended, but it keeps its type and entries
+            ended = end_time is not None and bool(entries) and end_time <= entries[-1].end_time
+            return self._render_seek_playlist(key, start_time, entries, None, index.target_duration(), ended)
+
+    def _render_seek_playlist(self, key: tuple, start_time: float, segments: list, playlist_type: Optional[str],
+                              target_duration: Optional[int] = None, ended: bool = False) -> Optional[str]:
+        """Render and cache a seek playlist, or None if nothing from start_time has been recorded"""
+        if not segments or segments[-1].end_time <= start_time:
+            return None
+        playlist = render_playlist(segments, uri_prefix='/', playlist_type=playlist_type,
+                                   start_offset=max(start_time - segments[0].start_time, 0),
+                                   target_duration=target_duration, program_date_time=True)
+        if ended:
+            playlist += '#EXT-X-ENDLIST\n'
+        self._seek_cache[key] = playlist
+        if len(self._seek_cache) > SEEK_CACHE_ENTRIES:
+            self._seek_cache.popitem(last=False)
+        return playlist
+
+    def read_ahead(self, evict: Optional[Callable[[str], None]] = None) -> ReadAhead:
+        """Read ahead of the active delays, from this generator's indexes"""
+        return ReadAhead(self.folder, self.segment_index, self.chunk_index, self._lock, self.follow_journal, evict)
+
+    def sequence_due(self, delay_seconds: int, sequence: int, chunks: bool = False,
+                     playlist_file: bool = False) -> Optional[float]:
+        """
+        Wall time at which a segment enters the playlist for a delay, or None if it isn't indexed yet
+
+        With chunks, sequence is a chunk of a playlist that plays coalesced chunks instead. On-demand
+        playlists are all anchored on the oldest segment (or chunk), the playlist creator's files on
+        the anchor it saves for each delay, which only differ once recording has had a gap.
+        """
+        with self._lock:
+            segment_index = self.chunk_index if chunks else self.segment_index
+            if chunks or self.follow_journal:
+                segment_index.refresh()
+            position = segment_index.position(sequence)
+            if position is None:
+                return None
+            if playlist_file:
+                anchor = playlist_anchor(self.folder, delay_seconds, segment_index,
+                                         coalesce_segments if chunks else 1)
+                if anchor is None:
+                    return None
+                anchor = segment_index.position(anchor)
+            else:
+                anchor = 0
+            start = segment_index.timestamps[anchor] + segment_index.start_offsets[position] \
+                - segment_index.start_offsets[anchor]
+        return start + delay_seconds + config.buffer_period_seconds
+
+    def playlists_changed(self):
+        """Wake blocked playlist reloads, after the delayed playlist files have been rewritten"""
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait_for_change(self, timeout: float):
+        with self._changed:
+            self._changed.wait(max(timeout, 0))
+
+    def segment_delay(self, filename: str, chunks: bool = False) -> Optional[int]:
+        """Estimate the delay a segment (or with chunks, a chunk) is being played at from its age, or None if it isn't indexed"""
+        match = re.fullmatch(r'segment_(\d+)\.aac', filename)
+        if not match:
+            return None
+        with self._lock:
+            segment_index = self.chunk_index if chunks else self.segment_index
+            if chunks:
+                segment_index.refresh()
+            position = segment_index.position(int(match.group(1)))
+            if position is None:
+                return None
+            age = time.time() - segment_index.timestamps[position] - config.buffer_period_seconds
+        return max(round(age / DELAY_LABEL_SECONDS) * DELAY_LABEL_SECONDS, 0)
+
+
+class SegmentCache:
+    """
+    Bounded LRU of segment file contents.
+
+    A segment is only admitted on its second request, so one-off reads of old segments
+    go straight from disk with sendfile and don't evict the segments every listener on
+    a popular delay is fetching.
+    """
+
+    def __init__(self, max_bytes: int = SEGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, mtime_ns: int) -> Optional[bytes]:
+        """Return the cached contents of path, if cached for this version of the file"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != mtime_ns:
+                return None
+            self._entries.move_to_end(path)
+            return entry[1]
+
+    def should_admit(self, path: str) -> bool:
+        """Record a miss, returning True if the path has missed recently and is worth caching"""
+        with self._lock:
+            if path in self._seen:
+                del self._seen[path]
+                return True
+            self._seen[path] = None
+            if len(self._seen) > 4096:
+                self._seen.popitem(last=False)
+            return False
+
+    def discard(self, path: str):
+        """Drop a file that is no longer about to be requested"""
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._seen.pop(path, None)
+
+    def put(self, path: str, mtime_ns: int, data: bytes):
+        if len(data) > self.max_bytes // 8:
+            return
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[path] = (mtime_ns, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class ArchiveMaps:
+    """
+    Keeps the most recently used archive files memory-mapped.
+
+    Byte ranges of an archive are sliced straight out of the mapping instead of opening,
+    seeking and reading the file for every segment request.
+    """
+
+    def __init__(self, max_maps: int = 8):
+        self.max_maps = max_maps
+        self._maps: "OrderedDict[str, Tuple[int, int, mmap.mmap]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path: str, f, stat: os.stat_result, start: int, end: int) -> bytes:
+        """Return bytes start to end (inclusive) of an open archive file"""
+        with self._lock:
+            entry = self._maps.get(path)
+            # Archives grow while their hour is being recorded and are replaced after retention, so remap then
+            if entry is None or entry[0] != stat.st_ino or entry[1] <= end:
+                if entry is not None:
+                    entry[2].close()
+                entry = (stat.st_ino, stat.st_size, mmap.mmap(f.fileno(), stat.st_size, access=mmap.ACCESS_READ))
+                self._maps[path] = entry
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)[1][2].close()
+            return entry[2][start:end + 1]
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single byte range from a Range header
+
+    Returns:
+        tuple: Inclusive (start, end) of the range, or None to send the whole file.
+        Raises ValueError if the range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = size - int(last)
+            end = size - 1
+    except ValueError:
+        return None
+    start = max(start, 0)
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+def timezone_delay(tz_name: str, now: float = None) -> int:
+    """Delay in seconds that plays the source station's local time at the same local time in tz_name"""
+    now = time.time() if now is None else now
+    instant = datetime.fromtimestamp(now, timezone.utc)
+    source_offset = instant.astimezone(ZoneInfo(config.source_timezone)).utcoffset()
+    listener_offset = instant.astimezone(ZoneInfo(tz_name)).utcoffset()
+    return int((source_offset - listener_offset).total_seconds()) % (24 * 60 * 60)
+
+
+def parse_broadcast_time(text: str) -> float:
+    """Wall time of an ISO 8601 time from a URL, taken as the source station's local time if it has no offset"""
+    moment = datetime.fromisoformat(unquote(text))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=ZoneInfo(config.source_timezone))
+    return moment.timestamp()
+
+
+def advertise_blocking_reload(playlist: str) -> str:
+    """Add EXT-X-SERVER-CONTROL to a playlist, telling players they can ask for blocking reloads"""
+    header, _, rest = playlist.partition('\n')
+    return f'{header}\n{SERVER_CONTROL}\n{rest}'
+
 
 class StreamHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory="output", **kwargs)
+    # HTTP/1.1 keeps connections open between a player's playlist and segment requests
+    protocol_version = 'HTTP/1.1'
+    # Close idle keep-alive connections so they don't pin a thread forever
+    timeout = 30
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            self.send_metrics()
+        elif url.path == '/playlist.m3u8':
+            try:
+                delay = int(parse_qs(url.query)['delay'][0])
+            except (KeyError, ValueError):
+                self.send_error(400, "Expected an integer delay parameter, in seconds")
+                return
+            self.send_playlist(delay, url.query)
+        elif url.path.startswith('/tz/') and url.path.endswith('.m3u8'):
+            try:
+                delay = timezone_delay(url.path[len('/tz/'):-len('.m3u8')])
+            except (ZoneInfoNotFoundError, ValueError):
+                self.send_error(404, "Unknown timezone")
+                return
+            self.send_playlist(delay, url.query)
+        elif url.path.startswith('/at/') and url.path.endswith('.m3u8'):
+            self.send_seek_playlist(url.path[len('/at/'):-len('.m3u8')])
+        elif url.path.startswith('/show/') and url.path.endswith('.m3u8'):
+            start, _, end = url.path[len('/show/'):-len('.m3u8')].partition('/')
+            self.send_seek_playlist(start, end)
+        elif url.path.endswith('.aac') and os.path.basename(url.path).startswith('archive_'):
+            self.send_file(self.translate_path(url.path), SEGMENT_CACHE_CONTROL, archive=True)
+        elif url.path.endswith('.aac'):
+            delay = self.server.playlist_generator.segment_delay(os.path.basename(url.path),
+                                                                 chunks=f'/{CHUNK_FOLDER}/' in url.path)
+            self.send_file(self.translate_path(url.path), SEGMENT_CACHE_CONTROL, cacheable=True, delay=delay)
+        elif url.path.endswith('.m3u8'):
+            match = re.fullmatch(r'playlist_(\d+)\.m3u8', os.path.basename(url.path))
+            if match:
+                self.delay_requested(int(match.group(1)), os.path.dirname(url.path).strip('/'))
+                self.send_playlist_file(self.translate_path(url.path), int(match.group(1)), url.query)
+            else:
+                self.send_file(self.translate_path(url.path), PLAYLIST_CACHE_CONTROL)
+        else:
+            super().do_GET()
+
+    def send_playlist(self, delay: int, query: str = ''):
+        """Send the on-demand playlist for a delay"""
+        if delay < 0:
+            self.send_error(400, "Delay must not be negative")
+            return
+        self.delay_requested(delay, playlist_file=False)
+        generator = self.server.playlist_generator
+        playlist = self.blocking_reload(delay, query, lambda: generator.playlist_for_delay(delay))
+        if playlist is not None:
+            self.send_playlist_body(advertise_blocking_reload(playlist), delay)
+
+    def delay_requested(self, delay: int, variant: str = '', playlist_file: bool = True):
+        """Let read ahead know a delay has listeners"""
+        if self.server.read_ahead:
+            self.server.read_ahead.delay_requested(delay, variant, playlist_file)
+
+    def send_seek_playlist(self, start: str, end: Optional[str] = None):
+        """Send a playlist of the buffer from a broadcast time, or between two"""
+        try:
+            start_time = parse_broadcast_time(start)
+            end_time = parse_broadcast_time(end) if end is not None else None
+        except ValueError:
+            self.send_error(400, "Expected ISO 8601 times, eg. /at/2026-10-16T09:00+11:00.m3u8")
+            return
+        if end_time is not None and end_time <= start_time:
+            self.send_error(400, "The end must be after the start")
+            return
+        playlist = self.server.playlist_generator.seek_playlist(start_time, end_time)
+        if playlist is None:
+            self.send_error(404, "Nothing buffered at that time")
+            return
+        self.send_playlist_body(playlist, None, kind='seek_playlist')
+
+    def send_playlist_file(self, path: str, delay: int, query: str = ''):
+        """Send a delayed playlist written by the playlist creator"""
+        def load() -> Optional[str]:
+            try:
+                with open(path, 'r') as f:
+                    return f.read()
+            except OSError:
+                return None
+
+        playlist = self.blocking_reload(delay, query, load, playlist_file=True)
+        if playlist is not None:
+            self.send_playlist_body(advertise_blocking_reload(playlist), delay)
+
+    def blocking_reload(self, delay: int, query: str, load: Callable[[], Optional[str]],
+                        playlist_file: bool = False) -> Optional[str]:
+        """
+        Load a delayed playlist, first waiting for the segment a blocking reload asks for
+
+        A request with _HLS_msn=<n> is held until the playlist load() returns reaches media
+        sequence n, for at most a few target durations (RFC 8216bis 6.2.5.2). The index says
+        when segment n enters the window for this delay, so the wait is a single sleep rather
+        than polling, apart from waiting out the playlist creator rewriting the file.
+
+        Args:
+            playlist_file: Whether load() reads the playlist creator's file, rather than an on-demand playlist
+
+        Returns:
+            str: The playlist, or None once an error has been sent
+        """
+        try:
+            msn = int(parse_qs(query)['_HLS_msn'][0])
+        except KeyError:
+            msn = None
+        except ValueError:
+            self.send_error(400, "Expected an integer _HLS_msn parameter")
+            return None
+
+        generator = self.server.playlist_generator
+        deadline = None
+        while True:
+            playlist = load()
+            if playlist is None:
+                self.send_error(404, "No segments buffered for this delay yet")
+                return None
+            if msn is None:
+                return playlist
+            parsed = parse_media_playlist(playlist)
+            last = parsed.segments[-1].media_sequence if parsed.segments else parsed.media_sequence - 1
+            if msn <= last:
+                return playlist
+            if msn > last + 2:
+                self.send_error(400, "_HLS_msn is too far beyond the end of the playlist")
+                return None
 
-def serve_content():
-    with socketserver.TCPServer(("", PORT), StreamHandler) as httpd:
-        print(f"Serving files from output/ directory at port {PORT}")
+            now = time.time()
+            if deadline is None:
+                deadline = now + BLOCKING_RELOAD_TARGET_DURATIONS * (parsed.target_duration or 10)
+            if now >= deadline:
+                self.send_error(503, "Segment not available yet")
+                return None
+            # Chunks are numbered apart from segments, so a playlist playing them is due by the chunk index
+            chunks = bool(parsed.segments) and f'{CHUNK_FOLDER}/' in parsed.segments[-1].uri
+            due = generator.sequence_due(delay, msn, chunks, playlist_file)
+            wait_seconds = due - now if due is not None and due > now else BLOCKING_RELOAD_POLL_SECONDS
+            generator.wait_for_change(min(wait_seconds, deadline - now))
+
+    def send_playlist_body(self, playlist: str, delay: Optional[int], kind: str = 'playlist'):
+        body = playlist.encode('utf-8')
+        etag = f'"{zlib.crc32(body):x}"'
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', PLAYLIST_CACHE_CONTROL)
+            self.end_headers()
+            self.count_request(delay, kind, 0)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', PLAYLIST_CACHE_CONTROL)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+        self.count_request(delay, kind, len(body))
+
+    def send_metrics(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count_request(self, delay: Optional[int], kind: str, length: int):
+        label = 'unknown' if delay is None else delay
+        served_requests.inc(delay=label, kind=kind)
+        served_bytes.inc(length, delay=label, kind=kind)
+
+    def send_file(self, path: str, cache_control: str, cacheable: bool = False, archive: bool = False,
+                  delay: Optional[int] = None):
+        """Send a file with validators and Range support, from the segment cache, an archive mapping or with sendfile"""
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        kind = 'playlist' if path.endswith('.m3u8') else 'archive' if archive else 'segment'
+        with f:
+            stat = os.fstat(f.fileno())
+            if archive:
+                # Archives only ever grow, so bytes already written never change and the inode identifies them
+                etag = f'"{stat.st_ino:x}"'
+                if not self.headers.get('Range'):
+                    cache_control = PLAYLIST_CACHE_CONTROL
+            else:
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            if etag in self.headers.get('If-None-Match', ''):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                self.count_request(delay, kind, 0)
+                return
+
+            try:
+                byte_range = parse_range(self.headers.get('Range'), stat.st_size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = byte_range if byte_range else (0, stat.st_size - 1)
+            length = end - start + 1
+
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Cache-Control', cache_control)
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{stat.st_size}')
+            self.end_headers()
+            if self.command == 'HEAD' or length <= 0:
+                return
+            self.count_request(delay, kind, length)
+
+            segment_cache = self.server.segment_cache
+            data = segment_cache.get(path, stat.st_mtime_ns) if cacheable else None
+            if archive and byte_range:
+                data = self.server.archive_maps.read(path, f, stat, start, end)
+                start, end = 0, length - 1
+            elif data is None and cacheable and segment_cache.should_admit(path):
+                data = os.pread(f.fileno(), stat.st_size, 0)
+                segment_cache.put(path, stat.st_mtime_ns, data)
+            if data is not None:
+                try:
+                    self.wfile.write(data[start:end + 1])
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+            else:
+                self.sendfile(f, start, length)
+
+    def sendfile(self, f, offset: int, count: int):
+        """Copy part of a file to the client with sendfile, without passing it through userspace"""
+        try:
+            self.connection.sendfile(f, offset, count)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        if self.server.log_requests:
+            super().log_message(format, *args)
+
+    def do_HEAD(self):
+        url = urlsplit(self.path)
+        if url.path.endswith('.aac'):
+            self.send_file(self.translate_path(url.path), SEGMENT_CACHE_CONTROL)
+        else:
+            super().do_HEAD()
+
+
+class StreamServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, server_address, folder: str = playlist_folder,
+                 segment_cache_bytes: int = SEGMENT_CACHE_BYTES, log_requests: bool = True,
+                 playlist_generator: Optional[PlaylistGenerator] = None, read_ahead: bool = True):
+        super().__init__(server_address, functools.partial(StreamHandler, directory=folder))
+        self.playlist_generator = playlist_generator or PlaylistGenerator(folder)
+        self.segment_cache = SegmentCache(segment_cache_bytes)
+        self.archive_maps = ArchiveMaps()
+        self.log_requests = log_requests
+        # Warms the page cache with the segments the delays being listened to play next
+        self.read_ahead = None
+        if read_ahead:
+            self.read_ahead = self.playlist_generator.read_ahead(evict=self.segment_cache.discard)
+            self.read_ahead.start()
+
+    def service_actions(self):
+        # Called by serve_forever between requests, so buffer and timezone changes apply without a restart
+        config.reload_if_changed()
+
+    def server_close(self):
+        if self.read_ahead:
+            self.read_ahead.stop()
+        super().server_close()
+
+
+def serve_content(port: int = PORT, folder: str = playlist_folder, log_requests: bool = True):
+    with StreamServer(("", port), folder, log_requests=log_requests) as httpd:
+        print(f"Serving files from {folder} directory at port {port}")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nShutting down server...")
-            httpd.shutdown()
 
 if __name__ == "__main__":
-    if not os.path.exists("output"):
-        os.makedirs("output")
-    serve_content()
+    parser = argparse.ArgumentParser(description="Serve the delayed playlists and segments")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--folder', default=playlist_folder)
+    parser.add_argument('--quiet', action='store_true', help="Don't log every request to stderr")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.folder):
+        os.makedirs(args.folder)
+    # SIGUSR1 profiles the running server
+    install_profiler(args.folder, 'serve_http')
+    serve_content(args.port, args.folder, log_requests=not args.quiet)
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Each extra variant has a bit in a segment's variant mask, which is a signed 32-bit column
+MAX_VARIANTS = 31
+
+
+class Variant(NamedTuple):
+    """A rendition of a station, as its origin's master playlist describes it"""
+    # Subfolder its segments and delayed playlists are stored in, '' for the station's own rendition
+    name: str
+    bandwidth: int
+    average_bandwidth: Optional[int] = None
+    codecs: Optional[str] = None
+
+
+class StationVariants(NamedTuple):
+    """
+    The station's own rendition and the extra variants recorded alongside it.
+
+    Extra variants share the station's timeline: the same media sequence numbers, durations
+    and wall times, so one segment index serves every variant. A segment's variant mask has
+    bit i set when variants[i] has it too. Variants keep their position once recorded, so
+    the masks already in the journal stay valid when the origin's ladder changes.
+    """
+    primary: Variant
+    variants: List[Variant]
+
+
+def variant_name(url: str) -> str:
+    """Folder name for a variant, from its media playlist's file name (eg. v1-64 for .../v1-64.m3u8)"""
+    stem = os.path.splitext(os.path.basename(urlsplit(url).path))[0]
+    return re.sub(r'[^A-Za-z0-9_-]', '_', stem) or 'variant'
+
+
+def variants_path(folder: str) -> Path:
+    return Path(folder) / 'variants.json'
+
+
+def save_variants(folder: str, station_variants: StationVariants):
+    """Atomically write the station's variants, for the playlist creator and export"""
+    path = variants_path(folder)
+    temp_file = path.with_suffix('.json.tmp')
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump({'primary': station_variants.primary._asdict(),
+                       'variants': [variant._asdict() for variant in station_variants.variants]}, f)
+        temp_file.replace(path)
+    except OSError as e:
+        logging.error(f"Error saving variants: {str(e)}")
+
+
+# Variants as last read, by path, with the (st_ino, st_mtime_ns, st_size) they were read at
+_loaded: Dict[Path, Tuple[Tuple[int, int, int], StationVariants]] = {}
+
+
+def load_variants(folder: str) -> Optional[StationVariants]:
+    """The station's variants, or None if only its own rendition is recorded. The file is only re-read when it changes"""
+    path = variants_path(folder)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    loaded = _loaded.get(path)
+    if loaded and loaded[0] == stat_key:
+        return loaded[1]
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        station_variants = StationVariants(Variant(**data['primary']),
+                                           [Variant(**variant) for variant in data['variants']])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error(f"Error loading variants: {str(e)}")
+        return loaded[1] if loaded else None
+    _loaded[path] = (stat_key, station_variants)
+    return station_variants
+
+
+def stream_inf(variant: Variant) -> str:
+    attributes = [f'BANDWIDTH={variant.bandwidth}']
+    if variant.average_bandwidth:
+        attributes.append(f'AVERAGE-BANDWIDTH={variant.average_bandwidth}')
+    if variant.codecs:
+        attributes.append(f'CODECS="{variant.codecs}"')
+    return '#EXT-X-STREAM-INF:' + ','.join(attributes)
+
+
+def render_master_playlist(station_variants: StationVariants, playlist_file_name: str) -> str:
+    """
+    Render the master playlist for one delay, pointing at that delay's playlist of every variant
+
+    The station's own rendition is listed first, so players start on it.
+    """
+    lines = ['#EXTM3U', stream_inf(station_variants.primary), playlist_file_name]
+    for variant in station_variants.variants:
+        lines.append(stream_inf(variant))
+        lines.append(f'{variant.name}/{playlist_file_name}')
+    return '\n'.join(lines) + '\n'